@@ -0,0 +1,304 @@
+import argparse
+import itertools
+import json
+import os
+import platform
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import container
+import data_steg
+import steganography
+import wav_file
+from wav_file import WavFile
+
+MB = 1 << 20
+SAMPLE_RATE = 44100
+PARSE_COUNT = 100
+PAYLOAD_PART = 0.5
+REPORT_VERSION = 1
+DEFAULT_THRESHOLD = 0.1
+# sizes of carriers in seconds, counts of channels, bits per sample,
+# masks, counts of lsbs, engines and modes of every suite
+SUITES = {
+    'quick': {'seconds': [1, 8], 'channels': [1, 2], 'bits': [16, 24],
+              'masks': ['1', '1101'], 'lsb_counts': [1],
+              'engines': ['bulk', 'parallel', 'in_place'],
+              'modes': ['plain', 'compress']},
+    'full': {'seconds': [1, 10, 60], 'channels': [1, 2, 6],
+             'bits': [8, 16, 24, 32], 'masks': ['1', '1101', '10000000'],
+             'lsb_counts': [1, 2, 4],
+             'engines': ['bulk', 'parallel', 'in_place'],
+             'modes': ['plain', 'compress']},
+}
+# metrics and whether bigger is better
+METRICS = {'embed_mb_s': True, 'extract_mb_s': True, 'parse_ms': False,
+           'listing_ms': False, 'embed_peak_mb': False,
+           'extract_peak_mb': False, 'startup_ms': False}
+# commands of startup cases, {main} and {carrier} are replaced by paths
+STARTUP_COMMANDS = {
+    'import': ['-c', 'import steganography'],
+    'info': ['{main}', '-i', '{carrier}', '-d', '.', '-s'],
+}
+
+
+def make_carrier(path, seconds, num_channels, bits):
+    # pcm wav file with random samples
+    block_align = num_channels * bits // 8
+    data_size = int(seconds * SAMPLE_RATE) * block_align
+    header = b'RIFF' + struct.pack('<I', 36 + data_size) + \
+        b'WAVEfmt ' + struct.pack('<IHHIIHH', 16, 1, num_channels,
+                                  SAMPLE_RATE, SAMPLE_RATE * block_align,
+                                  block_align, bits) + \
+        b'data' + struct.pack('<I', data_size)
+    with open(path, 'wb') as file:
+        file.write(header)
+        for position in range(0, data_size, MB):
+            file.write(os.urandom(min(MB, data_size - position)))
+
+
+def make_payload(path, size):
+    # half of random and half of repeated bytes, so compression matters
+    with open(path, 'wb') as file:
+        file.write(os.urandom(size // 2))
+        file.write(b'benchmark ' * ((size - size // 2) // 10))
+        file.write(b'b' * ((size - size // 2) % 10))
+
+
+def measure(function, setup=None, repeats=3):
+    # best time of the repeats, setup is not timed
+    times = []
+    for repeat in range(repeats):
+        if setup is not None:
+            setup()
+        start_time = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start_time)
+    return min(times)
+
+
+def measure_memory(function, setup=None):
+    # peak of python allocations of this process, workers are not counted
+    if setup is not None:
+        setup()
+    tracemalloc.start()
+    try:
+        function()
+        return tracemalloc.get_traced_memory()[1] / MB
+    finally:
+        tracemalloc.stop()
+
+
+def get_case_name(case):
+    return '{seconds}s-{channels}ch-{bits}bit-mask{mask}-k{lsb_count}-' \
+           '{engine}-{mode}'.format(**case)
+
+
+def iter_cases(suite):
+    keys = ['seconds', 'channels', 'bits', 'mask', 'lsb_count', 'engine',
+            'mode']
+    values = itertools.product(suite['seconds'], suite['channels'],
+                               suite['bits'], suite['masks'],
+                               suite['lsb_counts'], suite['engines'],
+                               suite['modes'])
+    for case_values in values:
+        yield dict(zip(keys, case_values))
+
+
+def run_case(case, carrier, work_dir, workers=2, repeats=3):
+    compress = case['mode'] == 'compress'
+    mask = case['mask']
+    lsb_count = case['lsb_count']
+    engine_workers = workers if case['engine'] == 'parallel' else 1
+    out_name = os.path.join(work_dir, 'out.wav')
+    payload = os.path.join(work_dir, 'payload.bin')
+    out_dir = os.path.join(work_dir, 'unpack')
+    os.makedirs(out_dir, exist_ok=True)
+    with open(carrier, 'rb') as in_file:
+        storage_size = steganography.get_storage_size(in_file, mask,
+                                                      lsb_count)
+    make_payload(payload, int(storage_size * PAYLOAD_PART))
+
+    def copy_carrier():
+        shutil.copyfile(carrier, out_name)
+
+    def embed():
+        with open(payload, 'rb') as payload_file:
+            if case['engine'] == 'in_place':
+                with open(out_name, 'r+b') as file:
+                    steganography.write_files_in_place(
+                        file, [payload_file], False, mask, compress,
+                        lsb_count=lsb_count)
+                return
+            with open(carrier, 'rb') as in_file, \
+                    open(out_name, 'wb') as out_file:
+                steganography.write_files(
+                    in_file, out_file, [payload_file], False, mask,
+                    compress, engine_workers, lsb_count)
+
+    def extract():
+        with open(out_name, 'rb') as in_file:
+            steganography.read_files(in_file, out_dir, mask, compress,
+                                     engine_workers, lsb_count)
+
+    def parse():
+        with open(carrier, 'rb') as in_file:
+            for index in range(PARSE_COUNT):
+                in_file.seek(0)
+                WavFile(in_file)
+
+    def listing():
+        with open(out_name, 'rb') as in_file:
+            steganography.get_listing(in_file, mask, compress, lsb_count)
+
+    setup = copy_carrier if case['engine'] == 'in_place' else None
+    carrier_size = os.path.getsize(carrier) / MB
+    result = dict(case, name=get_case_name(case),
+                  carrier_mb=carrier_size,
+                  payload_mb=os.path.getsize(payload) / MB)
+    result['embed_mb_s'] = carrier_size / measure(embed, setup, repeats)
+    result['extract_mb_s'] = carrier_size / measure(extract,
+                                                    repeats=repeats)
+    result['parse_ms'] = measure(parse, repeats=repeats) * 1000 / \
+        PARSE_COUNT
+    result['listing_ms'] = measure(listing, repeats=repeats) * 1000
+    result['embed_peak_mb'] = measure_memory(embed, setup)
+    result['extract_peak_mb'] = measure_memory(extract)
+    return result
+
+
+def run_startup(carrier, repeats=3):
+    # time of new interpreters from start to exit, so import time counts
+    main_name = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'main.py')
+    results = []
+    for name, arguments in sorted(STARTUP_COMMANDS.items()):
+        command = [sys.executable] + [
+            argument.format(main=main_name, carrier=carrier)
+            for argument in arguments]
+        seconds = measure(lambda: subprocess.run(
+            command, check=True, stdout=subprocess.DEVNULL,
+            cwd=os.path.dirname(main_name)), repeats=repeats)
+        results.append({'name': 'startup-' + name,
+                        'startup_ms': seconds * 1000})
+    return results
+
+
+def run_suite(suite, work_dir, workers=2, repeats=3, log=None):
+    carriers = {}
+    results = []
+    for case in iter_cases(suite):
+        key = (case['seconds'], case['channels'], case['bits'])
+        if key not in carriers:
+            carriers[key] = os.path.join(
+                work_dir, 'carrier-{}s-{}ch-{}bit.wav'.format(*key))
+            make_carrier(carriers[key], *key)
+        results.append(run_case(case, carriers[key], work_dir, workers,
+                                repeats))
+        if log is not None:
+            log('{name}: embed {embed_mb_s:.2f} MB/s, extract '
+                '{extract_mb_s:.2f} MB/s'.format(**results[-1]))
+    for result in run_startup(next(iter(carriers.values())), repeats):
+        results.append(result)
+        if log is not None:
+            log('{name}: {startup_ms:.1f} ms'.format(**result))
+    return results
+
+
+def make_report(results, suite_name, workers):
+    return {'version': REPORT_VERSION, 'suite': suite_name,
+            'workers': workers, 'python': platform.python_version(),
+            'platform': platform.platform(), 'time': time.time(),
+            'results': results}
+
+
+def compare(old_report, new_report, threshold=DEFAULT_THRESHOLD):
+    # regressions: (name, metric, old, new) of the cases of both reports
+    # which are worse than threshold part of the old value
+    old_results = {result['name']: result
+                   for result in old_report['results']}
+    regressions = []
+    for result in new_report['results']:
+        old = old_results.get(result['name'])
+        if old is None:
+            continue
+        for metric, bigger_is_better in METRICS.items():
+            old_value, new_value = old.get(metric), result.get(metric)
+            if not old_value or new_value is None:
+                continue
+            change = (new_value - old_value) / old_value
+            if bigger_is_better:
+                change = -change
+            if change > threshold:
+                regressions.append((result['name'], metric, old_value,
+                                    new_value))
+    return regressions
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Wav steganography '
+                                                 'benchmarks')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    parser_run = subparsers.add_parser('run', help='run benchmarks')
+    parser_run.add_argument('-o', action='store', dest='output',
+                            default='benchmark.json',
+                            help='json file for results')
+    parser_run.add_argument('-s', action='store', dest='suite',
+                            choices=sorted(SUITES), default='quick',
+                            help='set of carriers, engines and modes')
+    parser_run.add_argument('-j', action='store', dest='workers', type=int,
+                            default=2,
+                            help='count of processes of parallel engine')
+    parser_run.add_argument('-r', action='store', dest='repeats', type=int,
+                            default=3,
+                            help='count of runs, the best one is taken')
+    parser_run.add_argument('-d', action='store', dest='workdir',
+                            default=None,
+                            help='directory for carriers, temporary '
+                                 'by default')
+    parser_compare = subparsers.add_parser(
+        'compare', help='compare results with old ones')
+    parser_compare.add_argument('old', help='json file of old results')
+    parser_compare.add_argument('new', help='json file of new results')
+    parser_compare.add_argument('-t', action='store', dest='threshold',
+                                type=float, default=DEFAULT_THRESHOLD,
+                                help='allowed part of slowdown')
+    return parser
+
+
+def main():
+    args = get_parser().parse_args()
+    if args.command == 'compare':
+        with open(args.old) as old_file, open(args.new) as new_file:
+            regressions = compare(json.load(old_file), json.load(new_file),
+                                  args.threshold)
+        for name, metric, old_value, new_value in regressions:
+            print('{} {}: {:.3f} -> {:.3f}'.format(name, metric, old_value,
+                                                   new_value))
+        print('{} regressions'.format(len(regressions)))
+        sys.exit(1 if regressions else 0)
+    for initialize in (steganography.initialize_steganography,
+                       wav_file.initialize_wav_file,
+                       data_steg.initialize_data_steg,
+                       container.initialize_container):
+        initialize(False)
+    if args.workdir is None:
+        with tempfile.TemporaryDirectory() as work_dir:
+            results = run_suite(SUITES[args.suite], work_dir, args.workers,
+                                args.repeats, print)
+    else:
+        os.makedirs(args.workdir, exist_ok=True)
+        results = run_suite(SUITES[args.suite], args.workdir, args.workers,
+                            args.repeats, print)
+    with open(args.output, 'w') as output_file:
+        json.dump(make_report(results, args.suite, args.workers),
+                  output_file, indent=4)
+
+
+if __name__ == '__main__':
+    main()
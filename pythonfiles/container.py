@@ -0,0 +1,190 @@
+import importlib
+import logging
+import struct
+import time
+import zlib
+from functools import partial
+
+import instrumentation
+from steganography_exceptions import DecodingError
+
+MAGIC = b'SWFC'
+VERSION = 1
+STORE_CODEC = 0
+ZLIB_CODEC = 1
+DEFAULT_CODEC = 'zlib-9'
+AUTO_CODEC = 'auto'
+# minimal compression speed of the codec chosen by auto mode, MiB/s
+AUTO_SPEED = 8.0
+SAMPLE_SIZE = 1 << 18
+HEADER = struct.Struct('<4sBBIII')
+FRAME_ENTRY = struct.Struct('<I')
+FRAME_SIZE = 1 << 20
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+# Framed container, written instead of one gzip stream:
+#   header: magic, version, codec, frame size, count of frames,
+#           size of label
+#   label: uncompressed
+#   frame table: compressed size of every frame
+#   frames: content of all files, split by frame size and compressed
+#           independently of each other by the codec of the header
+
+# codec id: (name, compress, decompress)
+CODECS = {}
+
+
+def initialize_container(debug):
+    global logger
+    logger.disabled = not debug
+
+
+def register_codec(codec, name, compress, decompress):
+    # codec id is written to the header, it must not change
+    if codec in CODECS or not 0 <= codec <= 0xff:
+        raise ValueError('codec id {} is not free'.format(codec))
+    CODECS[codec] = (name, compress, decompress)
+
+
+def get_codec(name):
+    # codec id by name
+    for codec, (codec_name, compress, decompress) in CODECS.items():
+        if codec_name == name:
+            return codec
+    raise ValueError('unknown codec {}'.format(name))
+
+
+def _call_lazy(module_name, function_name, *args, **kwargs):
+    # bz2 and lzma are imported at the first use, not at start
+    module = importlib.import_module(module_name)
+    try:
+        return getattr(module, function_name)(*args, **kwargs)
+    except getattr(module, 'LZMAError', ValueError) as error:
+        raise ValueError(error)
+
+
+def get_codec_names():
+    return [name for name, compress, decompress in CODECS.values()]
+
+
+register_codec(STORE_CODEC, 'store', bytes, bytes)
+register_codec(ZLIB_CODEC, 'zlib-9', partial(zlib.compress, level=9),
+               zlib.decompress)
+register_codec(2, 'zlib-1', partial(zlib.compress, level=1),
+               zlib.decompress)
+register_codec(3, 'zlib-6', partial(zlib.compress, level=6),
+               zlib.decompress)
+register_codec(4, 'bz2-9',
+               partial(_call_lazy, 'bz2', 'compress', compresslevel=9),
+               partial(_call_lazy, 'bz2', 'decompress'))
+register_codec(5, 'lzma-6', partial(_call_lazy, 'lzma', 'compress', preset=6),
+               partial(_call_lazy, 'lzma', 'decompress'))
+register_codec(6, 'lzma-9', partial(_call_lazy, 'lzma', 'compress', preset=9),
+               partial(_call_lazy, 'lzma', 'decompress'))
+
+
+def is_container(data):
+    return data[:len(MAGIC)] == MAGIC
+
+
+def make_header(frame_size, frames_count, label_size, codec=ZLIB_CODEC):
+    return HEADER.pack(MAGIC, VERSION, codec, frame_size,
+                       frames_count, label_size)
+
+
+def read_header(data):
+    magic, version, codec, frame_size, frames_count, label_size = \
+        HEADER.unpack(data)
+    if magic != MAGIC or version != VERSION or codec not in CODECS or \
+            frame_size == 0:
+        logger.error('unsupported container: {}'.format(data))
+        raise DecodingError(
+            "Error decoding, try change mask or input password")
+    logger.info('container header was successfully read')
+    return {'codec': codec, 'frame_size': frame_size,
+            'frames_count': frames_count, 'label_size': label_size}
+
+
+def get_frames_count(data_size, frame_size):
+    return -(-data_size // frame_size)
+
+
+def make_frame_table(frame_sizes):
+    return b''.join(map(FRAME_ENTRY.pack, frame_sizes))
+
+
+def read_frame_table(data):
+    return [size for size, in FRAME_ENTRY.iter_unpack(data)]
+
+
+def get_frame_offsets(frame_sizes):
+    # offsets of the frames from the end of the frame table
+    offsets = [0]
+    for size in frame_sizes:
+        offsets.append(offsets[-1] + size)
+    return offsets
+
+
+def iter_frames(chunks, frame_size):
+    # joins or splits chunks to pieces of frame size, last may be shorter
+    buffer = bytearray()
+    for chunk in chunks:
+        buffer += chunk
+        while len(buffer) >= frame_size:
+            yield bytes(buffer[:frame_size])
+            del buffer[:frame_size]
+    if buffer:
+        yield bytes(buffer)
+
+
+def compress_frame(frame, codec=ZLIB_CODEC):
+    with instrumentation.stage('compress') as stage:
+        stage.add(len(frame))
+        return CODECS[codec][1](frame)
+
+
+def decompress_frame(data, codec=ZLIB_CODEC):
+    try:
+        with instrumentation.stage('decompress') as stage:
+            frame = CODECS[codec][2](data)
+            stage.add(len(frame))
+            return frame
+    except (zlib.error, OSError, ValueError, EOFError):
+        raise DecodingError(
+            "Error decoding, try change mask or input password")
+
+
+def choose_codec(sample, speed=AUTO_SPEED):
+    # codec giving the smallest sample among codecs compressing at least
+    # speed MiB/s, the fastest one if there is no such codec
+    results = []
+    for codec, (name, compress, decompress) in CODECS.items():
+        start_time = time.perf_counter()
+        size = len(compress(sample))
+        seconds = max(time.perf_counter() - start_time, 1e-9)
+        results.append((len(sample) / seconds / (1 << 20), size, codec))
+    fast_results = [result for result in results if result[0] >= speed]
+    if fast_results:
+        codec = min(fast_results, key=lambda result: result[1:])[2]
+    else:
+        codec = max(results)[2]
+    logger.info('codec {} was chosen'.format(CODECS[codec][0]))
+    return codec
+
+
+def get_pieces(sizes, frame_index, frame_size):
+    # (index of file, offset in file, offset in frame, length) for every
+    # file which has bytes in the frame
+    frame_start = frame_index * frame_size
+    frame_stop = frame_start + frame_size
+    file_start = 0
+    for index, size in enumerate(sizes):
+        start = max(file_start, frame_start)
+        stop = min(file_start + size, frame_stop)
+        if start < stop:
+            yield index, start - file_start, start - frame_start, stop - start
+        file_start += size
+        if file_start >= frame_stop:
+            break
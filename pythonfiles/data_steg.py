@@ -1,23 +1,269 @@
 import logging
-from random import getrandbits
+import math
+import mmap
+import operator
+import os
+import struct
+from bisect import bisect_left
+from collections import deque
+from itertools import repeat
+from random import getrandbits, seed
 import itertools
 
+import instrumentation
 from wav_file import WavFile
+from steganography_exceptions import DecodingError, MaskError
 
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.DEBUG)
-fileHandler = logging.FileHandler('stegano_logs.log')
-fileHandler.setLevel(logging.DEBUG)
-format_string = '%(name)s %(levelname)s %(asctime)s %(message)s'
-formatter = logging.Formatter(format_string)
-fileHandler.setFormatter(formatter)
-logger.addHandler(fileHandler)
+logger.addHandler(logging.NullHandler())
+
+LSB_COUNTS = (1, 2, 4, 8)
+LSB_TABLE = bytes(x & 1 for x in range(256))
+# for every count of lsbs: tables of the low bits, of the cleared low
+# bits and of every bit of the low bits, most significant first
+LOW_TABLES = {k: bytes(x & (1 << k) - 1 for x in range(256))
+              for k in LSB_COUNTS}
+CLEAR_TABLES = {k: bytes(x >> k << k for x in range(256))
+                for k in LSB_COUNTS}
+BIT_TABLES = {k: [bytes(x >> (k - 1 - j) & 1 for x in range(256))
+                  for j in range(k)] for k in LSB_COUNTS}
+HIGH_BIT_TABLE = bytes(x >> 7 for x in range(256))
+BIT_TABLE = bytes.maketrans(b'01', b'\x00\x01')
+ASCII_TABLE = bytes.maketrans(b'\x00\x01', b'01')
+COPY_CHUNK_SIZE = 1 << 20
+READ_CHUNK_SIZE = 1 << 20
+JOURNAL_SUFFIX = '.journal'
+# offset in the carrier and size of the original bytes which follow
+JOURNAL_ENTRY = struct.Struct('<QI')
+# journal entry of one original byte
+JOURNAL_BYTE = struct.Struct('<QIB')
+# mask of keyed scattering: the prefix and then the key
+SCATTER_PREFIX = 'scatter:'
 
 
 def byte2bit(byte):
     return bin(byte)[2:].zfill(8)
 
 
+def bytes2bits(data):
+    # one byte (0 or 1) per bit, most significant bit first like byte2bit
+    if not data:
+        return b''
+    bits = bin(int.from_bytes(b'\x01' + bytes(data), 'big'))[3:]
+    return bits.encode().translate(BIT_TABLE)
+
+
+def bits2bytes(bits):
+    if not bits:
+        return b''
+    number = int(bytes(bits).translate(ASCII_TABLE), base=2)
+    return number.to_bytes(len(bits) // 8, 'big')
+
+
+def set_lsbs(lows, bits, lsb_count=1):
+    # bits are values of lsb_count low bits, one byte per value
+    cleared = int.from_bytes(
+        bytes(lows).translate(CLEAR_TABLES[lsb_count]), 'little')
+    number = cleared | int.from_bytes(bits, 'little')
+    return number.to_bytes(len(lows), 'little')
+
+
+def pack_bits(bits, lsb_count):
+    # one byte per lsb_count bits, most significant bit first
+    if lsb_count == 1:
+        return bits
+    number = 0
+    for index in range(lsb_count):
+        number |= int.from_bytes(bytes(bits[index::lsb_count]), 'little') \
+            << lsb_count - 1 - index
+    return number.to_bytes(len(bits) // lsb_count, 'little')
+
+
+def unpack_bits(values, lsb_count):
+    if lsb_count == 1:
+        return values
+    bits = bytearray(len(values) * lsb_count)
+    for index, table in enumerate(BIT_TABLES[lsb_count]):
+        bits[index::lsb_count] = values.translate(table)
+    return bits
+
+
+def random_lsbs(count):
+    # same bits as count sequential getrandbits(1) calls: each of them
+    # takes the high bit of the next 32-bit word of the generator
+    if count <= 0:
+        return b''
+    words = getrandbits(32 * count).to_bytes(4 * count, 'little')
+    return words[3::4].translate(HIGH_BIT_TABLE)
+
+
+class MaskLayout:
+    # maps payload bit indices to sample indices for a cyclic mask, every
+    # sample of a slot keeps lsb_count bits of the payload
+    def __init__(self, mask, noise=False, lsb_count=1):
+        if lsb_count not in LSB_COUNTS:
+            raise MaskError('count of lsbs must be one of {}'.format(
+                LSB_COUNTS))
+        self.mask = mask
+        self.noise = noise
+        self.lsb_count = lsb_count
+        self.period = len(mask)
+        self.ones = [i for i, cell in enumerate(mask) if cell == '1']
+        self.zeros = [i for i, cell in enumerate(mask) if cell != '1']
+        if not self.ones:
+            raise MaskError('mask {} has no ones'.format(repr(mask)))
+        # with noise every sample takes a bit, zeros get random ones
+        self.slots = list(range(self.period)) if noise else self.ones
+
+    def get_sample(self, bit_index):
+        cycle, slot = divmod(bit_index // self.lsb_count, len(self.slots))
+        return cycle * self.period + self.slots[slot]
+
+    def get_bits_before(self, sample):
+        cycle, cell = divmod(sample, self.period)
+        return (cycle * len(self.slots) + bisect_left(self.slots, cell)) * \
+            self.lsb_count
+
+    def _get_zeros_before(self, sample):
+        cycle, cell = divmod(sample, self.period)
+        return cycle * len(self.zeros) + bisect_left(self.zeros, cell)
+
+    def _runs(self, first_bit, bits_count):
+        # yields (slot, first bit index, count) for every mask slot, bit
+        # indices here are indices of values of lsb_count bits
+        density = len(self.slots)
+        for slot in range(density):
+            bit_index = first_bit + (slot - first_bit) % density
+            if bit_index >= first_bit + bits_count:
+                continue
+            count = (first_bit + bits_count - bit_index - 1) // density + 1
+            yield slot, bit_index, count
+
+    def embed(self, block, first_sample, bits, first_bit, width):
+        # first_bit and count of bits are multiples of lsb_count
+        step = self.period * width
+        values = pack_bits(bits, self.lsb_count)
+        first_value = first_bit // self.lsb_count
+        for slot, index, count in self._runs(first_value, len(values)):
+            start = (self.get_sample(index * self.lsb_count) -
+                     first_sample) * width
+            stop = start + (count - 1) * step + 1
+            offset = index - first_value
+            block[start:stop:step] = set_lsbs(
+                block[start:stop:step], values[offset::len(self.slots)],
+                self.lsb_count)
+        if self.noise and bits:
+            self._randomize(block, first_sample, self.get_sample(first_bit),
+                            self.get_sample(first_bit + len(bits) - 1) + 1,
+                            width)
+
+    def _randomize(self, block, first_sample, start, stop, width):
+        step = self.period * width
+        first_zero = self._get_zeros_before(start)
+        noise = pack_bits(random_lsbs(
+            (self._get_zeros_before(stop) - first_zero) * self.lsb_count),
+            self.lsb_count)
+        for index, zero in enumerate(self.zeros):
+            sample = start + (zero - start) % self.period
+            if sample >= stop:
+                continue
+            count = (stop - sample - 1) // self.period + 1
+            offset = (sample // self.period * len(self.zeros) + index -
+                      first_zero)
+            begin = (sample - first_sample) * width
+            end = begin + (count - 1) * step + 1
+            block[begin:end:step] = set_lsbs(
+                block[begin:end:step], noise[offset::len(self.zeros)],
+                self.lsb_count)
+
+    def extract(self, block, first_sample, first_bit, bits_count, width):
+        step = self.period * width
+        values = bytearray(bits_count // self.lsb_count)
+        first_value = first_bit // self.lsb_count
+        for slot, index, count in self._runs(first_value, len(values)):
+            start = (self.get_sample(index * self.lsb_count) -
+                     first_sample) * width
+            stop = start + (count - 1) * step + 1
+            offset = index - first_value
+            # bytes() also accepts memoryview blocks of mapped files
+            values[offset::len(self.slots)] = bytes(
+                block[start:stop:step]).translate(LOW_TABLES[self.lsb_count])
+        return unpack_bits(values, self.lsb_count)
+
+
+class ScatterLayout:
+    # value j of lsb_count bits goes to sample (a * j + b) % count of the
+    # whole data chunk, a and b are derived from the key; bit and sample
+    # indices of the other methods are virtual, value j is sample j; all
+    # samples are slots, so there are no zeros for noise
+    def __init__(self, mask, noise=False, lsb_count=1):
+        if lsb_count not in LSB_COUNTS:
+            raise MaskError('count of lsbs must be one of {}'.format(
+                LSB_COUNTS))
+        if noise:
+            raise MaskError('noise is not supported with scattering')
+        self.mask = mask
+        self.noise = noise
+        self.lsb_count = lsb_count
+        self.period = 1
+        import hashlib
+        self.key = hashlib.sha256(
+            mask[len(SCATTER_PREFIX):].encode()).digest()
+        self.maps = {}
+
+    def get_sample(self, bit_index):
+        return bit_index // self.lsb_count
+
+    def get_bits_before(self, sample):
+        return sample * self.lsb_count
+
+    def _get_map(self, count):
+        # step coprime with count makes the map a permutation, it is
+        # taken from the middle half of the range to spread the values
+        if count not in self.maps:
+            step = count // 4 + int.from_bytes(self.key[:16], 'little') % \
+                max(1, count // 2)
+            while math.gcd(step, count) != 1:
+                step += 1
+            self.maps[count] = (step, int.from_bytes(self.key[16:],
+                                                     'little') % count)
+        return self.maps[count]
+
+    def get_positions(self, first_value, values_count, count):
+        # samples of the values as a list, count is the count of samples
+        if first_value + values_count > count:
+            raise IndexError('data does not fit into wav file')
+        step, shift = self._get_map(count)
+        start = step * first_value + shift
+        return list(map(operator.mod,
+                        range(start, start + step * values_count, step),
+                        repeat(count)))
+
+
+def is_scatter(mask):
+    return mask.startswith(SCATTER_PREFIX)
+
+
+def make_layout(mask, noise=False, lsb_count=1):
+    if is_scatter(mask):
+        return ScatterLayout(mask, noise, lsb_count)
+    return MaskLayout(mask, noise, lsb_count)
+
+
+def gather_lows(in_wav_file, positions):
+    # low bytes of the samples at positions of the data chunk
+    width = in_wav_file.get_sample_width()
+    offsets = map(operator.add, map(operator.mul, positions, repeat(width)),
+                  repeat(in_wav_file.data_start))
+    if in_wav_file.view is not None:
+        return bytes(map(in_wav_file.view.__getitem__, offsets))
+    lows = bytearray()
+    for offset in offsets:
+        in_wav_file.in_file.seek(offset)
+        lows += in_wav_file.in_file.read(1)
+    return bytes(lows)
+
+
 def gen_mask(mask):
     for mask_cell in itertools.cycle(mask):
         yield mask_cell
@@ -78,6 +324,372 @@ def write_data(in_wav_file, out_wav_file, in_data, noise, mask):
     logger.info('writing {} bytes successfully complete'.format(len(in_data)))
 
 
+class BulkWriter:
+    # streaming form of write_data_bulk: data is embedded chunk by chunk
+    # and only the samples covered by the current chunk are in memory
+    def __init__(self, in_wav_file, out_wav_file, noise, mask, lsb_count=1):
+        self.in_wav_file = in_wav_file
+        self.out_wav_file = out_wav_file
+        self.layout = make_layout(mask, noise, lsb_count)
+        self.width = in_wav_file.get_sample_width()
+        self.bits_count = 0
+        self.samples_count = 0
+
+    def get_written_size(self):
+        return self.bits_count // 8
+
+    def _read_samples(self, bits_count):
+        last_sample = self.layout.get_sample(self.bits_count + bits_count - 1)
+        count = last_sample + 1 - self.samples_count
+        block = bytearray(self.in_wav_file.read_block(count))
+        if len(block) < count * self.width:
+            raise IndexError('data does not fit into wav file')
+        return block
+
+    def write(self, data):
+        bits = bytes2bits(data)
+        if not bits:
+            return
+        with instrumentation.stage('embed') as stage:
+            block = self._read_samples(len(bits))
+            self.layout.embed(block, self.samples_count, bits,
+                              self.bits_count, self.width)
+            self._store(block)
+            stage.add(len(data), len(block) // self.width)
+        self.bits_count += len(bits)
+        self.samples_count += len(block) // self.width
+
+    def _get_position(self):
+        return self.out_wav_file.size
+
+    def _store(self, block):
+        self.out_wav_file.write_data(bytes(block))
+
+    def _patch(self, position, block):
+        self.out_wav_file.patch_data(position, bytes(block))
+
+    def is_patchable(self):
+        return self.out_wav_file.is_patchable()
+
+    def reserve(self, size):
+        # keeps the samples for size bytes which are known only later,
+        # writer must be patchable
+        block = self._read_samples(size * 8)
+        reserved = (self._get_position(), block,
+                    self.samples_count, self.bits_count)
+        self._store(block)
+        self.bits_count += size * 8
+        self.samples_count += len(block) // self.width
+        return reserved
+
+    def fill(self, reserved, data):
+        position, block, first_sample, first_bit = reserved
+        self.layout.embed(block, first_sample, bytes2bits(data),
+                          first_bit, self.width)
+        self._patch(position, block)
+
+    def abort(self):
+        pass
+
+    def close(self):
+        # rest of the data chunk and then the chunks after it
+        channels_left = self.in_wav_file.get_channels_count() - \
+            self.in_wav_file.count_of_read_channels
+        while channels_left > 0:
+            count = min(channels_left, COPY_CHUNK_SIZE)
+            data = self.in_wav_file.read_block(count)
+            if not data:
+                break
+            self.out_wav_file.write_data(data)
+            channels_left -= count
+        self.out_wav_file.write_data(self.in_wav_file.read_tail())
+
+
+class InPlaceWriter(BulkWriter):
+    # changes only the samples covered by the data in the carrier itself,
+    # the wav file must be read from a named file opened with 'r+b'; the
+    # original bytes of every block go to the journal before the block is
+    # changed, so an interrupted writing is rolled back by rollback_journal
+    def __init__(self, in_wav_file, noise, mask, lsb_count=1):
+        super().__init__(in_wav_file, None, noise, mask, lsb_count)
+        self.file = in_wav_file.in_file
+        self.journal_name = self.file.name + JOURNAL_SUFFIX
+        rollback_journal(self.file.name)
+        self.journal = open(self.journal_name, 'xb')
+
+    def _get_position(self):
+        return self.in_wav_file.data_start + self.samples_count * self.width
+
+    def _store(self, block):
+        self._patch(self._get_position(), block)
+
+    def _patch(self, position, block):
+        self.file.seek(position)
+        original = self.file.read(len(block))
+        self.journal.write(JOURNAL_ENTRY.pack(position, len(original)))
+        self.journal.write(original)
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+        self.file.seek(position)
+        self.file.write(block)
+
+    def is_patchable(self):
+        return True
+
+    def abort(self):
+        self.journal.close()
+        self.file.flush()
+        rollback_journal(self.file.name)
+
+    def close(self):
+        # samples after the data are not touched at all
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.journal.close()
+        os.remove(self.journal_name)
+
+
+class ScatterWriter(BulkWriter):
+    # values are written to the samples of the keyed permutation, see
+    # ScatterLayout; the data chunk is copied to the output at once and
+    # then patched, without out wav file the carrier is patched in place
+    # with the original bytes in the journal like with InPlaceWriter; the
+    # data chunk of an output which can only be appended is patched in a
+    # temporary file and written on close
+    def __init__(self, in_wav_file, out_wav_file, noise, mask, lsb_count=1):
+        super().__init__(in_wav_file, out_wav_file, noise, mask, lsb_count)
+        self.count = in_wav_file.get_channels_count()
+        self.target = None
+        self.journal = None
+        self.spool = None
+        if out_wav_file is None:
+            self.file = in_wav_file.in_file
+            self.base = in_wav_file.data_start
+            self.journal_name = self.file.name + JOURNAL_SUFFIX
+            rollback_journal(self.file.name)
+            self.journal = open(self.journal_name, 'xb')
+            self.target = mmap.mmap(self.file.fileno(), 0)
+            return
+        self.base = out_wav_file.size + 1
+        write = out_wav_file.write_data
+        if not out_wav_file.is_patchable():
+            import tempfile
+            self.spool = tempfile.TemporaryFile()
+            write = self.spool.write
+        left = self.count
+        while left > 0:
+            data = in_wav_file.read_block(min(left, COPY_CHUNK_SIZE))
+            if not data:
+                break
+            write(data)
+            left -= len(data) // self.width
+        if self.spool is not None:
+            self.spool.flush()
+            self.file = self.spool
+            self.base = 0
+            if self.spool.tell():
+                self.target = mmap.mmap(self.spool.fileno(), 0)
+        elif isinstance(getattr(out_wav_file.out_file, 'name', None), str) \
+                and out_wav_file.is_patchable():
+            out_wav_file.out_file.flush()
+            self.file = open(out_wav_file.out_file.name, 'r+b')
+            self.target = mmap.mmap(self.file.fileno(), 0)
+            self.base += out_wav_file.start
+
+    def _embed(self, first_bit, bits):
+        values = pack_bits(bits, self.layout.lsb_count)
+        positions = self.layout.get_positions(
+            first_bit // self.layout.lsb_count, len(values), self.count)
+        lows = gather_lows(self.in_wav_file, positions)
+        data = set_lsbs(lows, values, self.layout.lsb_count)
+        offsets = list(map(operator.add, map(operator.mul, positions,
+                                             repeat(self.width)),
+                           repeat(self.base)))
+        if self.journal is not None:
+            self.journal.write(b''.join(map(JOURNAL_BYTE.pack, offsets,
+                                            repeat(1), lows)))
+            self.journal.flush()
+            os.fsync(self.journal.fileno())
+        if self.target is not None:
+            deque(map(self.target.__setitem__, offsets, data), maxlen=0)
+            return
+        for offset, value in zip(offsets, data):
+            self.out_wav_file.patch_data(offset - 1, bytes((value,)))
+
+    def write(self, data):
+        bits = bytes2bits(data)
+        if not bits:
+            return
+        with instrumentation.stage('embed') as stage:
+            self._embed(self.bits_count, bits)
+            stage.add(len(data), len(bits) // self.layout.lsb_count)
+        self.bits_count += len(bits)
+        self.samples_count += len(bits) // self.layout.lsb_count
+
+    def reserve(self, size):
+        reserved = self.bits_count
+        self.bits_count += size * 8
+        self.samples_count += size * 8 // self.layout.lsb_count
+        return reserved
+
+    def fill(self, reserved, data):
+        self._embed(reserved, bytes2bits(data))
+
+    def is_patchable(self):
+        return self.target is not None or self.out_wav_file.is_patchable()
+
+    def _close_target(self):
+        if self.target is None:
+            return
+        self.target.flush()
+        self.target.close()
+        self.target = None
+        if self.spool is not None:
+            return
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        if self.journal is None:
+            self.file.close()
+
+    def abort(self):
+        self._close_target()
+        if self.spool is not None:
+            self.spool.close()
+        if self.journal is not None:
+            self.journal.close()
+            rollback_journal(self.file.name)
+
+    def close(self):
+        self._close_target()
+        if self.journal is not None:
+            self.journal.close()
+            os.remove(self.journal_name)
+            return
+        if self.spool is not None:
+            self.spool.seek(0)
+            for data in iter(lambda: self.spool.read(
+                    COPY_CHUNK_SIZE * self.width), b''):
+                self.out_wav_file.write_data(data)
+            self.spool.close()
+        super().close()
+
+
+def rollback_journal(name):
+    # restores the original bytes of the carrier after interrupted
+    # in-place writing, entries are applied from last to first
+    journal_name = name + JOURNAL_SUFFIX
+    try:
+        with open(journal_name, 'rb') as journal:
+            data = journal.read()
+    except FileNotFoundError:
+        return False
+    entries = []
+    offset = 0
+    while offset + JOURNAL_ENTRY.size <= len(data):
+        position, size = JOURNAL_ENTRY.unpack_from(data, offset)
+        offset += JOURNAL_ENTRY.size
+        if offset + size > len(data):
+            # entry was not saved completely, the carrier is not changed
+            break
+        entries.append((position, data[offset:offset + size]))
+        offset += size
+    with open(name, 'r+b') as file:
+        for position, original in reversed(entries):
+            file.seek(position)
+            file.write(original)
+        file.flush()
+        os.fsync(file.fileno())
+    os.remove(journal_name)
+    logger.warning('in-place writing to {} was rolled back'.format(name))
+    return True
+
+
+def _init_worker():
+    # forked workers must not share the state of the noise generator
+    seed()
+
+
+def embed_range(task):
+    (in_name, in_offset, out_name, out_offset, mask, noise, lsb_count,
+     width, first_sample, count, first_bit, data) = task
+    layout = MaskLayout(mask, noise, lsb_count)
+    with open(in_name, 'rb') as in_file:
+        in_file.seek(in_offset + first_sample * width)
+        block = bytearray(in_file.read(count * width))
+    layout.embed(block, first_sample, bytes2bits(data), first_bit, width)
+    with open(out_name, 'r+b') as out_file:
+        out_file.seek(out_offset + first_sample * width)
+        out_file.write(block)
+    return len(data)
+
+
+class ParallelWriter(BulkWriter):
+    # chunks are embedded by a process pool, every worker reads its
+    # sample range from the input file and writes it to its place in the
+    # output file, out wav file must be patchable and both files named
+    def __init__(self, in_wav_file, out_wav_file, noise, mask, workers,
+                 lsb_count=1):
+        super().__init__(in_wav_file, out_wav_file, noise, mask, lsb_count)
+        self.in_name = in_wav_file.in_file.name
+        self.out_name = out_wav_file.out_file.name
+        self.in_offset = in_wav_file.pointer
+        self.out_offset = out_wav_file.start + out_wav_file.size + 1
+        self.samples_limit = ((os.path.getsize(self.in_name) -
+                               self.in_offset) // self.width)
+        self.workers = workers
+        self.futures = deque()
+        out_wav_file.out_file.flush()
+        from concurrent.futures import ProcessPoolExecutor
+        self.pool = ProcessPoolExecutor(workers, initializer=_init_worker)
+
+    def write(self, data):
+        if not data:
+            return
+        bits_count = len(data) * 8
+        last_sample = self.layout.get_sample(self.bits_count + bits_count - 1)
+        count = last_sample + 1 - self.samples_count
+        if last_sample >= self.samples_limit:
+            raise IndexError('data does not fit into wav file')
+        while len(self.futures) >= 2 * self.workers:
+            self.futures.popleft().result()
+        task = (self.in_name, self.in_offset, self.out_name,
+                self.out_offset, self.layout.mask, self.layout.noise,
+                self.layout.lsb_count, self.width, self.samples_count,
+                count, self.bits_count, bytes(data))
+        with instrumentation.stage('embed') as stage:
+            self.futures.append(self.pool.submit(embed_range, task))
+            stage.add(len(data), count)
+        self.in_wav_file.skip_block(count)
+        self.out_wav_file.skip_data(count * self.width)
+        self.bits_count += bits_count
+        self.samples_count += count
+
+    def abort(self):
+        self.pool.shutdown(cancel_futures=True)
+
+    def close(self):
+        try:
+            # time of the workers is counted while it is waited for
+            with instrumentation.stage('embed'):
+                while self.futures:
+                    self.futures.popleft().result()
+        finally:
+            self.pool.shutdown(cancel_futures=True)
+        super().close()
+
+
+def write_data_bulk(in_wav_file, out_wav_file, in_data, noise, mask,
+                    lsb_count=1):
+    # same output as write_data, but the samples covered by the data are
+    # read once and their low bytes are changed with slice assignments
+    logger.info('start bulk writing data with size = {}'.format(len(in_data)))
+    writer = BulkWriter(in_wav_file, out_wav_file, noise, mask, lsb_count)
+    writer.write(in_data)
+    writer.close()
+    logger.info('bulk writing {} bytes successfully complete'.format(
+        len(in_data)))
+
+
 def read_data(in_wav_file, data_length, mask, out_data=None):
     mask_iterator = iter(gen_mask(mask))
     for index in range(in_wav_file.count_of_read_channels % len(mask)):
@@ -104,8 +716,228 @@ def read_data(in_wav_file, data_length, mask, out_data=None):
     logger.info(format_str.format(data_length))
 
 
-def get_storage_size(in_file, mask):
+def read_data_bulk(in_wav_file, data_length, mask, out_data=None,
+                   workers=1, lsb_count=1):
+    # same result as read_data: the mask phase resumes from the count of
+    # already read channels, but the covered samples are read at once
+    layout = make_layout(mask, lsb_count=lsb_count)
+    phase = in_wav_file.count_of_read_channels % layout.period
+    logger.info('start bulk reading data with size = {}'.format(data_length))
+    final = b''
+    if data_length > 0 and is_scatter(mask):
+        values_count = data_length * 8 // lsb_count
+        try:
+            positions = layout.get_positions(
+                in_wav_file.count_of_read_channels, values_count,
+                in_wav_file.get_channels_count())
+        except IndexError:
+            raise DecodingError(
+                "Error decoding, try change mask or input password")
+        with instrumentation.stage('extract') as stage:
+            values = gather_lows(in_wav_file, positions).translate(
+                LOW_TABLES[lsb_count])
+            final = bits2bytes(unpack_bits(values, lsb_count))
+            stage.add(data_length, values_count)
+        in_wav_file.skip_block(values_count)
+    elif data_length > 0 and workers > 1:
+        reader = ParallelReader(in_wav_file, mask, workers, lsb_count)
+        try:
+            final = reader.read(data_length)
+        finally:
+            reader.close()
+    elif data_length > 0:
+        first_bit = layout.get_bits_before(phase)
+        bits_count = data_length * 8
+        last_sample = layout.get_sample(first_bit + bits_count - 1)
+        samples_count = last_sample - phase + 1
+        width = in_wav_file.get_sample_width()
+        with instrumentation.stage('extract') as stage:
+            block = in_wav_file.read_block(samples_count)
+            if len(block) < samples_count * width:
+                raise DecodingError(
+                    "Error decoding, try change mask or input password")
+            final = bits2bytes(layout.extract(
+                block, phase, first_bit, bits_count, width))
+            stage.add(data_length, samples_count)
+    if out_data is None:
+        return final
+    else:
+        with open(out_data, 'wb') as file:
+            file.write(final)
+    format_str = 'bulk reading {} bytes was successfully complete'
+    logger.info(format_str.format(data_length))
+
+
+def seek_data(in_wav_file, data_offset, mask, lsb_count=1):
+    # next read starts from byte data_offset of data written with mask
+    layout = make_layout(mask, lsb_count=lsb_count)
+    samples_count = 0
+    if data_offset > 0:
+        samples_count = layout.get_sample(data_offset * 8 - 1) + 1
+    in_wav_file.seek_block(samples_count)
+
+
+class BulkReader:
+    # successive reads from one wav file with the same mask
+    def __init__(self, in_wav_file, mask, lsb_count=1):
+        self.in_wav_file = in_wav_file
+        self.mask = mask
+        self.lsb_count = lsb_count
+
+    def read(self, size):
+        return read_data_bulk(self.in_wav_file, size, self.mask,
+                              lsb_count=self.lsb_count)
+
+    def iter_read(self, size):
+        while size > 0:
+            chunk_size = min(size, READ_CHUNK_SIZE)
+            yield self.read(chunk_size)
+            size -= chunk_size
+
+    def read_to_file(self, size, out_name, out_offset=0):
+        with open(out_name, 'r+b') as out_file:
+            out_file.seek(out_offset)
+            for chunk in self.iter_read(size):
+                with instrumentation.stage('file_write') as stage:
+                    out_file.write(chunk)
+                    stage.add(len(chunk))
+
+    def wait(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def extract_range(task):
+    (in_name, in_offset, mask, lsb_count, width, first_sample, count,
+     first_bit, size, out_name, out_offset) = task
+    with open(in_name, 'rb') as in_file:
+        in_file.seek(in_offset)
+        block = in_file.read(count * width)
+    if len(block) < count * width:
+        raise DecodingError(
+            "Error decoding, try change mask or input password")
+    data = bits2bytes(MaskLayout(mask, lsb_count=lsb_count).extract(
+        block, first_sample, first_bit, size * 8, width))
+    if out_name is None:
+        return data
+    with open(out_name, 'r+b') as out_file:
+        out_file.seek(out_offset)
+        out_file.write(data)
+    return len(data)
+
+
+def get_range_task(in_wav_file, mask, data_offset, size, out_name=None,
+                   out_offset=0, lsb_count=1):
+    # task of extract_range for size bytes from byte data_offset of data
+    # written with mask from the beginning of the data chunk
+    layout = MaskLayout(mask, lsb_count=lsb_count)
+    width = in_wav_file.get_sample_width()
+    first_bit = data_offset * 8
+    first_sample = layout.get_sample(first_bit)
+    count = layout.get_sample(first_bit + size * 8 - 1) + 1 - first_sample
+    return (in_wav_file.in_file.name,
+            in_wav_file.data_start + first_sample * width, mask, lsb_count,
+            width, first_sample, count, first_bit, size, out_name,
+            out_offset)
+
+
+class ParallelReader(BulkReader):
+    # byte ranges are extracted by a process pool, every worker reads its
+    # samples from the input file by name
+    def __init__(self, in_wav_file, mask, workers, lsb_count=1):
+        super().__init__(in_wav_file, mask, lsb_count)
+        self.layout = MaskLayout(mask, lsb_count=lsb_count)
+        self.width = in_wav_file.get_sample_width()
+        self.in_name = in_wav_file.in_file.name
+        self.in_size = os.path.getsize(self.in_name)
+        self.workers = workers
+        self.futures = deque()
+        from concurrent.futures import ProcessPoolExecutor
+        self.pool = ProcessPoolExecutor(workers)
+
+    def _get_tasks(self, size, part_size, out_name, out_offset):
+        # splits next size bytes into tasks and moves pointer after them
+        phase = self.in_wav_file.count_of_read_channels % self.layout.period
+        pointer = self.in_wav_file.pointer
+        bits_before = self.layout.get_bits_before(phase)
+        last_sample = self.layout.get_sample(bits_before + size * 8 - 1)
+        if pointer + (last_sample - phase + 1) * self.width > self.in_size:
+            raise DecodingError(
+                "Error decoding, try change mask or input password")
+        tasks = []
+        for start in range(0, size, part_size):
+            part = min(part_size, size - start)
+            first_bit = bits_before + start * 8
+            first_sample = self.layout.get_sample(first_bit)
+            count = self.layout.get_sample(first_bit + part * 8 - 1) + 1 - \
+                first_sample
+            in_offset = pointer + (first_sample - phase) * self.width
+            tasks.append((self.in_name, in_offset, self.mask,
+                          self.lsb_count, self.width, first_sample, count,
+                          first_bit, part, out_name,
+                          None if out_name is None else out_offset + start))
+        self.in_wav_file.skip_block(last_sample - phase + 1)
+        return tasks
+
+    def _get_part_size(self, size):
+        return max(1, min(READ_CHUNK_SIZE, -(-size // self.workers)))
+
+    def read(self, size):
+        if size < READ_CHUNK_SIZE:
+            return super().read(size)
+        import tempfile
+        with tempfile.NamedTemporaryFile() as out_file:
+            out_file.truncate(size)
+            out_file.flush()
+            self.read_to_file(size, out_file.name)
+            self.wait()
+            out_file.seek(0)
+            return out_file.read()
+
+    def iter_read(self, size):
+        if size <= 0:
+            return
+        futures = deque()
+        for task in self._get_tasks(size, READ_CHUNK_SIZE, None, 0):
+            futures.append(self.pool.submit(extract_range, task))
+            if len(futures) > 2 * self.workers:
+                yield futures.popleft().result()
+        while futures:
+            yield futures.popleft().result()
+
+    def read_to_file(self, size, out_name, out_offset=0):
+        # out file must exist, ranges are written by workers, call wait
+        if size <= 0:
+            return
+        with instrumentation.stage('extract') as stage:
+            tasks = self._get_tasks(
+                size, self._get_part_size(size), out_name, out_offset)
+            for task in tasks:
+                self.futures.append(self.pool.submit(extract_range, task))
+            stage.add(size, sum(task[6] for task in tasks))
+
+    def wait(self):
+        with instrumentation.stage('extract'):
+            while self.futures:
+                self.futures.popleft().result()
+
+    def close(self):
+        try:
+            self.wait()
+        finally:
+            self.pool.shutdown(cancel_futures=True)
+
+
+def get_capacity(channels_count, mask, lsb_count=1):
+    # same as get_storage_size for a file with channels_count samples
+    if is_scatter(mask):
+        return channels_count // 8 * lsb_count
     factor = sum(map(int, list(mask))) / len(mask)
+    return factor * (channels_count // 8) * factor * lsb_count
+
+
+def get_storage_size(in_file, mask, lsb_count=1):
     wav_file = WavFile(in_file)
-    file_size = wav_file.get_storage_size(mask)
-    return file_size * factor
+    return get_capacity(wav_file.get_channels_count(), mask, lsb_count)
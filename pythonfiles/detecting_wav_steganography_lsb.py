@@ -1,7 +1,145 @@
+import sys
+import time
+
+import container
 import data_steg
-import wav_file
 import steganography
-from itertools import product
+from wav_file import WavFile
+
+PLANE_SIZE = 1 << 16
+PREFIX_SIZE = 32
+TASK_SIZE = 1 << 12
+NON_PRINTABLE = bytes(set(range(256)) - set(range(32, 127)) - {9, 10, 13})
+
+plane = b''
+
+
+def get_lsb_plane(in_file, samples_count=PLANE_SIZE):
+    # one byte (0 or 1) per sample from the beginning of the data chunk
+    in_wav_file = WavFile(in_file)
+    width = in_wav_file.get_sample_width()
+    block = in_wav_file.read_block(samples_count)
+    return bytes(block[::width]).translate(data_steg.LSB_TABLE)
+
+
+def decode_plane(lsb_plane, mask, size):
+    # data of size bytes written with mask or None if plane is too short
+    layout = data_steg.MaskLayout(mask)
+    if layout.get_sample(size * 8 - 1) >= len(lsb_plane):
+        return None
+    return data_steg.bits2bytes(
+        layout.extract(lsb_plane, 0, 0, size * 8, 1))
+
+
+def get_format(data):
+    # which data of steganography module starts with these bytes
+    if container.is_container(data):
+        return 'container'
+    if data[:len(steganography.LABEL_MAGIC)] == steganography.LABEL_MAGIC:
+        return 'files'
+    if not any(data[4:27]) and data[27:29] == b'\x1f\x8b':
+        return 'compressed'
+    return None
+
+
+def get_text_score(data):
+    return len(data.translate(None, NON_PRINTABLE)) / len(data)
+
+
+def is_repeated(mask):
+    # such mask gives the same data as a shorter one
+    length = len(mask)
+    return any(length % part == 0 and mask == mask[:part] * (length // part)
+               for part in range(1, length))
+
+
+def score_mask(mask, buffer_size, text_threshold, max_attempts=1):
+    # up to max_attempts buffers of the data are checked for text, cheap
+    # check of a short prefix goes before decoding the first buffer
+    prefix = decode_plane(plane, mask, PREFIX_SIZE)
+    if prefix is None:
+        return None
+    data_format = get_format(prefix)
+    if data_format is not None:
+        return mask, data_format, 1.0
+    buffer_size = max(buffer_size, PREFIX_SIZE)
+    for attempt in range(max_attempts):
+        if attempt == 0 and get_text_score(prefix) < text_threshold:
+            continue
+        data = decode_plane(plane, mask, (attempt + 1) * buffer_size)
+        if data is None:
+            return None
+        score = get_text_score(data[attempt * buffer_size:])
+        if score >= text_threshold:
+            return mask, 'text', score
+    return None
+
+
+def _init_search(lsb_plane):
+    global plane
+    plane = lsb_plane
+
+
+def score_masks(task):
+    mask_len, start, stop, buffer_size, text_threshold, max_attempts = task
+    results = []
+    for number in range(start, stop):
+        mask = bin(number)[2:].zfill(mask_len)
+        if is_repeated(mask):
+            continue
+        result = score_mask(mask, buffer_size, text_threshold, max_attempts)
+        if result is not None:
+            results.append(result)
+    return results
+
+
+def iter_tasks(min_mask_len, max_mask_len, buffer_size, text_threshold,
+               max_attempts=1):
+    for mask_len in range(min_mask_len, max_mask_len + 1):
+        # zero mask has no ones, it is skipped
+        for start in range(1, 2 ** mask_len, TASK_SIZE):
+            stop = min(start + TASK_SIZE, 2 ** mask_len)
+            yield (mask_len, start, stop, buffer_size, text_threshold,
+                   max_attempts)
+
+
+def find_masks(in_file, min_mask_len=1, max_mask_len=16, max_seconds=None,
+               buffer_size=100, text_threshold=0.95, max_results=1,
+               workers=1, max_attempts=1):
+    # masks sorted by length, search stops after max_results masks,
+    # max_mask_len or max_seconds; a mask is skipped after max_attempts
+    # buffers of its data which are not text
+    lsb_plane = get_lsb_plane(in_file)
+    stop_time = None if max_seconds is None else time.time() + max_seconds
+    tasks = iter_tasks(min_mask_len, max_mask_len, buffer_size,
+                       text_threshold, max_attempts)
+    found = []
+    if workers <= 1:
+        _init_search(lsb_plane)
+        for task in tasks:
+            found += score_masks(task)
+            if len(found) >= max_results or \
+                    stop_time is not None and time.time() > stop_time:
+                break
+        return found[:max_results]
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(workers, initializer=_init_search,
+                             initargs=(lsb_plane,)) as pool:
+        futures = []
+        for task in tasks:
+            futures.append(pool.submit(score_masks, task))
+            if len(futures) < 2 * workers:
+                continue
+            found += futures.pop(0).result()
+            if len(found) >= max_results or \
+                    stop_time is not None and time.time() > stop_time:
+                break
+        for future in futures:
+            future.cancel()
+        for future in futures:
+            if not future.cancelled():
+                found += future.result()
+    return found[:max_results]
 
 
 def brute_force_mask(in_wav_filename,
@@ -9,44 +147,36 @@ def brute_force_mask(in_wav_filename,
                      mask_len=None,
                      buffer_size=100,
                      printing=False):
-    if mask_len is not None:
-        for row_mask in product('10', repeat=mask_len):
-            mask = ''.join(row_mask)
-            data_len = int(data_steg.get_storage_size(in_wav_filename, mask))
-            in_wav = wav_file.WavFile(in_wav_filename)
-            attempts_count = 0
-            for e in range(data_len // buffer_size):
-                data_buff = data_steg.read_data(in_wav, buffer_size, mask)
-                try:
-                    data = data_buff.decode()
-                    format_str = 'mask = {}, result buffer: {}'
-                    print(format_str.format(mask, repr(data)))
-                except UnicodeDecodeError:
-                    attempts_count += 1
-                    if attempts_count >= max_attempts_count:
-                        break
-                if printing:
-                    print(data_buff)
+    # max_attempts_count is the count of buffers of the data of every mask
+    # which fail to decode before the mask is skipped
+    min_mask_len = 1 if mask_len is None else mask_len
+    max_mask_len = 16 if mask_len is None else mask_len
+    with open(in_wav_filename, 'rb') as in_file:
+        found = find_masks(in_file, min_mask_len, max_mask_len,
+                           buffer_size=buffer_size,
+                           max_attempts=max_attempts_count)
+    if printing:
+        for mask, data_format, score in found:
+            format_str = 'mask = {}, format: {}, score: {:.2f}'
+            print(format_str.format(mask, data_format, score))
+    if not found:
         return -1
-    else:
-        mask_len = 1
-        while True:
-            mask = brute_force_mask(
-                in_wav_filename, max_attempts_count, mask_len=mask_len,
-                buffer_size=buffer_size, printing=printing)
-            if mask != -1:
-                return mask
-            else:
-                mask_len += 1
+    return found[0][0]
 
 
 def main():
-    steganography.write_files('..\\wav files\\1 0.wav',
-                              'out.wav',
-                              ['..\\text files\\test_file.txt'],
-                              False,
-                              mask='1001')
-    print('mask =', brute_force_mask('out.wav', 100, printing=False))
+    if len(sys.argv) < 2:
+        print('usage: detecting_wav_steganography_lsb.py '
+              'wav_file [max_mask_len] [max_seconds] [workers]')
+        sys.exit(0)
+    args = sys.argv[2:] + [None] * 3
+    max_mask_len = int(args[0] or 16)
+    max_seconds = None if args[1] is None else float(args[1])
+    workers = int(args[2] or 1)
+    with open(sys.argv[1], 'rb') as in_file:
+        found = find_masks(in_file, max_mask_len=max_mask_len,
+                           max_seconds=max_seconds, workers=workers)
+    print('mask =', found[0][0] if found else -1)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,152 @@
+import hashlib
+import json
+import logging
+import os
+from collections import OrderedDict
+
+import data_steg
+import steganography
+from wav_file import WavFile
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+# Json file with an entry of every carrier: its size and mtime, the
+# parsed header and the capacities and listings of the masks; masks are
+# kept as fingerprints, so masks of passwords are not written to the disk
+CACHE_VERSION = 1
+DEFAULT_MAX_SIZE = 1 << 20
+FINGERPRINT_SIZE = 16
+
+
+def initialize_index_cache(debug):
+    global logger
+    logger.disabled = not debug
+
+
+def get_fingerprint(mask, lsb_count=1, compress=False):
+    key = '{}:{}:{}'.format(mask, lsb_count, int(compress))
+    return hashlib.sha256(key.encode()).hexdigest()[:FINGERPRINT_SIZE]
+
+
+def get_header_index(in_wav_file):
+    # what is needed of the header without parsing it again
+    params = in_wav_file.params
+    return {'num_channels': params['num_channels'],
+            'sample_rate': params['sample_rate'],
+            'bits_per_sample': params['bits_per_sample'],
+            'block_align': params['block_align'],
+            'data_start': in_wav_file.data_start,
+            'data_size': params['subchunk2_size'],
+            'channels_count': in_wav_file.get_channels_count(),
+            'chunks': [[ident.decode('latin-1'), offset, size]
+                       for ident, offset, size in in_wav_file.chunks]}
+
+
+class IndexCache:
+    # entries are in order of use, the least recently used ones are
+    # evicted when the file is over max_size bytes
+    def __init__(self, path, max_size=None):
+        self.path = path
+        self.max_size = DEFAULT_MAX_SIZE if max_size is None else max_size
+        self.entries = OrderedDict()
+        self.changed = False
+        self.hits = 0
+        self.misses = 0
+        try:
+            with open(path) as cache_file:
+                data = json.load(cache_file)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as error:
+            logger.warning('cache {} was not loaded: {}'.format(path, error))
+            return
+        if data.get('version') != CACHE_VERSION:
+            logger.warning('cache {} of other version was '
+                           'dropped'.format(path))
+            return
+        self.entries.update(data['entries'])
+
+    def _get_entry(self, filename):
+        # entry of the carrier, a new one if the carrier was changed
+        key = os.path.realpath(filename)
+        stat = os.stat(key)
+        entry = self.entries.get(key)
+        if entry is not None and (entry['size'] != stat.st_size or
+                                  entry['mtime'] != stat.st_mtime_ns):
+            logger.info('carrier {} was changed'.format(key))
+            entry = None
+        if entry is None:
+            entry = {'size': stat.st_size, 'mtime': stat.st_mtime_ns,
+                     'header': None, 'capacities': {}, 'listings': {}}
+            self.entries[key] = entry
+            self.changed = True
+        if next(reversed(self.entries)) != key:
+            # the order of use is saved too, it decides the eviction
+            self.changed = True
+        self.entries.move_to_end(key)
+        return entry
+
+    def _count(self, hit):
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+            self.changed = True
+
+    def get_header(self, filename):
+        entry = self._get_entry(filename)
+        self._count(entry['header'] is not None)
+        if entry['header'] is None:
+            with open(filename, 'rb') as in_file:
+                entry['header'] = get_header_index(WavFile(in_file))
+        return entry['header']
+
+    def get_capacity(self, filename, mask='1', lsb_count=1):
+        entry = self._get_entry(filename)
+        fingerprint = get_fingerprint(mask, lsb_count)
+        capacities = entry['capacities']
+        self._count(fingerprint in capacities)
+        if fingerprint not in capacities:
+            capacities[fingerprint] = data_steg.get_capacity(
+                self.get_header(filename)['channels_count'], mask, lsb_count)
+        return capacities[fingerprint]
+
+    def get_listing(self, filename, mask='1', compress=False, lsb_count=1):
+        entry = self._get_entry(filename)
+        fingerprint = get_fingerprint(mask, lsb_count, compress)
+        listings = entry['listings']
+        self._count(fingerprint in listings)
+        if fingerprint not in listings:
+            with open(filename, 'rb') as in_file:
+                listings[fingerprint] = steganography.get_listing(
+                    in_file, mask, compress, lsb_count)
+        return [tuple(item) for item in listings[fingerprint]]
+
+    def invalidate(self, filename):
+        if self.entries.pop(os.path.realpath(filename), None) is not None:
+            self.changed = True
+
+    def _evict(self):
+        sizes = OrderedDict((key, len(json.dumps([key, entry])))
+                            for key, entry in self.entries.items())
+        total = sum(sizes.values())
+        while total > self.max_size and len(sizes) > 1:
+            key, size = sizes.popitem(last=False)
+            del self.entries[key]
+            total -= size
+            logger.info('carrier {} was evicted from cache'.format(key))
+
+    def save(self):
+        # the file is replaced at once, so readers never see a part of it
+        if not self.changed:
+            return
+        self._evict()
+        temp_name = '{}.{}.tmp'.format(self.path, os.getpid())
+        with open(temp_name, 'w') as cache_file:
+            json.dump({'version': CACHE_VERSION,
+                       'entries': list(self.entries.items())}, cache_file)
+        os.replace(temp_name, self.path)
+        self.changed = False
+        logger.info('cache {} was saved, {} hits, {} misses'.format(
+            self.path, self.hits, self.misses))
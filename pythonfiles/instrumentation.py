@@ -0,0 +1,145 @@
+import sys
+import time
+
+MB = 1 << 20
+ROW_FORMAT = '{:<14}{:>7}{:>10}{:>10}{:>12}{:>12}{:>10}'
+
+enabled = False
+callbacks = []
+stages = {}
+start_time = None
+
+
+class Stage:
+    # one run of a stage, it is recorded on exit
+    def __init__(self, name):
+        self.name = name
+        self.bytes_count = 0
+        self.samples_count = 0
+
+    def __enter__(self):
+        self.wall = time.perf_counter()
+        self.cpu = time.process_time()
+        return self
+
+    def __exit__(self, *exc_info):
+        record(self.name, time.perf_counter() - self.wall,
+               time.process_time() - self.cpu, self.bytes_count,
+               self.samples_count)
+        return False
+
+    def add(self, bytes_count=0, samples_count=0):
+        self.bytes_count += bytes_count
+        self.samples_count += samples_count
+
+
+class NullStage:
+    # stage when instrumentation is off, it does nothing
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def add(self, bytes_count=0, samples_count=0):
+        pass
+
+
+NULL_STAGE = NullStage()
+
+
+def stage(name):
+    # with stage('embed') as current: ...; current.add(bytes, samples)
+    if not enabled and not callbacks:
+        return NULL_STAGE
+    return Stage(name)
+
+
+def record(name, wall, cpu, bytes_count=0, samples_count=0):
+    current = {'wall_seconds': wall, 'cpu_seconds': cpu,
+               'bytes': bytes_count, 'samples': samples_count}
+    if not enabled:
+        # totals are kept only while instrumentation is on
+        total = dict(current, calls=1)
+    else:
+        total = stages.setdefault(name, {'calls': 0, 'wall_seconds': 0.0,
+                                         'cpu_seconds': 0.0, 'bytes': 0,
+                                         'samples': 0})
+        total['calls'] += 1
+        for key, value in current.items():
+            total[key] += value
+    for callback in callbacks:
+        callback(name, current, total)
+
+
+def enable(callback=None):
+    # callback(stage name, this run, totals of the stage) is called after
+    # every run of a stage, so it can report progress
+    global enabled, start_time
+    enabled = True
+    if start_time is None:
+        start_time = time.perf_counter()
+    if callback is not None:
+        callbacks.append(callback)
+
+
+def add_callback(callback):
+    # stages are measured while there are callbacks, even if
+    # instrumentation is off
+    callbacks.append(callback)
+
+
+def remove_callback(callback):
+    if callback in callbacks:
+        callbacks.remove(callback)
+
+
+def disable():
+    global enabled
+    enabled = False
+    callbacks.clear()
+
+
+def reset():
+    global start_time
+    stages.clear()
+    start_time = time.perf_counter() if enabled else None
+
+
+def get_report():
+    # totals of every stage of this process, workers are not counted
+    report = {}
+    for name, total in stages.items():
+        report[name] = dict(total)
+        wall = total['wall_seconds']
+        report[name]['mb_per_second'] = \
+            total['bytes'] / MB / wall if wall else None
+    wall = time.perf_counter() - start_time if start_time is not None \
+        else 0.0
+    return {'wall_seconds': wall, 'stages': report}
+
+
+def format_report(report):
+    lines = [ROW_FORMAT.format('stage', 'calls', 'wall, s', 'cpu, s', 'MB',
+                               'samples', 'MB/s')]
+    for name, total in sorted(report['stages'].items()):
+        speed = total['mb_per_second']
+        lines.append(ROW_FORMAT.format(
+            name, total['calls'], '{:.3f}'.format(total['wall_seconds']),
+            '{:.3f}'.format(total['cpu_seconds']),
+            '{:.3f}'.format(total['bytes'] / MB), total['samples'],
+            '-' if speed is None else '{:.2f}'.format(speed)))
+    lines.append('total wall time {:.3f} s'.format(report['wall_seconds']))
+    return '\n'.join(lines)
+
+
+def write_report(path=None):
+    # json report to the file or table to stderr without path
+    report = get_report()
+    if path is None:
+        print(format_report(report), file=sys.stderr)
+        return report
+    import json
+    with open(path, 'w') as report_file:
+        json.dump(report, report_file, indent=4)
+    return report
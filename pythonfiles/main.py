@@ -1,82 +1,219 @@
+import logging
 import os
 import sys
-import hashlib
 import parse_arguments
 import steganography
-import data_steg
 import wav_file
 from steganography_exceptions import DecodingError, WavFileError,\
     TooLargeDataError
 
+LOG_FILENAME = 'stegano_logs.log'
+LOG_FORMAT = '%(name)s %(levelname)s %(asctime)s %(message)s'
+
+
+def configure_logging(loggingon):
+    # the log file is opened only when logging is on
+    if not loggingon:
+        return
+    handler = logging.FileHandler(LOG_FILENAME)
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    root_logger = logging.getLogger()
+    root_logger.setLevel(logging.DEBUG)
+    root_logger.addHandler(handler)
+
+
+def initialize_loggers(names, loggingon):
+    # modules which are imported only when they are used get the same
+    # loggers by their names later
+    for name in names:
+        logging.getLogger(name).disabled = not loggingon
+
 
 def process_password(password):
+    import hashlib
     hash_tool = hashlib.md5()
     hash_tool.update(password.encode())
     hash_bytes = hash_tool.digest()[-8:]
     return ''.join(map(lambda x: bin(x)[2:].zfill(8), hash_bytes))
 
 
-def process_storage(storage, in_filename, mask):
-    if storage:
+def process_scatter_password(password):
+    # key of pseudo-random positions over the whole data chunk
+    import hashlib
+    import data_steg
+    return data_steg.SCATTER_PREFIX + \
+        hashlib.sha256(password.encode()).hexdigest()
+
+
+def process_storage(storage, in_filenames, mask, lsb_count, cache=None):
+    if storage and len(in_filenames) > 1:
+        import striping
+        print(striping.get_striped_storage_size(in_filenames, mask,
+                                                lsb_count))
+    elif storage and cache is not None:
+        print(cache.get_capacity(in_filenames[0], mask, lsb_count))
+    elif storage:
+        in_filename = in_filenames[0]
         with open(in_filename, 'rb') as in_file:
-            print(steganography.get_storage_size(in_file, mask))
+            print(steganography.get_storage_size(in_file, mask, lsb_count))
 
 
-def process_listing(listing, in_filename, mask, compress):
-    if listing:
+def process_listing(listing, in_filenames, mask, compress, lsb_count,
+                    cache=None):
+    if listing and len(in_filenames) > 1:
+        import striping
+        print(striping.get_striped_listing(in_filenames, mask, lsb_count))
+    elif listing and cache is not None:
+        print(cache.get_listing(in_filenames[0], mask, compress, lsb_count))
+    elif listing:
+        in_filename = in_filenames[0]
         with open(in_filename, 'rb') as in_file:
-            print(steganography.get_listing(in_file, mask, compress=compress))
+            print(steganography.get_listing(in_file, mask, compress=compress,
+                                            lsb_count=lsb_count))
 
 
-def writing_files(files, in_filename,
-                  out_filename, noise, mask, compress, nowarnings):
-    if files is not None:
-        old_out_filename = ''
-        if (in_filename == out_filename) and not nowarnings:
+def writing_striped_files(files, in_filenames, out_filename, noise, mask,
+                          workers, lsb_count):
+    # stripes of all carriers are written at the same time
+    import striping
+    out_filenames = [out_filename.format(n=index)
+                     for index in range(len(in_filenames))]
+    if len(set(out_filenames)) < len(out_filenames):
+        print('Sorry, but output filename must contain {n} '
+              'for several input files')
+        sys.exit(2)
+    striping.write_striped(in_filenames, out_filenames, files, noise, mask,
+                           lsb_count,
+                           workers=max(workers, len(in_filenames)))
+
+
+def writing_files(files, in_filenames, out_filename, noise, mask, compress,
+                  nowarnings, workers, lsb_count, codec, speed):
+    if files is not None and len(in_filenames) > 1:
+        writing_striped_files(files, in_filenames, out_filename, noise, mask,
+                              workers, lsb_count)
+    elif files is not None:
+        in_filename = in_filenames[0]
+        same_io = os.path.exists(out_filename) and \
+            os.path.samefile(in_filename, out_filename)
+        if same_io and not nowarnings:
             print("Input and output files are same. "
                   "Do you want to continue? [y/n]")
             if input() != 'y':
                 sys.exit(0)
-        same_io = in_filename == out_filename
+        file_list = map(lambda x: open(x, 'rb'), files)
         if same_io:
-            old_out_filename = out_filename
-            out_filename = 'tmp.wav'
+            # only samples covered by the files are rewritten in place
+            with open(in_filename, 'r+b') as file:
+                steganography.write_files_in_place(
+                    file, file_list, noise, mask, compress=compress,
+                    lsb_count=lsb_count, codec=codec, speed=speed)
+            return
         try:
             os.remove(out_filename)
         except FileNotFoundError:
             pass
-        file_list = map(lambda x: open(x, 'rb'), files)
-        with open(in_filename, 'rb') as in_file, \
-                open(out_filename, 'ab') as out_file:
-            steganography.write_files(
-                in_file, out_file, file_list,
-                noise, mask, compress=compress)
-        if same_io:
-            os.rename('tmp.wav', old_out_filename)
+        try:
+            with open(in_filename, 'rb') as in_file, \
+                    open(out_filename, 'wb') as out_file:
+                steganography.write_files(
+                    in_file, out_file, file_list,
+                    noise, mask, compress=compress, workers=workers,
+                    lsb_count=lsb_count, codec=codec, speed=speed)
+        except BaseException:
+            # compressed data is found too large only while it is written,
+            # a part of the output is not left behind
+            os.remove(out_filename)
+            raise
+
+
+def process_batch(manifest, workers, report, loggingon):
+    import json
+    with open(manifest) as manifest_file:
+        jobs = json.load(manifest_file)
+    for job in jobs:
+        if 'password' in job and job.pop('scatter', False):
+            job['mask'] = process_scatter_password(job.pop('password'))
+        elif 'password' in job:
+            job['mask'] = process_password(job.pop('password'))
+    results = steganography.run_batch(jobs, workers, loggingon)
+    for result in results:
+        print('{} {:.3f}s {}'.format(result['input'], result['seconds'],
+                                     result['error'] or 'ok'))
+    if report is not None:
+        with open(report, 'w') as report_file:
+            json.dump(results, report_file, indent=4)
+    if any(result['error'] for result in results):
+        sys.exit(1)
 
 
-def reading_files(reading, in_filename, outdir, mask, compress):
-    if reading:
+def reading_files(reading, in_filenames, outdir, mask, compress, workers,
+                  extract, lsb_count):
+    if reading and len(in_filenames) > 1:
+        import striping
+        try:
+            striping.read_striped(in_filenames, outdir, mask,
+                                  max(workers, len(in_filenames)), lsb_count)
+        except DecodingError:
+            print("Parsing error, try change mask or input files")
+            sys.exit(0)
+    elif reading:
+        in_filename = in_filenames[0]
         try:
             with open(in_filename, 'rb') as in_file:
-                steganography.read_files(
-                    in_file, outdir, mask, compress=compress)
+                if extract is not None:
+                    steganography.extract_file(
+                        in_file, extract, mask, outdir, compress=compress,
+                        lsb_count=lsb_count)
+                else:
+                    steganography.read_files(
+                        in_file, outdir, mask, compress=compress,
+                        workers=workers, lsb_count=lsb_count)
+        except KeyError:
+            print('Sorry, but file {} doesn\'t exist '
+                  'in input wav file'.format(extract))
+            sys.exit(2)
         except DecodingError:
             print("Parsing error, try change mask or compression")
             sys.exit(0)
 
 
+def process_profile(profile, profile_file):
+    if profile or profile_file is not None:
+        import instrumentation
+        instrumentation.write_report(profile_file)
+
+
 def main():
     out_filename = None
     nowarnings = None
     noise = None
+    codec = None
+    speed = None
+    workers = 1
     parser = parse_arguments.get_parser()
     if len(sys.argv) == 1:
         parser.print_help()
         sys.exit(0)
     args = vars(parser.parse_args(sys.argv[1:]))
     # return
-    in_filename = args['input']
+    in_filenames = args['input']
+    if args['profile'] or args['profile_file'] is not None:
+        import instrumentation
+        instrumentation.enable()
+    configure_logging(args['loggingon'])
+    if 'manifest' in args:
+        steganography.initialize_steganography(args['loggingon'])
+        wav_file.initialize_wav_file(args['loggingon'])
+        initialize_loggers(['data_steg', 'container'], args['loggingon'])
+        try:
+            process_batch(args['manifest'], args['workers'], args['report'],
+                          args['loggingon'])
+        finally:
+            process_profile(args['profile'], args['profile_file'])
+        sys.exit(0)
+    if in_filenames is None:
+        parser.error('the following arguments are required: -i')
 
     compress = args['compress']
     password = args['password']
@@ -84,6 +221,7 @@ def main():
     listing = args['listing']
     loggingon = args['loggingon']
     mask = args['mask']
+    lsb_count = args['lsb_count']
     if 'files' in args:
         files = args['files']
     else:
@@ -98,6 +236,8 @@ def main():
         nowarnings = args['nowarnings']
         out_filename = args['output']
         noise = args['noise']
+        codec = args['codec']
+        speed = args['speed']
     else:
         files = None
     outdir = args['outdir']
@@ -107,20 +247,43 @@ def main():
 
     if 'read' in args:
         reading = args['read']
+        extract = args['extract']
     else:
         reading = False
+        extract = None
+    if len(in_filenames) > 1 and (compress or extract is not None):
+        print('Sorry, but striped files are written and read '
+              'without compression and only all together')
+        sys.exit(2)
+
+    if 'workers' in args:
+        workers = args['workers']
 
     steganography.initialize_steganography(loggingon)
     wav_file.initialize_wav_file(loggingon)
-    data_steg.initialize_data_steg(loggingon)
-    if password is not None:
+    initialize_loggers(['data_steg', 'container', 'striping'], loggingon)
+    if password is not None and args['scatter']:
+        mask = process_scatter_password(password)
+    elif password is not None:
         mask = process_password(password)
+    elif args['scatter']:
+        parser.error('scattering requires a password (-p)')
+    if noise and args['scatter']:
+        parser.error('noise (-n) is not supported with scattering (-x)')
+    cache = None
+    if args['cache'] is not None:
+        # json and hashlib of the cache are not needed without it
+        import index_cache
+        index_cache.initialize_index_cache(loggingon)
+        cache = index_cache.IndexCache(args['cache'], args['cache_size'])
     try:
-        process_storage(storage, in_filename, mask)
-        process_listing(listing, in_filename, mask, compress)
-        writing_files(files, in_filename, out_filename,
-                      noise, mask, compress, nowarnings)
-        reading_files(reading, in_filename, outdir, mask, compress)
+        process_storage(storage, in_filenames, mask, lsb_count, cache)
+        process_listing(listing, in_filenames, mask, compress, lsb_count,
+                        cache)
+        writing_files(files, in_filenames, out_filename, noise, mask,
+                      compress, nowarnings, workers, lsb_count, codec, speed)
+        reading_files(reading, in_filenames, outdir, mask, compress, workers,
+                      extract, lsb_count)
 
     except WavFileError:
         print("Unsupported file format")
@@ -130,6 +293,10 @@ def main():
     except DecodingError:
         print("Decodin error, try change mask or password")
         sys.exit(2)
+    finally:
+        if cache is not None:
+            cache.save()
+        process_profile(args['profile'], args['profile_file'])
 
 if __name__ == '__main__':
     main()
@@ -1,12 +1,15 @@
 import argparse
+import container
 
 
 def get_parser():
     parser = argparse.ArgumentParser(description='Wav steganography')
 
-    parser.add_argument('-i', action='store',
-                        dest='input', required=True,
-                        help='input wav filename')
+    parser.add_argument('-i', action='append',
+                        dest='input', default=None,
+                        help='input wav filename, required '
+                             'for all commands except batch, several '
+                             'carriers of striped files can be given')
 
     parser.add_argument('-c', action='store_true', dest='compress',
                         help='write/read information with compressing')
@@ -21,13 +24,16 @@ def get_parser():
     subparsers = parser.add_subparsers(help="sub-command help")
     parser_write = subparsers.add_parser("write", help='write files')
     parser_read = subparsers.add_parser("read", help='read files')
+    parser_batch = subparsers.add_parser(
+        "batch", help='write or read files by jobs from manifest')
 
     parser_write.add_argument('-f', action='store',
                         dest='files', required=True,
                         help='list of comma-separated files for writing')
     parser_write.add_argument('-o', action='store',
                         dest='output', default='out.wav',
-                        help='output wav filename')
+                        help='output wav filename, for several input '
+                             'files {n} is replaced by number of the file')
 
     parser_write.add_argument('-w', action='store_true',
                         help='no warnings with same input/output files',
@@ -40,6 +46,31 @@ def get_parser():
     parser_read.add_argument('-r', action='store_true', dest='read',
                         help='reading files from '
                              'input wav to output directory', default=True)
+    parser_read.add_argument('-j', action='store', dest='workers',
+                        type=int, default=1,
+                        help='count of processes for reading files')
+    parser_read.add_argument('-e', action='store', dest='extract',
+                        default=None,
+                        help='name of the only file to extract')
+
+    parser_batch.add_argument('-f', action='store',
+                        dest='manifest', required=True,
+                        help='json manifest: list of jobs with input, '
+                             'files and output for writing or input and '
+                             'outdir for reading, optional mask, password, '
+                             'scatter, lsb_count, checksums, codec, speed, '
+                             'noise and compress, jobs run in any order')
+    parser_batch.add_argument('-j', action='store', dest='workers',
+                        type=int, default=1,
+                        help='count of jobs running at the same time')
+    parser_batch.add_argument('-r', action='store', dest='report',
+                        default=None,
+                        help='json file for timing and errors of jobs')
+
+    parser.add_argument('-k', action='store', dest='lsb_count', type=int,
+                        choices=[1, 2, 4, 8], default=1,
+                        help='count of low bits of every sample of the mask'
+                             ' for writing or reading files')
 
     passw_and_mask = parser.add_mutually_exclusive_group()
 
@@ -53,6 +84,37 @@ def get_parser():
                                 default=None)
     parser_write.add_argument('-n', action='store_true', dest='noise',
                         help='add noises instead of zeros in mask')
+    parser_write.add_argument('-j', action='store', dest='workers',
+                        type=int, default=1,
+                        help='count of processes for writing files')
+    parser_write.add_argument('-z', action='store', dest='codec',
+                        choices=container.get_codec_names() +
+                        [container.AUTO_CODEC],
+                        default=container.DEFAULT_CODEC,
+                        help='codec for writing with compressing, auto '
+                             'chooses it by a sample of the files')
+    parser_write.add_argument('-b', action='store', dest='speed',
+                        type=float, default=container.AUTO_SPEED,
+                        help='minimal speed of the codec chosen by auto, '
+                             'MiB/s')
+    parser.add_argument('-x', action='store_true', dest='scatter',
+                        help='scatter data over the whole wav file by '
+                             'positions derived from the password, '
+                             'without noise')
+    parser.add_argument('--profile', action='store_true', dest='profile',
+                        help='print time, bytes and samples of every stage')
+    parser.add_argument('--profile-file', action='store',
+                        dest='profile_file', default=None,
+                        help='json file for time, bytes and samples of '
+                             'every stage instead of printing them')
+    parser.add_argument('--cache', action='store', dest='cache',
+                        default=None,
+                        help='json file of cached headers, storage sizes '
+                             'and lists of files of input wav files')
+    parser.add_argument('--cache-size', action='store', dest='cache_size',
+                        type=int, default=None,
+                        help='max size of the cache file, bytes, '
+                             '1 MiB by default')
     parser.add_argument('-l', action='store_true',
                         help='logging on', dest='loggingon')
     return parser
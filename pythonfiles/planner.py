@@ -0,0 +1,159 @@
+import logging
+import os
+import shutil
+
+import data_steg
+import steganography
+from wav_file import WavFile
+from steganography_exceptions import TooLargeDataError, WavFileError
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+CARRIER_SUFFIX = '.wav'
+PART_FORMAT = '{}.part{}'
+
+
+def get_entry_size(name, size):
+    # bytes taken by the file in the index of the label and by its data
+    name = name.encode()
+    return len(steganography.encode_varint(len(name))) + len(name) + \
+        len(steganography.encode_varint(size)) + size
+
+
+def get_label_size(count):
+    # label without entries of the files
+    return steganography.LABEL_HEADER.size + \
+        len(steganography.encode_varint(count))
+
+
+class Carrier:
+    def __init__(self, path, capacity):
+        self.path = path
+        self.capacity = capacity
+        self.files = []
+        self.used = 0
+
+    def get_free(self, name):
+        # max size of one more file with the name, may be negative
+        free = int(self.capacity) - self.used - \
+            get_label_size(len(self.files) + 1) - get_entry_size(name, 0)
+        # size 0 takes one byte of varint already
+        return free - len(steganography.encode_varint(max(free, 0))) + 1
+
+    def add(self, file, name, size):
+        self.files.append(file)
+        self.used += get_entry_size(name, size)
+
+
+class CarrierPool:
+    # wav files of the directory are parsed once, capacities are cached
+    # for every mask and count of lsbs
+    def __init__(self, directory):
+        self.directory = directory
+        self.channels = {}
+        self.capacities = {}
+        for name in sorted(os.listdir(directory)):
+            path = os.path.join(directory, name)
+            if not name.lower().endswith(CARRIER_SUFFIX) or \
+                    not os.path.isfile(path):
+                continue
+            try:
+                with open(path, 'rb') as file:
+                    self.channels[path] = WavFile(file).get_channels_count()
+            except (WavFileError, OSError) as error:
+                logger.warning('carrier {} was skipped: {}'.format(path,
+                                                                   error))
+        logger.info('{} carriers were found in {}'.format(len(self.channels),
+                                                          directory))
+
+    def get_paths(self):
+        return list(self.channels)
+
+    def get_capacity(self, path, mask='1', lsb_count=1):
+        key = (path, mask, lsb_count)
+        if key not in self.capacities:
+            self.capacities[key] = data_steg.get_capacity(
+                self.channels[path], mask, lsb_count)
+        return self.capacities[key]
+
+    def get_total_capacity(self, mask='1', lsb_count=1):
+        return sum(self.get_capacity(path, mask, lsb_count)
+                   for path in self.channels)
+
+    def make_plan(self, files, out_dir, mask='1', lsb_count=1, noise=False):
+        # files: names of the payloads; the biggest go first, every one
+        # to the carrier it fills best or in parts to the freest ones
+        carriers = [Carrier(path, self.get_capacity(path, mask, lsb_count))
+                    for path in self.channels]
+        payloads = sorted(((os.path.getsize(path), path) for path in files),
+                          reverse=True)
+        parts = {}
+        for size, path in payloads:
+            name = os.path.basename(path)
+            fitting = [carrier for carrier in carriers
+                       if carrier.get_free(name) >= size]
+            if fitting:
+                carrier = min(fitting, key=lambda x: x.get_free(name))
+                carrier.add(path, name, size)
+                continue
+            parts[name] = _split_file(carriers, path, name, size)
+        jobs = [{'input': carrier.path,
+                 'output': os.path.join(out_dir,
+                                        os.path.basename(carrier.path)),
+                 'files': carrier.files, 'mask': mask,
+                 'lsb_count': lsb_count, 'noise': noise}
+                for carrier in carriers if carrier.files]
+        logger.info('plan of {} files to {} carriers was successfully '
+                    'created'.format(len(payloads), len(jobs)))
+        return {'jobs': jobs, 'parts': parts}
+
+
+def _split_file(carriers, path, name, size):
+    # names of the parts in order of the file
+    names = []
+    offset = 0
+    for carrier in sorted(carriers, key=lambda x: x.get_free(name),
+                          reverse=True):
+        if offset == size:
+            break
+        part_name = PART_FORMAT.format(name, len(names))
+        part_size = min(carrier.get_free(part_name), size - offset)
+        if part_size <= 0:
+            continue
+        carrier.add({'path': path, 'offset': offset, 'size': part_size,
+                     'name': part_name}, part_name, part_size)
+        names.append(part_name)
+        offset += part_size
+    if offset < size:
+        logger.error('size of file {} more than size of '
+                     'carriers'.format(path))
+        raise TooLargeDataError("Too large data")
+    return names
+
+
+def execute_plan(plan, workers=1, debug=False):
+    # results of steganography.run_batch for the jobs of the plan
+    return steganography.run_batch(plan['jobs'], workers, debug)
+
+
+def read_plan(plan, out_dir, workers=1, debug=False):
+    # files of the written carriers of the plan, parts are joined
+    jobs = [{'input': job['output'], 'outdir': out_dir,
+             'mask': job['mask'], 'lsb_count': job['lsb_count']}
+            for job in plan['jobs']]
+    results = steganography.run_batch(jobs, workers, debug)
+    if not any(result['error'] for result in results):
+        join_parts(plan['parts'], out_dir)
+    return results
+
+
+def join_parts(parts, directory):
+    for name, part_names in parts.items():
+        with open(os.path.join(directory, name), 'wb') as file:
+            for part_name in part_names:
+                part_path = os.path.join(directory, part_name)
+                with open(part_path, 'rb') as part:
+                    shutil.copyfileobj(part, file)
+                os.remove(part_path)
+    logger.info('parts of {} files were joined'.format(len(parts)))
@@ -0,0 +1,194 @@
+import json
+import logging
+import math
+import operator
+import sys
+from collections import Counter
+from itertools import repeat
+
+from wav_file import WavFile, FLOAT_FORMAT
+from steganography_exceptions import WavFileError
+
+WINDOW_SECONDS = 1.0
+MIN_PAIR_COUNT = 10
+# formats of memoryview for signed samples of 2, 4 and 8 bytes
+VALUE_FORMATS = {2: 'h', 4: 'i', 8: 'q'}
+SIGN_TABLE = bytes(0xff if x >= 0x80 else 0 for x in range(256))
+NOT_TABLE = bytes.maketrans(b'\x00\x01', b'\x01\x00')
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+def get_values(block, width):
+    # samples of the block as a memoryview of signed ints
+    if width == 1:
+        return memoryview(bytes(block))
+    if width == 3:
+        data = bytes(block)
+        wide = bytearray(len(data) // 3 * 4)
+        for index in range(3):
+            wide[index::4] = data[index::3]
+        wide[3::4] = data[2::3].translate(SIGN_TABLE)
+        return memoryview(wide).cast('i')
+    return memoryview(bytes(block)).cast(VALUE_FORMATS[width])
+
+
+def count_ones(data):
+    return data.count(1)
+
+
+def count_both(first, second):
+    # count of places where both 0/1 byte strings have 1
+    both = int.from_bytes(first, 'little') & int.from_bytes(second, 'little')
+    return bin(both).count('1')
+
+
+def get_chi_square(values):
+    # pair of values test: embedding makes counts of 2k and 2k+1 equal
+    histogram = Counter(values)
+    statistic = 0.0
+    pairs_count = 0
+    for value, count in histogram.items():
+        if value & 1:
+            continue
+        pair_count = count + histogram.get(value + 1, 0)
+        if pair_count < MIN_PAIR_COUNT:
+            continue
+        expected = pair_count / 2
+        statistic += (count - expected) ** 2 / expected
+        pairs_count += 1
+    return statistic, pairs_count - 1
+
+
+def get_chi_square_p(statistic, freedom):
+    # probability of embedding: upper tail of chi-square distribution,
+    # Wilson-Hilferty normal approximation
+    if freedom < 1:
+        return 0.0
+    scale = 2 / (9 * freedom)
+    normal = ((statistic / freedom) ** (1 / 3) - 1 + scale) / \
+        math.sqrt(scale)
+    return 0.5 * math.erfc(normal / math.sqrt(2))
+
+
+def get_pair_counts(values):
+    # counts X, Y, Z, W and P of sample pair analysis for adjacent samples
+    first, second = values[:-1], values[1:]
+    greater = bytes(map(operator.gt, first, second))
+    less = bytes(map(operator.lt, first, second))
+    difference = list(map(operator.sub, first, second))
+    odd = bytes(map(operator.and_, second, repeat(1)))
+    even = odd.translate(NOT_TABLE)
+    up = bytes(map(operator.eq, difference, repeat(1)))
+    down = bytes(map(operator.eq, difference, repeat(-1)))
+    x = count_both(less, even) + count_both(greater, odd)
+    y = count_both(greater, even) + count_both(less, odd)
+    w = count_both(up, even) + count_both(down, odd)
+    p = len(difference)
+    z = p - count_ones(greater) - count_ones(less)
+    return [x, y, z, w, p]
+
+
+def get_embedding_rate(counts):
+    # smaller root of (W + Z) / 2 * r^2 + (2X - P) * r + Y - X = 0
+    x, y, z, w, p = counts
+    a = (w + z) / 2
+    b = 2 * x - p
+    c = y - x
+    if a == 0:
+        rate = -c / b if b else 0.0
+    else:
+        discriminant = b * b - 4 * a * c
+        if discriminant < 0:
+            return 1.0
+        rate = (-b - math.sqrt(discriminant)) / (2 * a)
+    return min(max(rate, 0.0), 1.0)
+
+
+def analyze_block(block, width, num_channels):
+    values = get_values(block, width)
+    counts = [0] * 5
+    statistic = 0.0
+    freedom = 0
+    for channel in range(num_channels):
+        channel_values = values[channel::num_channels]
+        if len(channel_values) < 2:
+            continue
+        counts = list(map(operator.add, counts,
+                          get_pair_counts(channel_values)))
+        channel_statistic, channel_freedom = get_chi_square(channel_values)
+        statistic += channel_statistic
+        freedom += max(channel_freedom, 0)
+    return {'chi_square_p': get_chi_square_p(statistic, freedom),
+            'rate': get_embedding_rate(counts)}
+
+
+def iter_windows(in_wav_file, window, hop):
+    # blocks of window frames every hop frames, last may be shorter
+    num_channels = in_wav_file.params['num_channels']
+    samples_count = in_wav_file.get_channels_count()
+    start = 0
+    while start < samples_count // num_channels:
+        in_wav_file.seek_block(start * num_channels)
+        count = min(window, samples_count // num_channels - start)
+        yield start, in_wav_file.read_block(count * num_channels)
+        start += hop
+
+
+def analyze(in_file, window_seconds=WINDOW_SECONDS, hop_seconds=None):
+    # suspicion score of the file and estimates for every window
+    in_wav_file = WavFile(in_file, use_mmap=True)
+    params = in_wav_file.params
+    width = in_wav_file.get_sample_width()
+    # the tests model lsbs of integer samples, not of float mantissas
+    if params['audio_format'] == FLOAT_FORMAT or \
+            width not in VALUE_FORMATS and width not in (1, 3):
+        in_wav_file.unmap()
+        logger.error('samples of the file are not supported')
+        raise WavFileError("steganalysis supports only integer samples of "
+                           "1, 2, 3, 4 or 8 bytes")
+    sample_rate = params['sample_rate']
+    window = max(2, int(window_seconds * sample_rate))
+    hop = window if hop_seconds is None else \
+        max(1, int(hop_seconds * sample_rate))
+    windows = [dict(analyze_block(block, width, params['num_channels']),
+                    start=start / sample_rate)
+               for start, block in iter_windows(in_wav_file, window, hop)]
+    in_wav_file.unmap()
+    rates = [result['rate'] for result in windows]
+    report = {'score': max(rates, default=0.0),
+              'mean_rate': sum(rates) / len(rates) if rates else 0.0,
+              'windows': windows}
+    logger.info('steganalysis was successfully completed')
+    return report
+
+
+def analyze_filename(filename, window_seconds=WINDOW_SECONDS,
+                     hop_seconds=None):
+    with open(filename, 'rb') as in_file:
+        report = analyze(in_file, window_seconds, hop_seconds)
+    report['file'] = filename
+    return report
+
+
+def analyze_files(filenames, window_seconds=WINDOW_SECONDS,
+                  hop_seconds=None, workers=1):
+    arguments = (filenames, repeat(window_seconds), repeat(hop_seconds))
+    if workers <= 1:
+        return list(map(analyze_filename, *arguments))
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(workers) as pool:
+        return list(pool.map(analyze_filename, *arguments))
+
+
+def main():
+    if len(sys.argv) < 2:
+        print('usage: steganalysis.py wav_file [wav_file ...]')
+        sys.exit(0)
+    reports = analyze_files(sys.argv[1:])
+    json.dump(reports, sys.stdout, indent=4)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,19 +1,33 @@
+import io
 import logging
 import os
-import gzip
-import data_steg
-import pickle
+import itertools
+import struct
+import time
+import zlib
+from functools import partial
+import instrumentation
+import wav_file
 from wav_file import WavFile
 from steganography_exceptions import DecodingError, TooLargeDataError
 
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.DEBUG)
-fileHandler = logging.FileHandler('stegano_logs.log')
-fileHandler.setLevel(logging.DEBUG)
-format_string = '%(name)s %(levelname)s %(asctime)s %(message)s'
-formatter = logging.Formatter(format_string)
-fileHandler.setFormatter(formatter)
-logger.addHandler(fileHandler)
+logger.addHandler(logging.NullHandler())
+
+CHUNK_SIZE = 1 << 20
+SPOOL_SIZE = 16 << 20
+SIZE_LENGTH = 27
+GZIP_WBITS = 31
+
+# Label: header with magic, version, flags and size of the index, then
+# the index: count of files and for every file size of its name, name in
+# utf-8, size of the file and crc32 of the file with CHECKSUMS_FLAG;
+# counts and sizes are varints
+LABEL_MAGIC = b'SWL'
+LABEL_VERSION = 1
+LABEL_HEADER = struct.Struct('<3sBBI')
+CHECKSUM = struct.Struct('<I')
+CHECKSUMS_FLAG = 1
 
 
 def initialize_steganography(debug):
@@ -21,17 +35,95 @@ def initialize_steganography(debug):
     logger.disabled = not debug
 
 
-def get_storage_size(in_file, mask='1'):
-    size = data_steg.get_storage_size(in_file, mask)
+def get_storage_size(in_file, mask='1', lsb_count=1):
+    import data_steg
+    size = data_steg.get_storage_size(in_file, mask, lsb_count)
     in_file.seek(0)
     return size
 
 
+def encode_varint(number):
+    data = bytearray()
+    while number > 0x7f:
+        data.append(number & 0x7f | 0x80)
+        number >>= 7
+    data.append(number)
+    return bytes(data)
+
+
+def decode_varint(data, offset):
+    # number and offset after it
+    number = 0
+    shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        number |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return number, offset
+        shift += 7
+
+
+def get_checksum(file):
+    # crc32 of the rest of the file, position of the file is kept
+    position = file.tell()
+    checksum = 0
+    for chunk in iter(lambda: file.read(CHUNK_SIZE), b''):
+        checksum = zlib.crc32(chunk, checksum)
+    file.seek(position)
+    return checksum
+
+
+class FilePart:
+    # size bytes of the file at path from offset, embedded as a file
+    # with its own name
+    def __init__(self, path, offset, size, name):
+        self.name = name
+        self.offset = offset
+        self.size = size
+        self.file = open(path, 'rb')
+        self.file.seek(offset)
+
+    def read(self, size=-1):
+        left = self.offset + self.size - self.file.tell()
+        if size < 0 or size > left:
+            size = left
+        return self.file.read(size)
+
+    def tell(self):
+        return self.file.tell() - self.offset
+
+    def seek(self, position):
+        self.file.seek(self.offset + position)
+
+    def close(self):
+        self.file.close()
+
+
+def get_file_size(file):
+    if isinstance(file, FilePart):
+        return file.size
+    return os.path.getsize(file.name)
+
+
+def make_label(file_list, checksums=False):
+    with instrumentation.stage('label_build') as stage:
+        index = [encode_varint(len(file_list))]
+        for file in file_list:
+            name = os.path.basename(file.name).encode()
+            index += [encode_varint(len(name)), name,
+                      encode_varint(get_file_size(file))]
+            if checksums:
+                index.append(CHECKSUM.pack(get_checksum(file)))
+        index = b''.join(index)
+        flags = CHECKSUMS_FLAG if checksums else 0
+        stage.add(LABEL_HEADER.size + len(index))
+        return LABEL_HEADER.pack(LABEL_MAGIC, LABEL_VERSION, flags,
+                                 len(index)) + index
+
+
 def make_mark(file_list):
-    label = list(map(lambda x: (os.path.basename(x.name),
-                                os.path.getsize(x.name)), file_list))
-    mark = len(pickle.dumps(label)).to_bytes(1, 'little')
-    mark += pickle.dumps(label)
+    mark = make_label(file_list)
     logger.info('mark was successfully created')
     return mark
 
@@ -42,16 +134,121 @@ def read_size(data):
     return size
 
 
-def read_label(data):
+def read_label_header(data):
+    # size of the index after the header
+    magic, version, flags, size = LABEL_HEADER.unpack(data)
+    if magic != LABEL_MAGIC or version != LABEL_VERSION:
+        raise DecodingError(
+            "Error decoding, try change mask or input password")
+    return size
+
+
+def _check_names(label):
+    if any(os.path.basename(name) != name or name in ('', '.', '..')
+           for name, size in label):
+        raise DecodingError(
+            "Error decoding, try change mask or input password")
+
+
+def read_legacy_label(data):
+    # label of the format before LABEL_MAGIC: size of the pickle in one
+    # byte and pickled list of (name, size)
+    import pickle
+
+    class LegacyLabelUnpickler(pickle.Unpickler):
+        # lists, tuples, strings and numbers do not need classes, so
+        # nothing else of the pickle is loaded
+        def find_class(self, module, name):
+            raise pickle.UnpicklingError(
+                'class {}.{} is not allowed'.format(module, name))
+
+    if not data or len(data) != data[0] + 1:
+        raise DecodingError(
+            "Error decoding, try change mask or input password")
     try:
-        label = pickle.loads(data)
-    except (pickle.UnpicklingError, ValueError, EOFError):
+        label = LegacyLabelUnpickler(io.BytesIO(data[1:])).load()
+        label = [(name, size) for name, size in label]
+    except (pickle.UnpicklingError, ValueError, TypeError, EOFError,
+            IndexError, KeyError, AttributeError):
         raise DecodingError(
             "Error decoding, try change mask or input password")
-    logger.info('label was successfully read')
+    if any(not isinstance(name, str) or not isinstance(size, int) or
+           size < 0 for name, size in label):
+        raise DecodingError(
+            "Error decoding, try change mask or input password")
+    _check_names(label)
+    logger.info('legacy label was successfully read')
     return label
 
 
+def read_index(data):
+    # list of (name, size) and list of crc32 or None, names are decoded
+    # from slices of the data without copying it
+    if bytes(data[:len(LABEL_MAGIC)]) != LABEL_MAGIC:
+        return read_legacy_label(bytes(data)), None
+    data = memoryview(data)
+    read_label_header(data[:LABEL_HEADER.size])
+    flags = data[4]
+    label = []
+    checksums = [] if flags & CHECKSUMS_FLAG else None
+    try:
+        count, offset = decode_varint(data, LABEL_HEADER.size)
+        for _ in range(count):
+            name_size, offset = decode_varint(data, offset)
+            name = str(data[offset:offset + name_size], 'utf-8')
+            size, offset = decode_varint(data, offset + name_size)
+            if checksums is not None:
+                checksums.append(CHECKSUM.unpack_from(data, offset)[0])
+                offset += CHECKSUM.size
+            label.append((name, size))
+    except (IndexError, UnicodeDecodeError, struct.error):
+        raise DecodingError(
+            "Error decoding, try change mask or input password")
+    if offset != len(data):
+        raise DecodingError(
+            "Error decoding, try change mask or input password")
+    _check_names(label)
+    logger.info('label was successfully read')
+    return label, checksums
+
+
+def read_label(data):
+    return read_index(data)[0]
+
+
+def _read_index(read):
+    # label read from the beginning of the data by read function, returns
+    # label, checksums and size of the label
+    head = read(LABEL_HEADER.size)
+    if len(head) < LABEL_HEADER.size:
+        raise DecodingError(
+            "Error decoding, try change mask or input password")
+    if head[:len(LABEL_MAGIC)] != LABEL_MAGIC:
+        # legacy label, the header may take more bytes than the whole
+        # label only if it is an empty list and no files follow it
+        data = head + read(max(0, head[0] + 1 - len(head)))
+        data = data[:head[0] + 1]
+    else:
+        data = head + read(read_label_header(head))
+    label, checksums = read_index(data)
+    return label, checksums, len(data)
+
+
+def _check_data(data, checksum):
+    if checksum is not None and zlib.crc32(data) != checksum:
+        raise DecodingError("Checksum of extracted file does not match")
+
+
+def _check_files(label, checksums, out_dir):
+    if checksums is None:
+        return
+    for (name, size), checksum in zip(label, checksums):
+        with open(os.path.join(out_dir, name), 'rb') as file:
+            if get_checksum(file) != checksum:
+                raise DecodingError(
+                    "Checksum of file {} does not match".format(name))
+
+
 def create_data(file_list):
     data = make_mark(file_list)
     for file in file_list:
@@ -61,130 +258,673 @@ def create_data(file_list):
 
 
 def finalize_data(data):
+    import gzip
     compressed_data = gzip.compress(data)
-    len_of_compressed_data = (len(compressed_data)).to_bytes(27, 'little')
+    len_of_compressed_data = (len(compressed_data)).to_bytes(
+        SIZE_LENGTH, 'little')
     final_data = len_of_compressed_data + compressed_data
     logger.info('data was successfully compressed and finalize')
     return final_data
 
 
-def _write_files(in_file, out_file, files, noise, mask):
+def iter_files(file_list):
+    # the content of the files, chunk by chunk
+    for file in file_list:
+        for chunk in iter(lambda: file.read(CHUNK_SIZE), b''):
+            yield chunk
+
+
+def _embed_chunks(writer, chunks, storage_size):
+    for chunk in chunks:
+        if writer.get_written_size() + len(chunk) > storage_size:
+            logger.error('size of file more than size of storage')
+            raise TooLargeDataError("Too large data")
+        writer.write(chunk)
+
+
+def _make_writer(in_wav_file, out_wav_file, noise, mask, workers,
+                 lsb_count=1):
+    import data_steg
+    if data_steg.is_scatter(mask):
+        # scattered values are patched at once, it is not parallel
+        return data_steg.ScatterWriter(
+            in_wav_file, out_wav_file, noise, mask, lsb_count)
+    if out_wav_file is None:
+        # in-place writing touches only a few samples, it is not parallel
+        return data_steg.InPlaceWriter(in_wav_file, noise, mask, lsb_count)
+    if workers > 1 and out_wav_file.is_patchable() and \
+            _is_named_file(in_wav_file.in_file) and \
+            _is_named_file(out_wav_file.out_file):
+        return data_steg.ParallelWriter(
+            in_wav_file, out_wav_file, noise, mask, workers, lsb_count)
+    if workers > 1:
+        logger.warning('files are not named or output is not patchable, '
+                       'writing in one process')
+    return data_steg.BulkWriter(
+        in_wav_file, out_wav_file, noise, mask, lsb_count)
+
+
+def _make_out_wav_file(out_file, in_wav_file):
+    # no out file means writing to the input file in place
+    if out_file is None:
+        return None
+    return WavFile(out_file, mode='w', params=in_wav_file.params)
+
+
+def _write_files(in_file, out_file, files, noise, mask, workers=1,
+                 lsb_count=1, checksums=False):
+    import data_steg
     format_str = 'start writing files {} without compression to {} with {}'
-    logger.info(format_str.format(files, out_file.name, in_file.name))
-    data = create_data(files)
-    if len(data) > data_steg.get_storage_size(in_file, mask):
+    logger.info(format_str.format(files, _get_name(out_file or in_file),
+                                  _get_name(in_file)))
+    files = list(files)
+    label = make_label(files, checksums)
+    data_size = len(label) + sum(map(get_file_size, files))
+    # header is parsed once for the storage size and the samples
+    in_wav_file = WavFile(in_file, use_mmap=True)
+    if data_size > data_steg.get_capacity(in_wav_file.get_channels_count(),
+                                          mask, lsb_count):
+        in_wav_file.unmap()
         logger.error('size of file more than size of storage')
         raise TooLargeDataError("Too large data")
-    in_file.seek(0)
-    in_wav_file = WavFile(in_file)
-    out_wav_file = WavFile(out_file, mode='w',
-                           params=in_wav_file.params)
-    data_steg.write_data(in_wav_file, out_wav_file, data, noise, mask)
+    out_wav_file = _make_out_wav_file(out_file, in_wav_file)
+    writer = _make_writer(
+        in_wav_file, out_wav_file, noise, mask, workers, lsb_count)
+    try:
+        for chunk in itertools.chain([label], iter_files(files)):
+            writer.write(chunk)
+    except BaseException:
+        writer.abort()
+        raise
+    writer.close()
+    in_wav_file.unmap()
 
     format_str = 'writing files {} to {} with {} was successfully completed'
     logger.info(format_str.format(files, out_wav_file, in_wav_file))
 
 
-def _write_files_with_compress(
-        in_file, out_file, files, noise, mask):
+def _get_sample(files):
+    # beginnings of the files, about SAMPLE_SIZE bytes in total
+    import container
+    part = max(1, container.SAMPLE_SIZE // max(1, len(files)))
+    sample = []
+    for file in files:
+        position = file.tell()
+        sample.append(file.read(part))
+        file.seek(position)
+    return b''.join(sample)
+
+
+def _get_codec(codec, files, speed):
+    import container
+    # codec and speed None are the defaults of container
+    if codec is None:
+        codec = container.DEFAULT_CODEC
+    if speed is None:
+        speed = container.AUTO_SPEED
+    if codec == container.AUTO_CODEC:
+        return container.choose_codec(_get_sample(files), speed)
+    return container.get_codec(codec)
+
+
+def _write_files_with_compress(in_file, out_file, files, noise, mask,
+                               workers=1, lsb_count=1, checksums=False,
+                               codec=None, speed=None):
+    import container
+    import data_steg
     format_str = 'start writing files {} with compression to {} with {}'
-    logger.info(format_str.format(files, out_file.name, in_file.name))
-    data = finalize_data(create_data(files))
-    if len(data) > data_steg.get_storage_size(in_file, mask):
-        logger.error('size of file more than size of storage')
-        raise TooLargeDataError("Too large data")
-    in_file.seek(0)
-    in_wav_file = WavFile(in_file)
-    out_wav_file = WavFile(
-        out_file, mode='w', params=in_wav_file.params)
-    data_steg.write_data(in_wav_file, out_wav_file, data, noise, mask)
+    logger.info(format_str.format(files, _get_name(out_file or in_file),
+                                  _get_name(in_file)))
+    files = list(files)
+    label = make_label(files, checksums)
+    codec = _get_codec(codec, files, speed)
+    data_size = sum(map(get_file_size, files))
+    frames_count = container.get_frames_count(
+        data_size, container.FRAME_SIZE)
+    head = container.make_header(
+        container.FRAME_SIZE, frames_count, len(label), codec) + label
+    in_wav_file = WavFile(in_file, use_mmap=True)
+    storage_size = data_steg.get_capacity(in_wav_file.get_channels_count(),
+                                          mask, lsb_count)
+    out_wav_file = _make_out_wav_file(out_file, in_wav_file)
+    writer = _make_writer(
+        in_wav_file, out_wav_file, noise, mask, workers, lsb_count)
+    frames = map(partial(container.compress_frame, codec=codec),
+                 container.iter_frames(iter_files(files),
+                                       container.FRAME_SIZE))
+    try:
+        _write_frames(writer, head, frames, frames_count, storage_size)
+    except BaseException:
+        writer.abort()
+        raise
+    writer.close()
+    in_wav_file.unmap()
     format_str = 'writing files {} with compression to' \
                  '{} with {} was successfully completed'
     logger.info(format_str.format(files, out_wav_file, in_wav_file))
 
 
-def _read_files_with_compress(in_file, out_dir, mask):
-    format_str = 'start reading files with compression from {}'
-    logger.info(format_str.format(in_file.name))
-
-    in_wav_file = WavFile(in_file)
-
-    size = read_size(data_steg.read_data(in_wav_file, 27, mask))
-    compressed_data = data_steg.read_data(in_wav_file, size, mask)
-
+def _write_frames(writer, head, frames, frames_count, storage_size):
+    import container
+    table_size = frames_count * container.FRAME_ENTRY.size
+    if len(head) + table_size > storage_size:
+        logger.error('size of file more than size of storage')
+        raise TooLargeDataError("Too large data")
+    writer.write(head)
+    frame_sizes = []
+    if writer.is_patchable():
+        # the frame table is embedded when all frames are written
+        reserved = writer.reserve(table_size)
+        for frame in frames:
+            frame_sizes.append(len(frame))
+            _embed_chunks(writer, [frame], storage_size)
+        writer.fill(reserved, container.make_frame_table(frame_sizes))
+    else:
+        import tempfile
+        with tempfile.SpooledTemporaryFile(SPOOL_SIZE) as spool:
+            for frame in frames:
+                frame_sizes.append(len(frame))
+                spool.write(frame)
+            spool.seek(0)
+            chunks = itertools.chain(
+                [container.make_frame_table(frame_sizes)],
+                iter(lambda: spool.read(CHUNK_SIZE), b''))
+            _embed_chunks(writer, chunks, storage_size)
+
+
+class ChunkStream:
+    # file-like reading from an iterator of chunks
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buffer = b''
+
+    def read(self, size):
+        parts = []
+        while size > 0:
+            if not self.buffer:
+                self.buffer = next(self.chunks, b'')
+                if not self.buffer:
+                    break
+            parts.append(self.buffer[:size])
+            self.buffer = self.buffer[size:]
+            size -= len(parts[-1])
+        return b''.join(parts)
+
+
+def _get_name(file):
+    # name of the file for the log, streams may have no name
+    return getattr(file, 'name', file)
+
+
+def _is_named_file(file):
+    name = getattr(file, 'name', None)
+    return isinstance(name, str) and os.path.isfile(name)
+
+
+def _make_reader(in_wav_file, mask, workers, lsb_count=1):
+    import data_steg
+    if data_steg.is_scatter(mask):
+        return data_steg.BulkReader(in_wav_file, mask, lsb_count)
+    if workers > 1 and _is_named_file(in_wav_file.in_file):
+        return data_steg.ParallelReader(
+            in_wav_file, mask, workers, lsb_count)
+    if workers > 1:
+        logger.warning('input is not a named file, reading in one process')
+    return data_steg.BulkReader(in_wav_file, mask, lsb_count)
+
+
+def iter_decompressed(chunks):
+    decompressor = zlib.decompressobj(GZIP_WBITS)
     try:
-        decompressed_data = gzip.decompress(compressed_data)
-    except OSError:
+        for chunk in chunks:
+            while chunk or decompressor.unconsumed_tail:
+                data = decompressor.decompress(
+                    chunk or decompressor.unconsumed_tail, CHUNK_SIZE)
+                chunk = b''
+                if data:
+                    yield data
+                if decompressor.eof:
+                    return
+        data = decompressor.flush()
+    except zlib.error:
         message_error = 'Error decoding, try change mask or input password'
         raise DecodingError(message_error)
-    logger.info('data with size {} was successfully completed'.format(size))
-    label_size = read_size(decompressed_data[0:1])
-    label = read_label(decompressed_data[1:label_size + 1])
-    pointer = label_size
-    for name in label:
-        data = decompressed_data[pointer + 1:pointer + name[1] + 1]
-        pointer += name[1]
-        with open(os.path.join(out_dir, name[0]), 'wb') as file:
-            file.write(data)
-    logger.info('reading files with compression'
-                ' from {} was successfully completed'.format(in_file.name))
-
-
-def _read_files(in_file, out_dir, mask):
+    if data:
+        yield data
+
+
+def _read_compressed_stream(reader, prefix=b''):
+    # format before the framed container: size and one gzip stream
+    size = read_size(prefix + reader.read(SIZE_LENGTH - len(prefix)))
+    stream = ChunkStream(iter_decompressed(reader.iter_read(size)))
+    label, checksums, label_size = _read_index(stream.read)
+    return label, checksums, stream
+
+
+def _read_container_head(reader, prefix):
+    import container
+    header = container.read_header(prefix)
+    label, header['checksums'] = read_index(
+        reader.read(header['label_size']))
+    table_size = header['frames_count'] * container.FRAME_ENTRY.size
+    header['frame_sizes'] = container.read_frame_table(
+        reader.read(table_size))
+    header['frames_start'] = len(prefix) + header['label_size'] + table_size
+    header['data_size'] = sum(size for name, size in label)
+    return header, label
+
+
+def _check_frame(header, index, frame):
+    frame_start = index * header['frame_size']
+    expected_size = min(header['frame_size'],
+                        header['data_size'] - frame_start)
+    if len(frame) != expected_size:
+        raise DecodingError(
+            "Error decoding, try change mask or input password")
+    return frame
+
+
+def _iter_frames(reader, header):
+    import container
+    for index, size in enumerate(header['frame_sizes']):
+        frame = container.decompress_frame(reader.read(size),
+                                           header['codec'])
+        yield _check_frame(header, index, frame)
+
+
+def decompress_frame_task(task):
+    import container
+    import data_steg
+    range_task, header, index, pieces = task
+    frame = container.decompress_frame(
+        data_steg.extract_range(range_task), header['codec'])
+    _check_frame(header, index, frame)
+    for out_name, file_offset, frame_offset, length in pieces:
+        with open(out_name, 'r+b') as out_file:
+            out_file.seek(file_offset)
+            out_file.write(frame[frame_offset:frame_offset + length])
+    return len(frame)
+
+
+def _check_frame_sizes(in_wav_file, mask, header, lsb_count=1):
+    # frame sizes of a corrupt container must fit into the carrier, or
+    # the workers try to read more than the file has
+    import data_steg
+    data_size = header['frames_start'] + sum(header['frame_sizes'])
+    task = data_steg.get_range_task(in_wav_file, mask, 0, data_size,
+                                    lsb_count=lsb_count)
+    (in_name, in_offset, mask, lsb_count, width, first_sample,
+     count) = task[:7]
+    if data_size > data_steg.get_capacity(
+            in_wav_file.get_channels_count(), mask, lsb_count) or \
+            in_offset + count * width > os.path.getsize(in_name):
+        raise DecodingError(
+            "Error decoding, try change mask or input password")
+
+
+def _read_frames_parallel(in_wav_file, mask, header, label, out_dir,
+                          workers, lsb_count=1):
+    # frames are independent, every worker extracts, decompresses and
+    # writes its frame to the files
+    import container
+    import data_steg
+    _check_frame_sizes(in_wav_file, mask, header, lsb_count)
+    out_names = []
+    for name, size in label:
+        out_names.append(os.path.join(out_dir, name))
+        with open(out_names[-1], 'wb') as file:
+            file.truncate(size)
+    sizes = [size for name, size in label]
+    offsets = container.get_frame_offsets(header['frame_sizes'])
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(workers) as pool:
+        futures = []
+        for index, size in enumerate(header['frame_sizes']):
+            range_task = data_steg.get_range_task(
+                in_wav_file, mask, header['frames_start'] + offsets[index],
+                size, lsb_count=lsb_count)
+            pieces = [(out_names[file_index], file_offset, frame_offset,
+                       length) for file_index, file_offset, frame_offset,
+                      length in container.get_pieces(
+                          sizes, index, header['frame_size'])]
+            futures.append(pool.submit(
+                decompress_frame_task, (range_task, header, index, pieces)))
+        for future in futures:
+            future.result()
+
+
+def _save_files(label, read, out_dir):
+    # every file is written by chunks as soon as they are decompressed
+    for name, size in label:
+        with open(os.path.join(out_dir, name), 'wb') as file:
+            while size > 0:
+                data = read(min(size, CHUNK_SIZE))
+                if not data:
+                    raise DecodingError(
+                        "Error decoding, try change mask or input password")
+                with instrumentation.stage('file_write') as stage:
+                    file.write(data)
+                    stage.add(len(data))
+                size -= len(data)
+
+
+def _read_files_with_compress(in_file, out_dir, mask, workers=1,
+                              lsb_count=1):
+    import container
+    import data_steg
+    format_str = 'start reading files with compression from {}'
+    logger.info(format_str.format(_get_name(in_file)))
+    in_wav_file = WavFile(in_file, use_mmap=True)
+    reader = data_steg.BulkReader(in_wav_file, mask, lsb_count)
+    prefix = reader.read(container.HEADER.size)
+    if container.is_container(prefix):
+        header, label = _read_container_head(reader, prefix)
+        checksums = header['checksums']
+        if workers > 1 and _is_named_file(in_file) and \
+                not data_steg.is_scatter(mask):
+            _read_frames_parallel(in_wav_file, mask, header, label,
+                                  out_dir, workers, lsb_count)
+        else:
+            stream = ChunkStream(_iter_frames(reader, header))
+            _save_files(label, stream.read, out_dir)
+    else:
+        reader = _make_reader(in_wav_file, mask, workers, lsb_count)
+        try:
+            label, checksums, stream = _read_compressed_stream(
+                reader, prefix)
+            _save_files(label, stream.read, out_dir)
+        finally:
+            reader.close()
+    in_wav_file.unmap()
+    _check_files(label, checksums, out_dir)
+    logger.info('reading files with compression from {} was '
+                'successfully completed'.format(_get_name(in_file)))
+
+
+def _read_files(in_file, out_dir, mask, workers=1, lsb_count=1):
     format_str = 'start reading files from {}'
-    logger.info(format_str.format(in_file.name))
-    in_wav_file = WavFile(in_file)
-    size = read_size(data_steg.read_data(in_wav_file, 1, mask)[0:1])
-    data_label = data_steg.read_data(in_wav_file, size, mask)
-    label = read_label(data_label)
-    for name in label:
-        data = data_steg.read_data(in_wav_file, name[1], mask)
-        with open(os.path.join(out_dir, name[0]), 'wb') as file:
-            file.write(data)
+    logger.info(format_str.format(_get_name(in_file)))
+    in_wav_file = WavFile(in_file, use_mmap=True)
+    reader = _make_reader(in_wav_file, mask, workers, lsb_count)
+    try:
+        label, checksums, label_size = _read_index(reader.read)
+        for name, size in label:
+            out_filename = os.path.join(out_dir, name)
+            with open(out_filename, 'wb') as file:
+                file.truncate(size)
+            reader.read_to_file(size, out_filename)
+        reader.wait()
+    finally:
+        reader.close()
+    in_wav_file.unmap()
+    _check_files(label, checksums, out_dir)
     logger.info('reading files from {}'
-                'was successfully completed'.format(in_file.name))
+                'was successfully completed'.format(_get_name(in_file)))
 
 
-def read_files(in_file, out_dir, mask='1', compress=False):
+def read_files(in_file, out_dir, mask='1', compress=False, workers=1,
+               lsb_count=1):
     if compress:
-        _read_files_with_compress(in_file, out_dir, mask)
+        _read_files_with_compress(in_file, out_dir, mask, workers, lsb_count)
     else:
-        _read_files(in_file, out_dir, mask)
+        _read_files(in_file, out_dir, mask, workers, lsb_count)
 
 
 def write_files(
-        in_file, out_file, files,
-        noise, mask='1', compress=False):
+        in_file, out_file, files, noise, mask='1', compress=False,
+        workers=1, lsb_count=1, checksums=False,
+        codec=None, speed=None):
+    # lsb_count low bits of every sample of the mask keep the data, with
+    # checksums crc32 of every file is in the label and checked on reading;
+    # codec is a name of container codec or 'auto' for the codec which
+    # compresses a sample best at speed MiB/s at least
     if compress:
-        _write_files_with_compress(
-            in_file, out_file, files, noise, mask)
+        _write_files_with_compress(in_file, out_file, files, noise, mask,
+                                   workers, lsb_count, checksums, codec,
+                                   speed)
     else:
-        _write_files(
-            in_file, out_file, files, noise, mask)
+        _write_files(in_file, out_file, files, noise, mask, workers,
+                     lsb_count, checksums)
+
+
+def write_files_in_place(file, files, noise, mask='1', compress=False,
+                         lsb_count=1, checksums=False,
+                         codec=None, speed=None):
+    # file is the named carrier opened with 'r+b', only samples covered by
+    # the data are rewritten; writing interrupted by a crash is rolled back
+    # by recover_in_place or by the next in-place writing
+    write_files(file, None, files, noise, mask, compress,
+                lsb_count=lsb_count, checksums=checksums, codec=codec,
+                speed=speed)
+
+
+def recover_in_place(filename):
+    # True if an interrupted in-place writing was rolled back
+    import data_steg
+    return data_steg.rollback_journal(filename)
+
+
+def _find_file(label, name):
+    # offset of the file content from the end of the label
+    offset = 0
+    for file_name, size in label:
+        if file_name == name:
+            return offset, size
+        offset += size
+    raise KeyError('File \"{}\" does not exist'.format(name))
+
+
+def _take_file(read, name, size, out_dir, checksum=None):
+    if out_dir is not None:
+        _save_files([(name, size)], read, out_dir)
+        _check_files([(name, size)],
+                     None if checksum is None else [checksum], out_dir)
+        return
+    data = read(size)
+    if len(data) < size:
+        raise DecodingError(
+            "Error decoding, try change mask or input password")
+    _check_data(data, checksum)
+    return data
+
+
+def _get_checksum(label, checksums, name):
+    if checksums is None:
+        return None
+    return checksums[[file_name for file_name, size in label].index(name)]
+
+
+def _extract_file(in_file, name, mask, out_dir, lsb_count=1):
+    import data_steg
+    in_wav_file = WavFile(in_file, use_mmap=True)
+    reader = data_steg.BulkReader(in_wav_file, mask, lsb_count)
+    label, checksums, label_size = _read_index(reader.read)
+    offset, size = _find_file(label, name)
+    # sizes in the label and the mask give the place of the file
+    data_steg.seek_data(in_wav_file, label_size + offset, mask, lsb_count)
+    data = _take_file(reader.read, name, size, out_dir,
+                      _get_checksum(label, checksums, name))
+    in_wav_file.unmap()
+    logger.info('file {} was successfully extracted'.format(name))
+    return data
 
 
-def _get_listing(in_file, mask):
-    in_wav_file = WavFile(in_file)
-    size = read_size(data_steg.read_data(in_wav_file, 1, mask)[0:1])
-    label = read_label(data_steg.read_data(in_wav_file, size, mask))
+def _iter_file_pieces(in_wav_file, reader, header, mask, offset, size,
+                      lsb_count=1):
+    # only frames with bytes of the file are extracted and decompressed
+    import container
+    import data_steg
+    frame_size = header['frame_size']
+    offsets = container.get_frame_offsets(header['frame_sizes'])
+    for index in range(offset // frame_size,
+                       (offset + size - 1) // frame_size + 1):
+        data_steg.seek_data(in_wav_file,
+                            header['frames_start'] + offsets[index], mask,
+                            lsb_count)
+        frame = _check_frame(header, index, container.decompress_frame(
+            reader.read(header['frame_sizes'][index]), header['codec']))
+        frame_start = index * frame_size
+        yield frame[max(offset, frame_start) - frame_start:
+                    min(offset + size, frame_start + frame_size) -
+                    frame_start]
+
+
+def _extract_file_with_compress(in_file, name, mask, out_dir,
+                                lsb_count=1):
+    import container
+    import data_steg
+    in_wav_file = WavFile(in_file, use_mmap=True)
+    reader = data_steg.BulkReader(in_wav_file, mask, lsb_count)
+    prefix = reader.read(container.HEADER.size)
+    if container.is_container(prefix):
+        header, label = _read_container_head(reader, prefix)
+        checksums = header['checksums']
+        offset, size = _find_file(label, name)
+        stream = ChunkStream(_iter_file_pieces(
+            in_wav_file, reader, header, mask, offset, size, lsb_count))
+    else:
+        # one gzip stream can not be sought, previous files are skipped
+        label, checksums, stream = _read_compressed_stream(reader, prefix)
+        offset, size = _find_file(label, name)
+        while offset > 0:
+            skipped = len(stream.read(min(offset, CHUNK_SIZE)))
+            if not skipped:
+                raise DecodingError(
+                    "Error decoding, try change mask or input password")
+            offset -= skipped
+    data = _take_file(stream.read, name, size, out_dir,
+                      _get_checksum(label, checksums, name))
+    in_wav_file.unmap()
+    logger.info('file {} was successfully extracted'.format(name))
+    return data
+
+
+def extract_file(in_file, name, mask='1', out_dir=None, compress=False,
+                 lsb_count=1):
+    # returns content of the file if out_dir is None
+    if compress:
+        return _extract_file_with_compress(
+            in_file, name, mask, out_dir, lsb_count)
+    else:
+        return _extract_file(in_file, name, mask, out_dir, lsb_count)
+
+
+def _get_listing(in_file, mask, lsb_count=1):
+    import data_steg
+    in_wav_file = WavFile(in_file, use_mmap=True)
+    reader = data_steg.BulkReader(in_wav_file, mask, lsb_count)
+    label = _read_index(reader.read)[0]
+    in_wav_file.unmap()
     logger.info('listing was successfully completed')
     return label
 
 
-def _get_listing_with_compression(in_file, mask):
-    in_wav_file = WavFile(in_file)
-    size = read_size(data_steg.read_data(in_wav_file, 27, mask))
-    compressed_data = data_steg.read_data(in_wav_file, size, mask)
-    decompressed_data = gzip.decompress(compressed_data)
-    logger.info('data with size {} was successfully completed'.format(size))
-    label_size = read_size(decompressed_data[0:1])
-    label = read_label(decompressed_data[1:label_size + 1])
+def _get_listing_with_compression(in_file, mask, lsb_count=1):
+    # label of the framed container is not compressed
+    import container
+    import data_steg
+    in_wav_file = WavFile(in_file, use_mmap=True)
+    reader = data_steg.BulkReader(in_wav_file, mask, lsb_count)
+    prefix = reader.read(container.HEADER.size)
+    if container.is_container(prefix):
+        header, label = _read_container_head(reader, prefix)
+    else:
+        label = _read_compressed_stream(reader, prefix)[0]
+    in_wav_file.unmap()
     logger.info('listing with compression was successfully completed')
     return label
 
 
-def get_listing(in_file, mask='1', compress=False):
+def get_listing(in_file, mask='1', compress=False, lsb_count=1):
     if compress:
-        return _get_listing_with_compression(in_file, mask)
+        return _get_listing_with_compression(in_file, mask, lsb_count)
     else:
-        return _get_listing(in_file, mask)
+        return _get_listing(in_file, mask, lsb_count)
+
+
+def _open_job_file(file):
+    # name of a file or dict with path, offset, size and name of its part
+    if isinstance(file, dict):
+        return FilePart(file['path'], file['offset'], file['size'],
+                        file['name'])
+    return open(file, 'rb')
+
+
+def _write_job(job):
+    if os.path.exists(job['output']) and \
+            os.path.samefile(job['input'], job['output']):
+        raise OSError('input and output files are same')
+    files = list(map(_open_job_file, job['files']))
+    try:
+        with open(job['input'], 'rb') as in_file, \
+                open(job['output'], 'wb') as out_file:
+            write_files(in_file, out_file, files, job.get('noise', False),
+                        job.get('mask', '1'), job.get('compress', False),
+                        lsb_count=job.get('lsb_count', 1),
+                        checksums=job.get('checksums', False),
+                        codec=job.get('codec'), speed=job.get('speed'))
+    except BaseException:
+        os.remove(job['output'])
+        raise
+    finally:
+        for file in files:
+            file.close()
+
+
+def _read_job(job):
+    with open(job['input'], 'rb') as in_file:
+        read_files(in_file, job['outdir'], job.get('mask', '1'),
+                   job.get('compress', False),
+                   lsb_count=job.get('lsb_count', 1))
+
+
+def run_job(job):
+    # job is a dict, it fails with a message instead of an exception
+    result = {'input': job['input'], 'error': None}
+    start_time = time.perf_counter()
+    try:
+        if 'files' in job:
+            _write_job(job)
+        else:
+            _read_job(job)
+    except Exception as error:
+        result['error'] = '{}: {}'.format(type(error).__name__, error)
+        logger.error('job {} failed: {}'.format(job, result['error']))
+    result['seconds'] = time.perf_counter() - start_time
+    return result
+
+
+def _init_batch_worker(debug):
+    import container
+    import data_steg
+    initialize_steganography(debug)
+    container.initialize_container(debug)
+    wav_file.initialize_wav_file(debug)
+    data_steg.initialize_data_steg(debug)
+
+
+def run_batch(jobs, workers=1, debug=False):
+    # jobs with files are written, others are read
+    if workers <= 1:
+        return list(map(run_job, jobs))
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(workers, initializer=_init_batch_worker,
+                             initargs=(debug,)) as pool:
+        return list(pool.map(run_job, jobs))
+
+
+def batch_write(jobs, workers=1, debug=False):
+    # jobs: dicts with input, files, output and optional mask, noise,
+    # compress, lsb_count, checksums, codec, speed; returns dicts with
+    # input, seconds and error for every job
+    jobs = [dict(job, files=list(job['files'])) for job in jobs]
+    return run_batch(jobs, workers, debug)
+
+
+def batch_read(jobs, workers=1, debug=False):
+    # jobs: dicts with input, outdir and optional mask, compress,
+    # lsb_count
+    jobs = [dict(job) for job in jobs]
+    for job in jobs:
+        job.pop('files', None)
+    return run_batch(jobs, workers, debug)
@@ -0,0 +1,222 @@
+import asyncio
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from functools import partial
+
+import container
+import instrumentation
+import steganography
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+CHUNK_SIZE = steganography.CHUNK_SIZE
+
+
+class _Cancelled(Exception):
+    # raised in the thread of the engine at the next stage of a
+    # cancelled operation
+    pass
+
+
+class _Operation:
+    # blocking function run by the executor; stages of its thread are sent
+    # to progress in the loop, cancel stops it at the next stage
+    def __init__(self, loop, progress):
+        self.loop = loop
+        self.progress = progress
+        self.cancelled = False
+        self.thread_id = None
+        self.totals = {}
+
+    def _on_stage(self, name, current, total):
+        if threading.get_ident() != self.thread_id:
+            return
+        if self.cancelled:
+            raise _Cancelled()
+        if self.progress is None:
+            return
+        self.totals[name] = self.totals.get(name, 0) + current['bytes']
+        event = dict(current, stage=name, total_bytes=self.totals[name])
+        self.loop.call_soon_threadsafe(self.progress, event)
+
+    def run(self, function):
+        self.thread_id = threading.get_ident()
+        if self.cancelled:
+            raise _Cancelled()
+        instrumentation.add_callback(self._on_stage)
+        try:
+            return function()
+        finally:
+            instrumentation.remove_callback(self._on_stage)
+
+    def report(self, name, bytes_count):
+        # stage of the coroutine itself, it runs in the loop
+        if self.progress is not None:
+            self.totals[name] = self.totals.get(name, 0) + bytes_count
+            self.progress({'stage': name, 'bytes': bytes_count,
+                           'samples': 0, 'total_bytes': self.totals[name]})
+
+
+async def _run(operation, executor, function, *args):
+    # cancellation waits for the engine to stop and clean up its output
+    future = operation.loop.run_in_executor(
+        executor, operation.run, partial(function, *args))
+    try:
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+        operation.cancelled = True
+        try:
+            await future
+        except _Cancelled:
+            pass
+        raise
+
+
+async def _call(executor, function, *args):
+    return await asyncio.get_running_loop().run_in_executor(
+        executor, partial(function, *args))
+
+
+async def _read_stream(stream):
+    # chunks of an object with coroutine read or of an async iterable
+    if hasattr(stream, 'read'):
+        while True:
+            chunk = await stream.read(CHUNK_SIZE)
+            if not chunk:
+                return
+            yield chunk
+    else:
+        async for chunk in stream:
+            yield chunk
+
+
+def _write_chunk(file, chunk):
+    file.write(chunk)
+
+
+async def _spool(operation, executor, sources, directory):
+    # names of the files to embed; (name, async stream) sources are
+    # written to the directory with their names first
+    names = []
+    for source in sources:
+        if isinstance(source, (str, os.PathLike)):
+            names.append(source)
+            continue
+        name, stream = source
+        path = os.path.join(directory, os.path.basename(name))
+        file = await _call(executor, open, path, 'wb')
+        try:
+            async for chunk in _read_stream(stream):
+                await _call(executor, _write_chunk, file, chunk)
+                operation.report('spool', len(chunk))
+        finally:
+            await _call(executor, file.close)
+        names.append(path)
+    return names
+
+
+def _write_files(in_name, out_name, names, noise, mask, compress, workers,
+                 lsb_count, checksums, codec, speed):
+    file_list = [open(name, 'rb') for name in names]
+    try:
+        if out_name is None:
+            with open(in_name, 'r+b') as file:
+                steganography.write_files_in_place(
+                    file, file_list, noise, mask, compress, lsb_count,
+                    checksums, codec, speed)
+            return
+        try:
+            with open(in_name, 'rb') as in_file, \
+                    open(out_name, 'wb') as out_file:
+                steganography.write_files(
+                    in_file, out_file, file_list, noise, mask, compress,
+                    workers, lsb_count, checksums, codec, speed)
+        except BaseException:
+            os.remove(out_name)
+            raise
+    finally:
+        for file in file_list:
+            file.close()
+
+
+async def write_files(in_name, out_name, sources, noise=False, mask='1',
+                      compress=False, workers=1, lsb_count=1,
+                      checksums=False, codec=container.DEFAULT_CODEC,
+                      speed=container.AUTO_SPEED, executor=None,
+                      progress=None):
+    # sources are file names or (name, stream) of async byte streams;
+    # out_name None writes in place; progress is called in the loop with
+    # a dict of stage, bytes, samples and total_bytes of the stage, so
+    # queue.put_nowait of an asyncio.Queue streams the events
+    operation = _Operation(asyncio.get_running_loop(), progress)
+    directory = await _call(executor, tempfile.mkdtemp)
+    try:
+        names = await _spool(operation, executor, sources, directory)
+        await _run(operation, executor, _write_files, in_name, out_name,
+                   names, noise, mask, compress, workers, lsb_count,
+                   checksums, codec, speed)
+    finally:
+        await _call(executor, shutil.rmtree, directory, True)
+    logger.info('async writing to {} was successfully '
+                'completed'.format(out_name or in_name))
+
+
+def _read_files(in_name, out_dir, mask, compress, workers, lsb_count):
+    with open(in_name, 'rb') as in_file:
+        steganography.read_files(in_file, out_dir, mask, compress, workers,
+                                 lsb_count)
+        in_file.seek(0)
+        return steganography.get_listing(in_file, mask, compress,
+                                         lsb_count)
+
+
+async def _send_file(operation, executor, path, name, sink):
+    file = await _call(executor, open, path, 'rb')
+    try:
+        while True:
+            chunk = await _call(executor, file.read, CHUNK_SIZE)
+            await sink(name, chunk)
+            if not chunk:
+                return
+            operation.report('send', len(chunk))
+    finally:
+        await _call(executor, file.close)
+
+
+async def read_files(in_name, out_dir=None, mask='1', compress=False,
+                     workers=1, lsb_count=1, sink=None, executor=None,
+                     progress=None):
+    # files are extracted to out_dir or sent to coroutine sink(name, chunk)
+    # which gets b'' at the end of every file; returns the listing
+    operation = _Operation(asyncio.get_running_loop(), progress)
+    if sink is None:
+        return await _run(operation, executor, _read_files, in_name,
+                          out_dir, mask, compress, workers, lsb_count)
+    directory = await _call(executor, tempfile.mkdtemp)
+    try:
+        label = await _run(operation, executor, _read_files, in_name,
+                           directory, mask, compress, workers, lsb_count)
+        for name, size in label:
+            await _send_file(operation, executor,
+                             os.path.join(directory, name), name, sink)
+    finally:
+        await _call(executor, shutil.rmtree, directory, True)
+    logger.info('async reading from {} was successfully '
+                'completed'.format(in_name))
+    return label
+
+
+def _get_listing(in_name, mask, compress, lsb_count):
+    with open(in_name, 'rb') as in_file:
+        return steganography.get_listing(in_file, mask, compress, lsb_count)
+
+
+async def get_listing(in_name, mask='1', compress=False, lsb_count=1,
+                      executor=None):
+    operation = _Operation(asyncio.get_running_loop(), None)
+    return await _run(operation, executor, _get_listing, in_name, mask,
+                      compress, lsb_count)
@@ -12,3 +12,7 @@ class WavFileError(Exception):
 
 class UnsupportedOperationError(Exception):
     pass
+
+
+class MaskError(Exception):
+    pass
@@ -0,0 +1,278 @@
+import logging
+import os
+import struct
+
+import data_steg
+import steganography
+from wav_file import WavFile
+from steganography_exceptions import DecodingError, TooLargeDataError, \
+    MaskError
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+# Every carrier keeps a header with magic, version, index of the stripe,
+# count of the stripes, id of the set of carriers, offset and size of the
+# stripe, then the stripe; stripes in order of index make the stream of
+# the label and the files as written without compression
+STRIPE_MAGIC = b'SWS'
+STRIPE_VERSION = 1
+STRIPE_HEADER = struct.Struct('<3sBHH8sQQ')
+SET_ID_SIZE = 8
+PART_SIZE = 1 << 20
+
+
+def initialize_striping(debug):
+    global logger
+    logger.disabled = not debug
+
+
+def _check_mask(mask):
+    # ranges of stripes are extracted by samples, not by permutation
+    if data_steg.is_scatter(mask):
+        raise MaskError('striped files can not be scattered')
+
+
+def get_stripe_capacity(in_name, mask='1', lsb_count=1):
+    with open(in_name, 'rb') as in_file:
+        size = data_steg.get_storage_size(in_file, mask, lsb_count)
+    return max(0, int(size) - STRIPE_HEADER.size)
+
+
+def get_striped_storage_size(in_names, mask='1', lsb_count=1):
+    return sum(get_stripe_capacity(name, mask, lsb_count)
+               for name in in_names)
+
+
+def get_stripe_sizes(size, capacities):
+    # sizes proportional to the capacities, the rest goes to the first
+    # stripes with free space
+    total = sum(capacities)
+    if size > total:
+        logger.error('size of files more than size of carriers')
+        raise TooLargeDataError("Too large data")
+    sizes = [size * capacity // total if total else 0
+             for capacity in capacities]
+    for index, capacity in enumerate(capacities):
+        extra = min(capacity - sizes[index], size - sum(sizes))
+        sizes[index] += extra
+    return sizes
+
+
+def _get_pieces(label, files, offset, size):
+    # bytes of the label and parts of the files from offset of the stream
+    pieces = []
+    if offset < len(label):
+        pieces.append(label[offset:offset + size])
+    position = len(label)
+    for name, file_size in files:
+        start = max(offset, position)
+        end = min(offset + size, position + file_size)
+        if start < end:
+            pieces.append({'path': name, 'offset': start - position,
+                           'size': end - start, 'name': name})
+        position += file_size
+    return pieces
+
+
+def write_stripe(task):
+    in_name, out_name, header, pieces, noise, mask, lsb_count = task
+    parts = [steganography.FilePart(piece['path'], piece['offset'],
+                                    piece['size'], piece['name'])
+             for piece in pieces if isinstance(piece, dict)]
+    chunks = [piece for piece in pieces if not isinstance(piece, dict)]
+    try:
+        with open(in_name, 'rb') as in_file, open(out_name, 'wb') as out_file:
+            in_wav_file = WavFile(in_file, use_mmap=True)
+            out_wav_file = WavFile(out_file, mode='w',
+                                   params=in_wav_file.params)
+            writer = data_steg.BulkWriter(in_wav_file, out_wav_file, noise,
+                                          mask, lsb_count)
+            try:
+                writer.write(header)
+                for chunk in chunks:
+                    writer.write(chunk)
+                for chunk in steganography.iter_files(parts):
+                    writer.write(chunk)
+            except BaseException:
+                writer.abort()
+                raise
+            writer.close()
+            in_wav_file.unmap()
+    finally:
+        for part in parts:
+            part.close()
+
+
+def write_striped(in_names, out_names, files, noise=False, mask='1',
+                  lsb_count=1, checksums=False, workers=None):
+    # files are names, the label and the files are split into stripes
+    # of all carriers which are written by workers at the same time
+    logger.info('start striped writing of files {} to {}'.format(files,
+                                                                 out_names))
+    _check_mask(mask)
+    for in_name, out_name in zip(in_names, out_names):
+        if os.path.exists(out_name) and os.path.samefile(in_name, out_name):
+            raise OSError('input and output files are same')
+    file_list = [open(name, 'rb') for name in files]
+    try:
+        label = steganography.make_label(file_list, checksums)
+    finally:
+        for file in file_list:
+            file.close()
+    sizes = [(name, os.path.getsize(name)) for name in files]
+    stream_size = len(label) + sum(size for name, size in sizes)
+    stripe_sizes = get_stripe_sizes(
+        stream_size, [get_stripe_capacity(name, mask, lsb_count)
+                      for name in in_names])
+    set_id = os.urandom(SET_ID_SIZE)
+    tasks = []
+    offset = 0
+    for index, size in enumerate(stripe_sizes):
+        header = STRIPE_HEADER.pack(STRIPE_MAGIC, STRIPE_VERSION, index,
+                                    len(stripe_sizes), set_id, offset, size)
+        tasks.append((in_names[index], out_names[index], header,
+                      _get_pieces(label, sizes, offset, size), noise, mask,
+                      lsb_count))
+        offset += size
+    _run(write_stripe, tasks, workers or len(tasks))
+    logger.info('striped writing to {} was successfully '
+                'completed'.format(out_names))
+
+
+def _run(function, tasks, workers):
+    if workers <= 1:
+        return list(map(function, tasks))
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(workers) as pool:
+        return list(pool.map(function, tasks))
+
+
+def read_stripe_header(in_name, mask='1', lsb_count=1):
+    with open(in_name, 'rb') as in_file:
+        in_wav_file = WavFile(in_file)
+        data = data_steg.BulkReader(in_wav_file, mask, lsb_count).read(
+            STRIPE_HEADER.size)
+    if len(data) < STRIPE_HEADER.size:
+        raise DecodingError(
+            "Error decoding, try change mask or input password")
+    magic, version, index, count, set_id, offset, size = \
+        STRIPE_HEADER.unpack(data)
+    if magic != STRIPE_MAGIC or version != STRIPE_VERSION:
+        raise DecodingError(
+            "Error decoding, try change mask or input password")
+    return {'name': in_name, 'index': index, 'count': count,
+            'set_id': set_id, 'offset': offset, 'size': size}
+
+
+def read_stripe_headers(in_names, mask='1', lsb_count=1):
+    # headers of the stripes in order, carriers may be given in any order
+    stripes = sorted((read_stripe_header(name, mask, lsb_count)
+                      for name in in_names), key=lambda x: x['index'])
+    offset = 0
+    for index, stripe in enumerate(stripes):
+        if stripe['index'] != index or stripe['count'] != len(stripes) or \
+                stripe['set_id'] != stripes[0]['set_id'] or \
+                stripe['offset'] != offset:
+            raise DecodingError("Carriers are not a complete striped set")
+        offset += stripe['size']
+    return stripes
+
+
+class StripedReader:
+    # successive reads of the stream from the stripes in order
+    def __init__(self, stripes, mask, lsb_count=1):
+        self.stripes = iter(stripes)
+        self.mask = mask
+        self.lsb_count = lsb_count
+        self.in_file = None
+        self.reader = None
+        self.left = 0
+
+    def _next_stripe(self):
+        self.close()
+        stripe = next(self.stripes, None)
+        if stripe is None:
+            return False
+        self.in_file = open(stripe['name'], 'rb')
+        in_wav_file = WavFile(self.in_file)
+        data_steg.seek_data(in_wav_file, STRIPE_HEADER.size, self.mask,
+                            self.lsb_count)
+        self.reader = data_steg.BulkReader(in_wav_file, self.mask,
+                                           self.lsb_count)
+        self.left = stripe['size']
+        return True
+
+    def read(self, size):
+        parts = []
+        while size > 0:
+            if not self.left and not self._next_stripe():
+                break
+            parts.append(self.reader.read(min(size, self.left)))
+            self.left -= len(parts[-1])
+            size -= len(parts[-1])
+        return b''.join(parts)
+
+    def close(self):
+        if self.in_file is not None:
+            self.in_file.close()
+            self.in_file = None
+
+
+def _read_stripes_label(stripes, mask, lsb_count):
+    reader = StripedReader(stripes, mask, lsb_count)
+    try:
+        return steganography._read_index(reader.read)
+    finally:
+        reader.close()
+
+
+def get_striped_listing(in_names, mask='1', lsb_count=1):
+    stripes = read_stripe_headers(in_names, mask, lsb_count)
+    return _read_stripes_label(stripes, mask, lsb_count)[0]
+
+
+def _get_tasks(stripe, in_wav_file, mask, lsb_count, start, end, out_name,
+               out_offset):
+    # extract_range tasks for stream bytes from start to end of the stripe
+    tasks = []
+    for position in range(start, end, PART_SIZE):
+        size = min(PART_SIZE, end - position)
+        tasks.append(data_steg.get_range_task(
+            in_wav_file, mask,
+            STRIPE_HEADER.size + position - stripe['offset'], size,
+            out_name, out_offset + position - start, lsb_count))
+    return tasks
+
+
+def read_striped(in_names, out_dir, mask='1', workers=None, lsb_count=1):
+    # every range of a file in every stripe is extracted by workers
+    # straight to its place in the file
+    logger.info('start striped reading from {}'.format(in_names))
+    _check_mask(mask)
+    stripes = read_stripe_headers(in_names, mask, lsb_count)
+    label, checksums, position = _read_stripes_label(stripes, mask,
+                                                     lsb_count)
+    in_files = [open(stripe['name'], 'rb') for stripe in stripes]
+    try:
+        in_wav_files = [WavFile(in_file) for in_file in in_files]
+        tasks = []
+        for name, size in label:
+            out_name = os.path.join(out_dir, name)
+            with open(out_name, 'wb') as out_file:
+                out_file.truncate(size)
+            for stripe, in_wav_file in zip(stripes, in_wav_files):
+                start = max(position, stripe['offset'])
+                end = min(position + size, stripe['offset'] + stripe['size'])
+                if start < end:
+                    tasks += _get_tasks(stripe, in_wav_file, mask, lsb_count,
+                                        start, end, out_name,
+                                        start - position)
+            position += size
+    finally:
+        for in_file in in_files:
+            in_file.close()
+    _run(data_steg.extract_range, tasks, workers or len(stripes))
+    steganography._check_files(label, checksums, out_dir)
+    logger.info('striped reading from {} was successfully '
+                'completed'.format(in_names))
@@ -4,6 +4,25 @@ import unittest
 import random
 import data_steg
 import wav_file
+import detecting_wav_steganography_lsb
+import steganalysis
+import planner
+import striping
+import benchmark
+import instrumentation
+import steganography_aio
+import index_cache
+import container
+import asyncio
+import gzip
+import io
+import logging
+import math
+import pickle
+import struct
+import shutil
+import tempfile
+import threading
 
 IN_WAV_FILENAME = os.path.join('..', 'wav files', 'music.wav')
 OUT_WAV_FILENAME = 'out.wav'
@@ -12,6 +31,7 @@ TEXT_FILENAME = os.path.join('..', 'files', 'textfile.txt')
 OUT_TEXT_FILENAME = os.path.join('..', 'unpack_dir', 'textfile.txt')
 PICTURE_FILENAME = os.path.join('..', 'files', 'python.jpg')
 ARCHIVE_FILENAME = os.path.join('..', 'files', 'archive.rar')
+SAMPLE_RATE = 8000
 
 
 def gen_random_mask(length):
@@ -22,6 +42,28 @@ def func_create_label(x):
     return os.path.basename(x.name), os.path.getsize(x.name)
 
 
+def make_legacy_data(file_list, compress):
+    # data as written by the first versions: pickled label after its size
+    # and the files, with compression gzip of it after its size
+    label = pickle.dumps([func_create_label(file) for file in file_list])
+    data = len(label).to_bytes(1, 'little') + label + \
+        b''.join(file.read() for file in file_list)
+    if compress:
+        data = gzip.compress(data)
+        data = len(data).to_bytes(27, 'little') + data
+    return data
+
+
+def make_wav(samples, channels, bits, fmt=1):
+    # wav file of the bytes of the samples
+    block_align = channels * bits // 8
+    return b'RIFF' + struct.pack('<I', 36 + len(samples)) + \
+        b'WAVEfmt ' + struct.pack('<IHHIIHH', 16, fmt, channels,
+                                  SAMPLE_RATE, SAMPLE_RATE * block_align,
+                                  block_align, bits) + \
+        b'data' + struct.pack('<I', len(samples)) + samples
+
+
 class SteganographyTester(unittest.TestCase):
     compress = False
     try:
@@ -142,6 +184,769 @@ class SteganographyTester(unittest.TestCase):
             self.assertEqual(first_data + second_data, data)
         os.remove(OUT_WAV_FILENAME)
 
+    def test_bulk_write_equals_write(self):
+        data = os.urandom(100)
+        for mask in ['1', '10', '0110', gen_random_mask(8) + '1']:
+            for noise in [False, True]:
+                results = []
+                for write in [data_steg.write_data,
+                              data_steg.write_data_bulk]:
+                    random.seed(mask)
+                    with open(IN_WAV_FILENAME, 'rb') as in_file, \
+                            open(OUT_WAV_FILENAME, 'ab') as out_file:
+                        in_wav_file = wav_file.WavFile(in_file)
+                        out_wav_file = wav_file.WavFile(
+                            out_file, 'w', params=in_wav_file.get_params())
+                        write(in_wav_file, out_wav_file, data, noise, mask)
+                    with open(OUT_WAV_FILENAME, 'rb') as out_file:
+                        results.append(out_file.read())
+                    os.remove(OUT_WAV_FILENAME)
+                self.assertEqual(results[0], results[1])
+
+    def test_bulk_read_equals_read(self):
+        mask = gen_random_mask(8) + '1'
+        lengths = [random.randint(0, 20) for e in range(5)]
+        results = []
+        for read in [data_steg.read_data, data_steg.read_data_bulk]:
+            with open(IN_WAV_FILENAME, 'rb') as in_file:
+                in_wav_file = wav_file.WavFile(in_file)
+                results.append([read(in_wav_file, length, mask)
+                                for length in lengths])
+        self.assertEqual(results[0], results[1])
+
+    def test_mapped_wav_file(self):
+        with open(IN_WAV_FILENAME, 'rb') as in_file:
+            expected = wav_file.WavFile(in_file).read_block(100)
+            in_file.seek(0)
+            mapped_wav_file = wav_file.WavFile(in_file, use_mmap=True)
+            self.assertEqual(
+                bytes(mapped_wav_file.get_samples(0, 100)), expected)
+            self.assertEqual(
+                bytes(mapped_wav_file.read_block(100)), expected)
+            mapped_wav_file.unmap()
+
+    def test_seekable_output(self):
+        with open(IN_WAV_FILENAME, 'rb') as in_file,\
+                open(OUT_WAV_FILENAME, 'wb') as out_file,\
+                open(TEXT_FILENAME, 'rb') as text_file,\
+                open(PICTURE_FILENAME, 'rb') as picture_file:
+            steganography.write_files(
+                in_file, out_file, [text_file, picture_file],
+                False, compress=self.compress)
+        self.assertEqual(os.path.getsize(OUT_WAV_FILENAME),
+                         os.path.getsize(IN_WAV_FILENAME))
+        with open(OUT_WAV_FILENAME, 'rb') as read_file:
+            steganography.read_files(
+                read_file, OUT_DIR, compress=self.compress)
+        with open(PICTURE_FILENAME, 'rb') as expected_file:
+            out_picture_filename = os.path.join(OUT_DIR, 'python.jpg')
+            with open(out_picture_filename, 'rb') as real_file:
+                self.assertEqual(expected_file.read(), real_file.read())
+        os.remove(out_picture_filename)
+        os.remove(OUT_TEXT_FILENAME)
+        os.remove(OUT_WAV_FILENAME)
+
+    def test_parallel_write_equals_write(self):
+        results = []
+        for workers in [1, 3]:
+            with open(IN_WAV_FILENAME, 'rb') as in_file,\
+                    open(OUT_WAV_FILENAME, 'wb') as out_file,\
+                    open(PICTURE_FILENAME, 'rb') as picture_file:
+                steganography.write_files(
+                    in_file, out_file, [picture_file], False,
+                    mask='1101', compress=self.compress, workers=workers)
+            with open(OUT_WAV_FILENAME, 'rb') as out_file:
+                results.append(out_file.read())
+            os.remove(OUT_WAV_FILENAME)
+        self.assertEqual(results[0], results[1])
+        # streams without names are written in one process
+        with open(IN_WAV_FILENAME, 'rb') as in_file,\
+                open(PICTURE_FILENAME, 'rb') as picture_file:
+            out_file = io.BytesIO()
+            steganography.write_files(
+                io.BytesIO(in_file.read()), out_file, [picture_file], False,
+                mask='1101', compress=self.compress, workers=3)
+        self.assertEqual(out_file.getvalue(), results[0])
+
+    def test_parallel_read(self):
+        with open(IN_WAV_FILENAME, 'rb') as in_file,\
+                open(OUT_WAV_FILENAME, 'wb') as out_file,\
+                open(PICTURE_FILENAME, 'rb') as picture_file:
+            steganography.write_files(
+                in_file, out_file, [picture_file], False,
+                mask='1101', compress=self.compress)
+        with open(OUT_WAV_FILENAME, 'rb') as read_file:
+            steganography.read_files(read_file, OUT_DIR, mask='1101',
+                                     compress=self.compress, workers=3)
+        out_picture_filename = os.path.join(OUT_DIR, 'python.jpg')
+        with open(PICTURE_FILENAME, 'rb') as expected_file:
+            with open(out_picture_filename, 'rb') as real_file:
+                self.assertEqual(expected_file.read(), real_file.read())
+        os.remove(out_picture_filename)
+        os.remove(OUT_WAV_FILENAME)
+
+    def test_batch(self):
+        write_jobs = [{'input': IN_WAV_FILENAME, 'files': [TEXT_FILENAME],
+                       'output': OUT_WAV_FILENAME, 'compress': self.compress},
+                      {'input': TEXT_FILENAME, 'files': [TEXT_FILENAME],
+                       'output': OUT_WAV_FILENAME + '.bad1'},
+                      {'input': IN_WAV_FILENAME, 'files': [TEXT_FILENAME],
+                       'output': OUT_WAV_FILENAME + '.bad2', 'compress': True,
+                       'codec': 'nope'},
+                      {'input': IN_WAV_FILENAME, 'files': [PICTURE_FILENAME],
+                       'output': OUT_WAV_FILENAME + '.bad3', 'mask': '1001',
+                       'compress': True}]
+        results = steganography.batch_write(write_jobs, workers=2)
+        self.assertIsNone(results[0]['error'])
+        self.assertTrue(results[1]['error'].startswith('WavFileError'))
+        self.assertTrue(results[2]['error'].startswith('ValueError'))
+        self.assertTrue(results[3]['error'].startswith('TooLargeDataError'))
+        # outputs of failed jobs are removed
+        for index in range(1, 4):
+            self.assertFalse(os.path.exists(
+                '{}.bad{}'.format(OUT_WAV_FILENAME, index)))
+        read_jobs = [{'input': OUT_WAV_FILENAME, 'outdir': OUT_DIR,
+                      'compress': self.compress}]
+        results = steganography.batch_read(read_jobs)
+        self.assertIsNone(results[0]['error'])
+        with open(TEXT_FILENAME, 'rb') as expected_file:
+            with open(OUT_TEXT_FILENAME, 'rb') as real_file:
+                self.assertEqual(expected_file.read(), real_file.read())
+        os.remove(OUT_TEXT_FILENAME)
+        os.remove(OUT_WAV_FILENAME)
+
+    def test_extract_file(self):
+        with open(TEXT_FILENAME, 'rb') as text_file,\
+                open(PICTURE_FILENAME, 'rb') as picture_file,\
+                open(ARCHIVE_FILENAME, 'rb') as arch_file,\
+                open(IN_WAV_FILENAME, 'rb') as in_file,\
+                open(OUT_WAV_FILENAME, 'wb') as out_file:
+            file_list = [text_file, picture_file, arch_file]
+            steganography.write_files(
+                in_file, out_file, file_list,
+                noise=False, mask='1101', compress=self.compress)
+        with open(OUT_WAV_FILENAME, 'rb') as read_file,\
+                open(ARCHIVE_FILENAME, 'rb') as arch_file:
+            data = steganography.extract_file(
+                read_file, 'archive.rar', mask='1101', compress=self.compress)
+            self.assertEqual(data, arch_file.read())
+            read_file.seek(0)
+            steganography.extract_file(
+                read_file, 'python.jpg', mask='1101', out_dir=OUT_DIR,
+                compress=self.compress)
+            out_name = os.path.join(OUT_DIR, 'python.jpg')
+            with open(out_name, 'rb') as out_picture,\
+                    open(PICTURE_FILENAME, 'rb') as picture_file:
+                self.assertEqual(out_picture.read(), picture_file.read())
+            os.remove(out_name)
+            read_file.seek(0)
+            with self.assertRaises(KeyError):
+                steganography.extract_file(
+                    read_file, 'nothing', mask='1101', compress=self.compress)
+        os.remove(OUT_WAV_FILENAME)
+
+    def test_legacy_format(self):
+        with open(IN_WAV_FILENAME, 'rb') as in_file,\
+                open(OUT_WAV_FILENAME, 'wb') as out_file,\
+                open(TEXT_FILENAME, 'rb') as text_file,\
+                open(PICTURE_FILENAME, 'rb') as picture_file:
+            in_wav_file = wav_file.WavFile(in_file)
+            out_wav_file = wav_file.WavFile(
+                out_file, 'w', params=in_wav_file.get_params())
+            data = make_legacy_data([text_file, picture_file], self.compress)
+            data_steg.write_data_bulk(
+                in_wav_file, out_wav_file, data, False, '1')
+        with open(OUT_WAV_FILENAME, 'rb') as read_file:
+            self.assertEqual(
+                steganography.get_listing(read_file, compress=self.compress),
+                [func_create_label(text_file),
+                 func_create_label(picture_file)])
+            read_file.seek(0)
+            steganography.read_files(read_file, OUT_DIR,
+                                     compress=self.compress)
+        with open(TEXT_FILENAME, 'rb') as expected_file:
+            with open(OUT_TEXT_FILENAME, 'rb') as real_file:
+                self.assertEqual(expected_file.read(), real_file.read())
+        os.remove(OUT_TEXT_FILENAME)
+        os.remove(os.path.join(OUT_DIR, 'python.jpg'))
+        os.remove(OUT_WAV_FILENAME)
+
+    def test_find_mask(self):
+        with open(IN_WAV_FILENAME, 'rb') as in_file,\
+                open(OUT_WAV_FILENAME, 'ab') as out_file,\
+                open(TEXT_FILENAME, 'rb') as text_file:
+            steganography.write_files(
+                in_file, out_file, [text_file],
+                False, compress=self.compress, mask='1001101')
+        with open(OUT_WAV_FILENAME, 'rb') as read_file:
+            found = detecting_wav_steganography_lsb.find_masks(
+                read_file, max_mask_len=8)
+        self.assertEqual(found[0][0], '1001101')
+        os.remove(OUT_WAV_FILENAME)
+        # text after a buffer of random bytes is found with two attempts
+        with open(IN_WAV_FILENAME, 'rb') as in_file,\
+                open(OUT_WAV_FILENAME, 'wb') as out_file:
+            in_wav_file = wav_file.WavFile(in_file)
+            out_wav_file = wav_file.WavFile(
+                out_file, 'w', params=in_wav_file.get_params())
+            data_steg.write_data_bulk(
+                in_wav_file, out_wav_file,
+                bytes(random.getrandbits(8) | 0x80 for _ in range(100)) +
+                b'hidden text ' * 20, False, '1001101')
+        self.assertEqual(detecting_wav_steganography_lsb.brute_force_mask(
+            OUT_WAV_FILENAME, 1, mask_len=7), -1)
+        self.assertNotEqual(detecting_wav_steganography_lsb.brute_force_mask(
+            OUT_WAV_FILENAME, 2, mask_len=7), -1)
+        with open(OUT_WAV_FILENAME, 'rb') as read_file:
+            found = detecting_wav_steganography_lsb.find_masks(
+                read_file, 7, 7, max_results=128, max_attempts=2)
+        self.assertIn('1001101', [mask for mask, data_format, score in found])
+        os.remove(OUT_WAV_FILENAME)
+
+    def test_lsb_count(self):
+        for lsb_count in [2, 4, 8]:
+            with open(IN_WAV_FILENAME, 'rb') as in_file,\
+                    open(OUT_WAV_FILENAME, 'wb') as out_file,\
+                    open(PICTURE_FILENAME, 'rb') as picture_file:
+                self.assertEqual(
+                    steganography.get_storage_size(in_file, '1101',
+                                                   lsb_count),
+                    steganography.get_storage_size(in_file, '1101') *
+                    lsb_count)
+                steganography.write_files(
+                    in_file, out_file, [picture_file], False,
+                    compress=self.compress, mask='1101',
+                    lsb_count=lsb_count)
+            with open(OUT_WAV_FILENAME, 'rb') as read_file:
+                steganography.read_files(read_file, OUT_DIR, '1101',
+                                         self.compress, lsb_count=lsb_count)
+            with open(PICTURE_FILENAME, 'rb') as expected_file,\
+                    open(os.path.join(OUT_DIR, 'python.jpg'),
+                         'rb') as real_file:
+                self.assertEqual(expected_file.read(), real_file.read())
+        os.remove(OUT_WAV_FILENAME)
+
+    def test_write_in_place(self):
+        with open(IN_WAV_FILENAME, 'rb') as in_file,\
+                open(OUT_WAV_FILENAME, 'wb') as out_file,\
+                open(TEXT_FILENAME, 'rb') as text_file:
+            steganography.write_files(in_file, out_file, [text_file], False,
+                                      '1101', self.compress)
+        with open(OUT_WAV_FILENAME, 'rb') as expected_file:
+            expected = expected_file.read()
+        shutil.copyfile(IN_WAV_FILENAME, OUT_WAV_FILENAME)
+        with open(OUT_WAV_FILENAME, 'r+b') as file,\
+                open(TEXT_FILENAME, 'rb') as text_file:
+            steganography.write_files_in_place(
+                file, [text_file], False, '1101', self.compress)
+        with open(OUT_WAV_FILENAME, 'rb') as real_file:
+            self.assertEqual(real_file.read(), expected)
+        self.assertFalse(steganography.recover_in_place(OUT_WAV_FILENAME))
+
+        # writing interrupted after the journal is saved is rolled back
+        shutil.copyfile(IN_WAV_FILENAME, OUT_WAV_FILENAME)
+        with open(OUT_WAV_FILENAME, 'r+b') as file:
+            writer = data_steg.InPlaceWriter(wav_file.WavFile(file), False,
+                                             '1')
+            writer.write(os.urandom(1000))
+            writer.journal.close()
+        self.assertTrue(steganography.recover_in_place(OUT_WAV_FILENAME))
+        with open(IN_WAV_FILENAME, 'rb') as expected_file,\
+                open(OUT_WAV_FILENAME, 'rb') as real_file:
+            self.assertEqual(real_file.read(), expected_file.read())
+        os.remove(OUT_WAV_FILENAME)
+
+    def test_many_files(self):
+        with tempfile.TemporaryDirectory() as files_dir:
+            names = []
+            for index in range(1000):
+                names.append(os.path.join(files_dir,
+                                          'log{}.txt'.format(index)))
+                with open(names[-1], 'wb') as file:
+                    file.write(os.urandom(index % 50))
+            files = [open(name, 'rb') for name in names]
+            with open(IN_WAV_FILENAME, 'rb') as in_file,\
+                    open(OUT_WAV_FILENAME, 'wb') as out_file:
+                steganography.write_files(
+                    in_file, out_file, files, False,
+                    compress=self.compress, checksums=True)
+            for file in files:
+                file.close()
+            with open(OUT_WAV_FILENAME, 'rb') as read_file:
+                self.assertEqual(
+                    steganography.get_listing(read_file,
+                                              compress=self.compress),
+                    list(map(func_create_label, files)))
+                read_file.seek(0)
+                with tempfile.TemporaryDirectory() as out_dir:
+                    steganography.read_files(read_file, out_dir,
+                                             compress=self.compress)
+                    for name in names:
+                        with open(name, 'rb') as expected_file,\
+                                open(os.path.join(
+                                    out_dir, os.path.basename(name)),
+                                    'rb') as real_file:
+                            self.assertEqual(expected_file.read(),
+                                             real_file.read())
+                read_file.seek(0)
+                with open(names[7], 'rb') as expected_file:
+                    self.assertEqual(steganography.extract_file(
+                        read_file, 'log7.txt', compress=self.compress),
+                        expected_file.read())
+        os.remove(OUT_WAV_FILENAME)
+
+        with open(TEXT_FILENAME, 'rb') as text_file:
+            label = bytearray(steganography.make_label([text_file], True))
+        self.assertEqual(steganography.read_label(label),
+                         [func_create_label(text_file)])
+        label[-1] ^= 1
+        checksum = steganography.read_index(label)[1][0]
+        with open(TEXT_FILENAME, 'rb') as text_file:
+            self.assertRaises(steganography.DecodingError,
+                              steganography._check_data, text_file.read(),
+                              checksum)
+        self.assertRaises(steganography.DecodingError,
+                          steganography.read_label, label[:-1])
+
+    def test_benchmark(self):
+        suite = {'seconds': [0.5], 'channels': [2], 'bits': [16],
+                 'masks': ['1101'], 'lsb_counts': [2],
+                 'engines': ['bulk', 'in_place'],
+                 'modes': ['compress' if self.compress else 'plain']}
+        with tempfile.TemporaryDirectory() as work_dir:
+            results = benchmark.run_suite(suite, work_dir, repeats=1)
+        self.assertEqual(len(results), 2 + len(benchmark.STARTUP_COMMANDS))
+        for result in results:
+            for metric in benchmark.METRICS:
+                if metric in result:
+                    self.assertGreater(result[metric], 0)
+        old_report = benchmark.make_report(results, 'test', 2)
+        new_report = benchmark.make_report(
+            [dict(results[0], embed_mb_s=results[0]['embed_mb_s'] / 2,
+                  parse_ms=results[0]['parse_ms'] / 2)], 'test', 2)
+        self.assertEqual(
+            [regression[:2] for regression in
+             benchmark.compare(old_report, new_report)],
+            [(results[0]['name'], 'embed_mb_s')])
+
+    def test_index_cache(self):
+        with tempfile.TemporaryDirectory() as work_dir:
+            carrier = os.path.join(work_dir, 'carrier.wav')
+            cache_name = os.path.join(work_dir, 'cache.json')
+            with open(IN_WAV_FILENAME, 'rb') as in_file,\
+                    open(carrier, 'wb') as out_file,\
+                    open(TEXT_FILENAME, 'rb') as text_file:
+                steganography.write_files(in_file, out_file, [text_file],
+                                          False, '1101', self.compress)
+            with open(carrier, 'rb') as in_file:
+                listing = steganography.get_listing(in_file, '1101',
+                                                    self.compress)
+                in_file.seek(0)
+                storage_size = steganography.get_storage_size(in_file, '1101')
+            cache = index_cache.IndexCache(cache_name)
+            self.assertEqual(cache.get_listing(carrier, '1101',
+                                               self.compress), listing)
+            self.assertEqual(cache.get_capacity(carrier, '1101'),
+                             storage_size)
+            cache.save()
+            cache = index_cache.IndexCache(cache_name)
+            self.assertEqual(cache.get_listing(carrier, '1101',
+                                               self.compress), listing)
+            self.assertEqual(cache.get_capacity(carrier, '1101'),
+                             storage_size)
+            self.assertEqual((cache.hits, cache.misses), (2, 0))
+            with open(cache_name) as cache_file:
+                self.assertNotIn('1101', cache_file.read())
+            # changed carrier is parsed again
+            with open(carrier, 'ab') as out_file:
+                out_file.write(b'\0')
+            cache.get_capacity(carrier, '1101')
+            self.assertEqual(cache.misses, 2)
+            cache.entries['other'] = cache.entries[os.path.realpath(carrier)]
+            cache.get_capacity(carrier, '1101')
+            cache.max_size = 1
+            cache.save()
+            self.assertEqual(list(cache.entries), [os.path.realpath(carrier)])
+            # a hit makes the carrier the most recently used one on disk
+            other = os.path.join(work_dir, 'other.wav')
+            shutil.copy(carrier, other)
+            cache_name = os.path.join(work_dir, 'order.json')
+            cache = index_cache.IndexCache(cache_name)
+            cache.get_capacity(carrier, '1101')
+            cache.get_capacity(other, '1101')
+            cache.save()
+            cache = index_cache.IndexCache(cache_name)
+            cache.get_capacity(carrier, '1101')
+            cache.save()
+            cache = index_cache.IndexCache(cache_name)
+            self.assertEqual(list(cache.entries), [os.path.realpath(other),
+                                                   os.path.realpath(carrier)])
+
+    def test_aio(self):
+        data = os.urandom(20000)
+
+        async def stream():
+            for position in range(0, len(data), 1000):
+                yield data[position:position + 1000]
+
+        async def run(work_dir):
+            out_name = os.path.join(work_dir, 'out.wav')
+            events = asyncio.Queue()
+            await steganography_aio.write_files(
+                IN_WAV_FILENAME, out_name,
+                [('stream.bin', stream()), TEXT_FILENAME], False, '1101',
+                self.compress, progress=events.put_nowait)
+            stages = set()
+            while not events.empty():
+                stages.add((await events.get())['stage'])
+            self.assertTrue({'spool', 'embed'} <= stages)
+            label = [('stream.bin', len(data)),
+                     ('textfile.txt', os.path.getsize(TEXT_FILENAME))]
+            self.assertEqual(await steganography_aio.get_listing(
+                out_name, '1101', self.compress), label)
+            chunks = {}
+
+            async def sink(name, chunk):
+                chunks.setdefault(name, []).append(chunk)
+
+            self.assertEqual(await steganography_aio.read_files(
+                out_name, mask='1101', compress=self.compress, sink=sink),
+                label)
+            self.assertEqual(b''.join(chunks['stream.bin']), data)
+            self.assertEqual(chunks['stream.bin'][-1], b'')
+            # writing cancelled after the first embedded chunk stops at the
+            # next stage and removes its output; the engine can not finish,
+            # it waits for the cancellation at the second chunk
+            cancel_name = os.path.join(work_dir, 'cancel.wav')
+            cancelled = threading.Event()
+            embedded = []
+
+            def pause(name, run, total):
+                if name == 'embed' and \
+                        threading.current_thread() is not \
+                        threading.main_thread():
+                    embedded.append(name)
+                    if len(embedded) == 2:
+                        cancelled.wait(10)
+
+            def cancel(event):
+                if event['stage'] == 'embed':
+                    task.cancel()
+                    # the engine goes on after the task gets the cancel
+                    asyncio.get_running_loop().call_soon(cancelled.set)
+
+            instrumentation.add_callback(pause)
+            try:
+                task = asyncio.ensure_future(steganography_aio.write_files(
+                    IN_WAV_FILENAME, cancel_name, [TEXT_FILENAME],
+                    compress=self.compress, progress=cancel))
+                with self.assertRaises(asyncio.CancelledError):
+                    await task
+            finally:
+                instrumentation.remove_callback(pause)
+            self.assertTrue(cancelled.is_set())
+            self.assertFalse(os.path.exists(cancel_name))
+
+        with tempfile.TemporaryDirectory() as work_dir:
+            asyncio.run(run(work_dir))
+
+    def test_scatter(self):
+        mask = data_steg.SCATTER_PREFIX + 'key'
+        layout = data_steg.ScatterLayout(mask)
+        positions = layout.get_positions(0, 1000, 1000)
+        self.assertEqual(sorted(positions), list(range(1000)))
+        self.assertEqual(layout.get_positions(10, 5, 1000),
+                         positions[10:15])
+        self.assertRaises(data_steg.MaskError, data_steg.ScatterLayout,
+                          mask, True)
+        with open(IN_WAV_FILENAME, 'rb') as in_file,\
+                open(OUT_WAV_FILENAME, 'wb') as out_file,\
+                open(TEXT_FILENAME, 'rb') as text_file:
+            steganography.write_files(in_file, out_file, [text_file], False,
+                                      mask, self.compress, lsb_count=2)
+        with open(IN_WAV_FILENAME, 'rb') as expected_file,\
+                open(OUT_WAV_FILENAME, 'rb') as real_file:
+            expected = expected_file.read()
+            real = real_file.read()
+        # changed samples are spread over the whole data chunk
+        changed = [index for index in range(len(expected))
+                   if expected[index] != real[index]]
+        self.assertGreater(changed[0] / len(real), 0)
+        self.assertLess(changed[0] / len(real), 0.01)
+        self.assertGreater(changed[-1] / len(real), 0.99)
+        with open(OUT_WAV_FILENAME, 'rb') as read_file:
+            steganography.read_files(read_file, OUT_DIR, mask, self.compress,
+                                     workers=2, lsb_count=2)
+        with open(TEXT_FILENAME, 'rb') as expected_file,\
+                open(OUT_TEXT_FILENAME, 'rb') as real_file:
+            self.assertEqual(expected_file.read(), real_file.read())
+        shutil.copyfile(IN_WAV_FILENAME, OUT_WAV_FILENAME)
+        with open(OUT_WAV_FILENAME, 'r+b') as file,\
+                open(TEXT_FILENAME, 'rb') as text_file:
+            steganography.write_files_in_place(
+                file, [text_file], False, mask, self.compress, lsb_count=2)
+        with open(OUT_WAV_FILENAME, 'rb') as real_file:
+            self.assertEqual(real_file.read(), real)
+        with open(OUT_WAV_FILENAME, 'rb') as read_file:
+            self.assertRaises(steganography.DecodingError,
+                              steganography.get_listing, read_file,
+                              mask + '1', self.compress, 2)
+        os.remove(OUT_WAV_FILENAME)
+        # data chunk of an output which is only appended is spooled
+        with open(IN_WAV_FILENAME, 'rb') as in_file,\
+                open(OUT_WAV_FILENAME, 'ab') as out_file,\
+                open(TEXT_FILENAME, 'rb') as text_file:
+            steganography.write_files(in_file, out_file, [text_file], False,
+                                      mask, self.compress, lsb_count=2)
+        with open(OUT_WAV_FILENAME, 'rb') as real_file:
+            self.assertEqual(real_file.read(), real)
+        os.remove(OUT_WAV_FILENAME)
+
+    def test_instrumentation(self):
+        events = []
+        instrumentation.enable(lambda name, run, total: events.append(name))
+        try:
+            with open(IN_WAV_FILENAME, 'rb') as in_file,\
+                    open(OUT_WAV_FILENAME, 'wb') as out_file,\
+                    open(TEXT_FILENAME, 'rb') as text_file:
+                steganography.write_files(in_file, out_file, [text_file],
+                                          False, compress=self.compress)
+            with open(OUT_WAV_FILENAME, 'rb') as read_file:
+                steganography.read_files(read_file, OUT_DIR,
+                                         compress=self.compress)
+            report = instrumentation.get_report()
+        finally:
+            instrumentation.disable()
+            instrumentation.reset()
+        stages = report['stages']
+        expected = {'header_parse', 'label_build', 'embed', 'extract',
+                    'file_write'}
+        if self.compress:
+            expected |= {'compress', 'decompress'}
+        self.assertEqual(set(stages), expected)
+        self.assertEqual(set(events), expected)
+        self.assertEqual(stages['file_write']['bytes'],
+                         os.path.getsize(TEXT_FILENAME))
+        self.assertGreater(stages['embed']['samples'], 0)
+        self.assertIs(instrumentation.stage('embed'),
+                      instrumentation.NULL_STAGE)
+        os.remove(OUT_WAV_FILENAME)
+
+
+class SteganographyToolsTester(unittest.TestCase):
+    # tests which do not depend on compression, so they are run once
+    def test_legacy_label(self):
+        label = pickle.dumps([('name', 1)])
+        self.assertEqual(steganography.read_label(
+            len(label).to_bytes(1, 'little') + label), [('name', 1)])
+        # classes of the pickle are not loaded
+        label = pickle.dumps([(os.path.join, 1)])
+        self.assertRaises(steganography.DecodingError,
+                          steganography.read_label,
+                          len(label).to_bytes(1, 'little') + label)
+
+    def test_riff_chunks(self):
+        # extensible fmt, metadata with 'data' inside and a chunk after data
+        fmt = struct.pack('<HHIIHHHHI', 0xfffe, 2, 8000, 32000, 4, 16, 22,
+                          16, 3) + struct.pack('<H', 1) + bytes(14)
+        info = b'INFOICMT' + struct.pack('<I', 9) + b'data data\x00'
+        samples = os.urandom(4000)
+        chunks = [(b'fmt ', fmt), (b'LIST', info), (b'data', samples),
+                  (b'cue ', os.urandom(7) + b'\x00')]
+        body = b''.join(ident + struct.pack('<I', len(data)) + data
+                        for ident, data in chunks)
+        riff = b'RIFF' + struct.pack('<I', len(body) + 4) + b'WAVE' + body
+        in_wav_file = wav_file.WavFile(io.BytesIO(riff))
+        self.assertEqual([chunk[0] for chunk in in_wav_file.chunks],
+                         [b'fmt ', b'LIST', b'data', b'cue '])
+        self.assertEqual(in_wav_file.params['num_channels'], 2)
+        self.assertEqual(in_wav_file.params['subchunk2_size'], 4000)
+        self.assertEqual(in_wav_file.read_block(2000), samples)
+        in_wav_file.seek_block(0)
+        out_file = io.BytesIO()
+        out_wav_file = wav_file.WavFile(
+            out_file, 'w', params=in_wav_file.get_params())
+        data_steg.write_data_bulk(
+            in_wav_file, out_wav_file, b'metadata', False, '1')
+        written = out_file.getvalue()
+        self.assertEqual(len(written), len(riff))
+        self.assertEqual(written[-16:], riff[-16:])
+        read_wav_file = wav_file.WavFile(io.BytesIO(written))
+        self.assertEqual(data_steg.read_data_bulk(
+            read_wav_file, 8, '1'), b'metadata')
+
+        # rf64 keeps the size of data in ds64
+        ds64 = struct.pack('<QQQI', len(body) + 40, 4000, 1000, 0)
+        body = b'ds64' + struct.pack('<I', len(ds64)) + ds64 + \
+            body.replace(struct.pack('<I', 4000), b'\xff' * 4, 1)
+        rf64 = b'RF64' + b'\xff' * 4 + b'WAVE' + body
+        in_wav_file = wav_file.WavFile(io.BytesIO(rf64))
+        self.assertEqual(in_wav_file.params['subchunk2_size'], 4000)
+        self.assertEqual(in_wav_file.chunks[-1][0], b'cue ')
+
+    def test_sample_width(self):
+        # only lsb_count low bits of 24-bit samples are changed
+        samples = os.urandom(3 * 3000)
+        data = os.urandom(1000)
+        in_wav_file = wav_file.WavFile(io.BytesIO(make_wav(samples, 1, 24)))
+        out_file = io.BytesIO()
+        out_wav_file = wav_file.WavFile(
+            out_file, 'w', params=in_wav_file.get_params())
+        data_steg.write_data_bulk(
+            in_wav_file, out_wav_file, data, False, '1', lsb_count=4)
+        written = out_file.getvalue()[-len(samples):]
+        self.assertEqual(written[1::3], samples[1::3])
+        self.assertEqual(written[2::3], samples[2::3])
+        self.assertEqual([x >> 4 for x in written[0::3]],
+                         [x >> 4 for x in samples[0::3]])
+        read_wav_file = wav_file.WavFile(io.BytesIO(out_file.getvalue()))
+        self.assertEqual(data_steg.read_data_bulk(
+            read_wav_file, len(data), '1', lsb_count=4), data)
+
+    def test_codecs(self):
+        for codec in container.get_codec_names() + ['auto']:
+            with open(IN_WAV_FILENAME, 'rb') as in_file,\
+                    open(OUT_WAV_FILENAME, 'wb') as out_file,\
+                    open(TEXT_FILENAME, 'rb') as text_file:
+                steganography.write_files(in_file, out_file, [text_file],
+                                          False, compress=True, codec=codec)
+            with open(OUT_WAV_FILENAME, 'rb') as read_file:
+                steganography.read_files(read_file, OUT_DIR, compress=True)
+            with open(TEXT_FILENAME, 'rb') as expected_file,\
+                    open(OUT_TEXT_FILENAME, 'rb') as real_file:
+                self.assertEqual(expected_file.read(), real_file.read())
+        os.remove(OUT_WAV_FILENAME)
+        random_data = os.urandom(1 << 16)
+        self.assertEqual(container.choose_codec(random_data),
+                         container.STORE_CODEC)
+        self.assertNotEqual(container.choose_codec(bytes(1 << 16), 0),
+                            container.STORE_CODEC)
+
+    def test_corrupt_frame_table(self):
+        # a frame bigger than the carrier is a decoding error for workers
+        with open(PICTURE_FILENAME, 'rb') as picture_file:
+            label = steganography.make_label([picture_file])
+        data = container.make_header(container.FRAME_SIZE, 1, len(label)) + \
+            label + container.make_frame_table([0xffffffff])
+        with open(IN_WAV_FILENAME, 'rb') as in_file,\
+                open(OUT_WAV_FILENAME, 'wb') as out_file:
+            in_wav_file = wav_file.WavFile(in_file)
+            out_wav_file = wav_file.WavFile(
+                out_file, 'w', params=in_wav_file.get_params())
+            data_steg.write_data_bulk(
+                in_wav_file, out_wav_file, data, False, '1')
+        for workers in [1, 3]:
+            with open(OUT_WAV_FILENAME, 'rb') as read_file:
+                self.assertRaises(steganography.DecodingError,
+                                  steganography.read_files, read_file,
+                                  OUT_DIR, compress=True, workers=workers)
+        os.remove(OUT_WAV_FILENAME)
+
+    def test_steganalysis(self):
+        # quiet signal, lsbs of the first half are replaced by random bits
+        count = 8000 * 4
+        samples = [round(300 * math.sin(i / 300) + random.gauss(0, 2))
+                   for i in range(count)]
+        samples[:count // 2] = [sample & ~1 | random.getrandbits(1)
+                                for sample in samples[:count // 2]]
+        data = struct.pack('<{}h'.format(count), *samples)
+        report = steganalysis.analyze(io.BytesIO(make_wav(data, 1, 16)))
+        rates = [window['rate'] for window in report['windows']]
+        self.assertEqual(len(rates), 4)
+        self.assertGreater(min(rates[:2]), 0.7)
+        self.assertLess(max(rates[2:]), 0.3)
+        self.assertEqual(report['score'], max(rates))
+        # 64-bit samples are analyzed, float samples are not
+        data = struct.pack('<{}q'.format(count), *samples)
+        for audio_format in (1, 3):
+            carrier = io.BytesIO(make_wav(data, 1, 64, audio_format))
+            if audio_format == 1:
+                report = steganalysis.analyze(carrier)
+                self.assertGreater(report['windows'][0]['rate'], 0.7)
+            else:
+                self.assertRaises(wav_file.WavFileError,
+                                  steganalysis.analyze, carrier)
+
+    def test_planner(self):
+        # the biggest payload does not fit in any carrier and is split
+        carrier = make_wav(os.urandom(2 * 8000), 1, 16)
+        with tempfile.TemporaryDirectory() as work_dir:
+            carriers_dir = os.path.join(work_dir, 'carriers')
+            out_dir = os.path.join(work_dir, 'out')
+            os.mkdir(carriers_dir)
+            read_dir = os.path.join(work_dir, 'read')
+            os.mkdir(out_dir)
+            os.mkdir(read_dir)
+            for index in range(3):
+                with open(os.path.join(carriers_dir, '{}.wav'.format(index)),
+                          'wb') as file:
+                    file.write(carrier)
+            names = []
+            for index, size in enumerate([3000, 900, 100]):
+                names.append(os.path.join(work_dir, 'payload{}'.format(index)))
+                with open(names[-1], 'wb') as file:
+                    file.write(os.urandom(size))
+            pool = planner.CarrierPool(carriers_dir)
+            self.assertEqual(pool.get_capacity(pool.get_paths()[0], '1', 2),
+                             2000)
+            self.assertRaises(steganography.TooLargeDataError,
+                              pool.make_plan, names, out_dir, '1', 1)
+            plan = pool.make_plan(names, out_dir, '1', 2)
+            self.assertEqual(len(plan['parts']['payload0']), 2)
+            results = planner.execute_plan(plan, workers=2)
+            self.assertFalse(any(result['error'] for result in results))
+            results = planner.read_plan(plan, read_dir)
+            self.assertFalse(any(result['error'] for result in results))
+            for name in names:
+                with open(name, 'rb') as expected_file,\
+                        open(os.path.join(read_dir, os.path.basename(name)),
+                             'rb') as real_file:
+                    self.assertEqual(expected_file.read(), real_file.read())
+
+    def test_striping(self):
+        with tempfile.TemporaryDirectory() as work_dir:
+            in_names = []
+            out_names = []
+            for index, count in enumerate([6000, 12000, 6000]):
+                in_names.append(os.path.join(work_dir, 'in{}.wav'.format(
+                    index)))
+                out_names.append(os.path.join(work_dir, 'out{}.wav'.format(
+                    index)))
+                with open(in_names[-1], 'wb') as file:
+                    file.write(make_wav(os.urandom(2 * count), 1, 16))
+            payload = os.path.join(work_dir, 'payload')
+            with open(payload, 'wb') as file:
+                file.write(os.urandom(5000))
+            striping.write_striped(in_names, out_names,
+                                   [payload, TEXT_FILENAME], mask='1101',
+                                   lsb_count=4, checksums=True)
+            sizes = [striping.read_stripe_header(name, '1101', 4)['size']
+                     for name in out_names]
+            self.assertAlmostEqual(sizes[1] / sizes[0], 2, delta=0.05)
+            self.assertEqual(
+                striping.get_striped_listing(out_names[::-1], '1101', 4),
+                [('payload', 5000),
+                 ('textfile.txt', os.path.getsize(TEXT_FILENAME))])
+            striping.read_striped(out_names[::-1], work_dir, '1101', 2, 4)
+            for name in [payload, TEXT_FILENAME]:
+                with open(name, 'rb') as expected_file,\
+                        open(os.path.join(work_dir, os.path.basename(name)),
+                             'rb') as real_file:
+                    self.assertEqual(expected_file.read(), real_file.read())
+            self.assertRaises(steganography.DecodingError,
+                              striping.read_striped, out_names[:2], work_dir,
+                              '1101', 1, 4)
+            self.assertRaises(steganography.TooLargeDataError,
+                              striping.write_striped, in_names[:1],
+                              out_names[:1], [payload], lsb_count=1)
+
+    def test_logging(self):
+        # modules only log, handlers are added by the entry point
+        for module in (steganography, data_steg, wav_file, container,
+                       striping, planner):
+            self.assertTrue(all(isinstance(handler, logging.NullHandler)
+                                for handler in module.logger.handlers))
+
 
 class SteganographyTesterWithCompression(SteganographyTester):
     compress = True
@@ -1,5 +1,9 @@
 from copy import copy
+import io
 import logging
+import mmap
+import struct
+import instrumentation
 from steganography_exceptions import WavFileError, UnsupportedOperationError
 
 PARAMS = ['chunk_id', 'chunk_size', 'format', 'subchunk1_id',
@@ -7,23 +11,25 @@ PARAMS = ['chunk_id', 'chunk_size', 'format', 'subchunk1_id',
           'sample_rate', 'byte_rate', 'block_align',
           'bits_per_sample', 'some_trash', 'subchunk2_id', 'subchunk2_size']
 
-FDA = {(b'', b'd'): b'd', (b'd', b'a'): b'da',
-       (b'da', b't'): b'dat', (b'dat', b'a'): b'data'}
-
 CHUNK_ID = b'RIFF'
+RF64_ID = b'RF64'
 FORMAT = b'WAVE'
 SUBCHUNK1_ID = b'fmt '
 SUBCHUNK1_SIZE = 16
+DS64_ID = b'ds64'
+DATA_ID = b'data'
 AUDIO_FORMAT = 1
+FLOAT_FORMAT = 3
+EXTENSIBLE_FORMAT = 0xfffe
+UNKNOWN_SIZE = 0xffffffff
+
+RIFF_HEADER = struct.Struct('<4sI4s')
+CHUNK_HEADER = struct.Struct('<4sI')
+FMT = struct.Struct('<HHIIHH')
+DS64 = struct.Struct('<QQ')
 
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.DEBUG)
-fileHandler = logging.FileHandler('stegano_logs.log')
-fileHandler.setLevel(logging.DEBUG)
-format_string = '%(name)s %(levelname)s %(asctime)s %(message)s'
-formatter = logging.Formatter(format_string)
-fileHandler.setFormatter(formatter)
-logger.addHandler(fileHandler)
+logger.addHandler(logging.NullHandler())
 
 
 def initialize_wav_file(debug):
@@ -35,93 +41,155 @@ def decode_int(data):
     return int.from_bytes(data, byteorder='little', signed=False)
 
 
-def check_marks(file):
-    chunk_id = file.read(4)
-    if CHUNK_ID != chunk_id:
-        logger.error('unsupported format file: {}'.format(chunk_id))
-        raise WavFileError("unsupported format file: {}".format(chunk_id))
-    params = decode_int(file.read(4))
-    if FORMAT != file.read(4):
-        logger.error('unsupported format file')
+def read_exactly(file, size):
+    data = file.read(size)
+    if len(data) != size:
+        logger.error('unexpected end of file')
         raise WavFileError("unsupported format file")
-    if SUBCHUNK1_ID != file.read(4):
-        logger.error('unsupported format file')
-        raise WavFileError("unsupported format file")
-    subchunk_size = decode_int(file.read(4))
-    if SUBCHUNK1_SIZE != subchunk_size:
+    return data
+
+
+def parse_fmt(data):
+    if len(data) < FMT.size:
         logger.error('unsupported format file')
         raise WavFileError("unsupported format file")
-    audio_format = decode_int(file.read(2))
-    if AUDIO_FORMAT != audio_format:
+    params = dict(zip(['audio_format', 'num_channels', 'sample_rate',
+                       'byte_rate', 'block_align', 'bits_per_sample'],
+                      FMT.unpack_from(data)))
+    if params['audio_format'] == EXTENSIBLE_FORMAT and len(data) >= 26:
+        # first two bytes of the sub format guid are the format code
+        params['audio_format'] = decode_int(data[24:26])
+    if params['audio_format'] not in (AUDIO_FORMAT, FLOAT_FORMAT):
         logger.error('incorrect compress format')
         raise WavFileError("incorrect compress format")
+    if params['block_align'] == 0 or params['num_channels'] == 0:
+        logger.error('unsupported format file')
+        raise WavFileError("unsupported format file")
     return params
 
 
+def get_data_size(chunk_id, size, ds64_size, data_size_left):
+    if size == UNKNOWN_SIZE:
+        # rf64 keeps the size in ds64, others did not know it
+        return data_size_left if ds64_size is None else ds64_size
+    if chunk_id == CHUNK_ID and data_size_left - size >= 1 << 32:
+        # size of data chunk of riff file over 4 GB wraps around
+        size += (data_size_left - size) >> 32 << 32
+    return size
+
+
+def walk_chunks(file):
+    # (id, offset, size) of every chunk of riff/rf64 file, offset is the
+    # offset of the chunk header; one seek per chunk, only ds64 is read
+    start = file.tell()
+    chunk_id, chunk_size, wave_id = RIFF_HEADER.unpack(
+        read_exactly(file, RIFF_HEADER.size))
+    if chunk_id not in (CHUNK_ID, RF64_ID) or wave_id != FORMAT:
+        logger.error('unsupported format file: {}'.format(chunk_id))
+        raise WavFileError("unsupported format file: {}".format(chunk_id))
+    file_size = file.seek(0, io.SEEK_END)
+    ds64_size = None
+    chunks = []
+    offset = start + RIFF_HEADER.size
+    while offset + CHUNK_HEADER.size <= file_size:
+        file.seek(offset)
+        ident, size = CHUNK_HEADER.unpack(
+            read_exactly(file, CHUNK_HEADER.size))
+        if ident == DS64_ID and chunk_id == RF64_ID:
+            chunk_size, ds64_size = DS64.unpack(read_exactly(file, DS64.size))
+        elif ident == DATA_ID:
+            size = get_data_size(chunk_id, size, ds64_size,
+                                 file_size - offset - CHUNK_HEADER.size)
+        chunks.append((ident, offset, size))
+        offset += CHUNK_HEADER.size + size + size % 2
+    return chunk_size, chunks
+
+
 class WavFile:
-    def __init__(self, user_file, mode='r', params=None):
+    def __init__(self, user_file, mode='r', params=None, use_mmap=False):
         logger.info('start logging in wavfile')
         self.mode = mode
         self.user_file = user_file
+        self.map = None
+        self.view = None
         if mode == 'r':
-            self._read(user_file)
+            with instrumentation.stage('header_parse') as stage:
+                self._read(user_file)
+                stage.add(len(self.params['header']))
+            if use_mmap:
+                self._map(user_file)
         elif mode == 'w':
             self._write(user_file, params)
 
     def _read(self, in_file):
-        # in_file must be bytes-readable
+        # in_file must be bytes-readable and seekable
         logger.info('start reading wav file')
-        self.pointer = 0
-        self.params = {}
         self.count_of_read_channels = 0
-
-        self.params['chunk_size'] = check_marks(in_file)
-        self.params['num_channels'] = decode_int(in_file.read(2))
-        self.params['sample_rate'] = decode_int(in_file.read(4))
-        self.params['byte_rate'] = decode_int(in_file.read(4))
-        self.params['block_align'] = decode_int(in_file.read(2))
-        self.params['bits_per_sample'] = decode_int(in_file.read(2))
-        mark = in_file.read(4)
-        if mark == b'data':
-            self.some_trash = b''
-        else:
+        start = in_file.tell()
+        chunk_size, self.chunks = walk_chunks(in_file)
+        index = {}
+        for chunk in self.chunks:
+            index.setdefault(chunk[0], chunk)
+        if SUBCHUNK1_ID not in index or DATA_ID not in index or \
+                index[SUBCHUNK1_ID][1] > index[DATA_ID][1]:
+            logger.error('unsupported format file')
+            raise WavFileError("unsupported format file")
+        fmt_offset, fmt_size = index[SUBCHUNK1_ID][1:]
+        data_offset, data_size = index[DATA_ID][1:]
+        in_file.seek(start)
+        header = read_exactly(
+            in_file, data_offset + CHUNK_HEADER.size - start)
+        fmt_start = fmt_offset - start
+        fmt_stop = fmt_start + CHUNK_HEADER.size + fmt_size + fmt_size % 2
+        self.params = parse_fmt(
+            header[fmt_start + CHUNK_HEADER.size:fmt_stop])
+        self.params['chunk_size'] = chunk_size
+        # chunks before data except fmt, they are passed to the output
+        self.some_trash = header[RIFF_HEADER.size:fmt_start] + \
+            header[fmt_stop:-CHUNK_HEADER.size]
+        if self.some_trash:
             logger.warning('some trash in file was found')
-            some_trash = bytearray(mark)
-            state = b''
-            while 1:
-                c = in_file.read(1)
-                if (state, c) in FDA.keys():
-                        state = FDA[(state, c)]
-                else:
-                    state = b''
-                if state == b'data':
-                    self.subchunk2_id = b'data'
-                    break
-                else:
-                    some_trash.append(c[0])
-            self.some_trash = bytes(some_trash[:-3])
         self.params['some_trash'] = self.some_trash
         logger.info('some trash was successfully parsed')
-        self.params['subchunk2_size'] = decode_int(in_file.read(4))
-        self.head_size = 43 + len(self.some_trash)
-        self.pointer = self.head_size + 1
+        self.params['header'] = header
+        self.params['subchunk2_size'] = data_size
+        self.data_start = data_offset + CHUNK_HEADER.size
+        self.head_size = self.data_start - 1
+        self.pointer = self.data_start
         self.in_file = in_file
 
+    def _map(self, in_file):
+        # samples are then sliced from the mapping without seek/read calls
+        try:
+            self.map = mmap.mmap(in_file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (io.UnsupportedOperation, AttributeError, OSError,
+                ValueError) as error:
+            logger.warning('file can not be mapped: {}'.format(error))
+            return
+        self.view = memoryview(self.map)
+        logger.info('wav file was successfully mapped')
+
     def _write(self, out_file, params):
         logger.info('start writing in wav file')
         self.params = copy(params)
-        data = [b'RIFF', params['chunk_size'].to_bytes(4, 'little'), b'WAVE',
-                b'fmt ', SUBCHUNK1_SIZE.to_bytes(4, 'little'),
-                AUDIO_FORMAT.to_bytes(2, 'little'),
-                params['num_channels'].to_bytes(2, 'little'),
-                params['sample_rate'].to_bytes(4, 'little'),
-                params['byte_rate'].to_bytes(4, 'little'),
-                params['block_align'].to_bytes(2, 'little'),
-                params['bits_per_sample'].to_bytes(2, 'little'),
-                params['some_trash'], b'data',
-                params['subchunk2_size'].to_bytes(4, 'little')]
-        out_file.write(b''.join(data))
-        self.size = 43 + len(params['some_trash'])
+        if 'header' in params:
+            # header of the input file with all its chunks before data
+            data = [params['header']]
+        else:
+            data = [b'RIFF', params['chunk_size'].to_bytes(4, 'little'),
+                    b'WAVE', b'fmt ', SUBCHUNK1_SIZE.to_bytes(4, 'little'),
+                    AUDIO_FORMAT.to_bytes(2, 'little'),
+                    params['num_channels'].to_bytes(2, 'little'),
+                    params['sample_rate'].to_bytes(4, 'little'),
+                    params['byte_rate'].to_bytes(4, 'little'),
+                    params['block_align'].to_bytes(2, 'little'),
+                    params['bits_per_sample'].to_bytes(2, 'little'),
+                    params['some_trash'], b'data',
+                    params['subchunk2_size'].to_bytes(4, 'little')]
+        data = b''.join(data)
+        self.start = out_file.tell() if out_file.seekable() else 0
+        out_file.write(data)
+        self.size = len(data) - 1
         self.out_file = out_file
 
     def get_param(self, param):
@@ -142,15 +210,62 @@ class WavFile:
         if self.mode == 'w':
             raise UnsupportedOperationError(
                 "Unsupported operation: not readable")
-        self.in_file.seek(self.pointer)
         block_align = self.get_param('block_align')
         num_channels = self.get_param('num_channels')
-        self.pointer += count * block_align // self.get_param('num_channels')
-        channels = self.in_file.read(count * block_align // num_channels)
+        channels = self._read_bytes(count * block_align // num_channels)
         self.count_of_read_channels += 1
         # logger.info('{} channel(s) was successfully read'.format(count))
         return channels
 
+    def get_sample_width(self):
+        return self.params['block_align'] // self.params['num_channels']
+
+    def read_block(self, count):
+        # unlike read_channels, every read sample counts as a read channel
+        if self.mode == 'w':
+            raise UnsupportedOperationError(
+                "Unsupported operation: not readable")
+        data = self._read_bytes(count * self.get_sample_width())
+        self.count_of_read_channels += count
+        return data
+
+    def skip_block(self, count):
+        # moves pointer like read_block, but nothing is read
+        self.pointer += count * self.get_sample_width()
+        self.count_of_read_channels += count
+
+    def seek_block(self, index):
+        # state as if index samples of the data chunk were read by blocks
+        self.pointer = self.data_start + index * self.get_sample_width()
+        self.count_of_read_channels = index
+
+    def _read_bytes(self, size):
+        start = self.pointer
+        self.pointer += size
+        if self.view is not None:
+            return self.view[start:start + size]
+        self.in_file.seek(start)
+        return self.in_file.read(size)
+
+    def read_tail(self):
+        # chunks after the data chunk, they are passed to the output
+        data_stop = self.data_start + self.params['subchunk2_size']
+        if self.view is not None:
+            return self.view[data_stop:]
+        self.in_file.seek(data_stop)
+        return self.in_file.read()
+
+    def get_samples(self, start, stop):
+        # view of the data chunk by sample index, it does not move pointer
+        if self.view is None:
+            raise UnsupportedOperationError(
+                "Unsupported operation: wav file is not mapped")
+        width = self.get_sample_width()
+        data_stop = self.data_start + self.params['subchunk2_size']
+        start = min(self.data_start + start * width, data_stop)
+        stop = min(self.data_start + stop * width, data_stop)
+        return self.view[start:stop]
+
     def write_data(self, data):
         if self.mode == 'r':
             raise UnsupportedOperationError(
@@ -159,7 +274,40 @@ class WavFile:
         self.size += len(data)
         # logger.info('{} bytes was successfully wrote'.format(len(data)))
 
+    def unmap(self):
+        if self.map is None:
+            return
+        self.view.release()
+        try:
+            self.map.close()
+        except BufferError:
+            logger.warning('mapped samples are still in use')
+        self.map = self.view = None
+
+    def skip_data(self, size):
+        # leaves size bytes to be written by somebody else
+        self.out_file.flush()
+        self.out_file.seek(size, io.SEEK_CUR)
+        self.size += size
+
+    def is_patchable(self):
+        # files opened for appending ignore seek before write
+        if self.mode != 'w' or not self.out_file.seekable():
+            return False
+        return 'a' not in getattr(self.out_file, 'mode', '')
+
+    def patch_data(self, position, data):
+        # rewrites already written bytes, position is counted like size
+        if not self.is_patchable():
+            raise UnsupportedOperationError(
+                "Unsupported operation: not patchable")
+        current_position = self.out_file.tell()
+        self.out_file.seek(self.start + position + 1)
+        self.out_file.write(data)
+        self.out_file.seek(current_position)
+
     def close(self):
+        self.unmap()
         if self.mode == 'r':
             self.in_file.close()
         if self.mode == 'w':